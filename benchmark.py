@@ -0,0 +1,226 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Benchmarks of the WaitingList hot paths at several scales.
+Run as:
+python3 benchmark.py --save baseline.json
+and after a change, to compare against the saved baseline:
+python3 benchmark.py --compare baseline.json
+
+Every case builds a model (timing __init__, including the data_import lookups), times the initial
+and monthly add_candidates calls, a number of steps, and every model reporter.  The peak memory of
+building and stepping the model is measured in a separate pass with tracemalloc, since tracing
+slows the model down."""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import numpy.random as npr
+
+from data_import import clear_parameter_cache
+from reporters import model_reporter
+from waitinglist import WaitingList
+
+SMALL_DSAS = "CAOP,ILIP,INOP,MNOP"
+
+# Timings more than this fraction slower than the baseline are reported as regressions
+DEFAULT_TOLERANCE = 0.1
+
+# The reporters only take microseconds, so each one is timed over this many calls
+REPORTER_CALLS = 200
+
+# WaitingList options that change how the engine runs, named in the benchmark cases that use them
+ENGINE_OPTIONS = ["active_set", "batched_draws", "kernels"]
+
+
+def case_name(params):
+    """
+    Return the name of a benchmark case, used as its key in the baseline files.  The name includes
+    the engine and the options enabled with it, so a comparison only matches cases run the same way.
+    """
+    dsas = "ALL" if params["DSAs"] == "ALL" else "%d-DSAs" % len(params["DSAs"].split(","))
+    engine = "+".join([params.get("engine", "agents")] +
+                      [option for option in ENGINE_OPTIONS if params.get(option)])
+    return "%s/p=%s/smart=%s/scale=%s/%s" % (dsas, params["advantage_prob"], params["smart_listing"],
+                                            params["population_scale"], engine)
+
+
+def build_model(params):
+    """
+    Build a model from the benchmark parameters, with the data caches cleared so the
+    data_import lookups are part of the work.
+    """
+    clear_parameter_cache()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return WaitingList(output=False, record_interval=0, **params)
+
+
+def timed(function, *args, calls=1):
+    """
+    Call function and return the number of seconds it took, on average over the given number of calls.
+    """
+    start = time.perf_counter()
+    for i in range(calls):
+        function(*args)
+    return (time.perf_counter() - start) / calls
+
+
+def time_case(params, months, arrivals):
+    """
+    Time the hot paths of one benchmark case and return a dictionary of seconds.
+
+    args:
+    params: WaitingList arguments of the case
+    months: number of steps to time
+    arrivals: number of monthly add_candidates calls to time
+    """
+    result = {}
+
+    # __init__, and the initial add_candidates on a model that is thrown away afterwards
+    start = time.perf_counter()
+    model = build_model(params)
+    result["init"] = time.perf_counter() - start
+    result["add_candidates_initial"] = timed(model.add_candidates, model.initial_patients, True)
+
+    # Step a new model, then time the monthly arrivals and the reporters on the stepped model
+    model = build_model(params)
+    with contextlib.redirect_stdout(io.StringIO()):
+        step_times = [timed(model.step) for i in range(months)]
+    result["step"] = float(np.mean(step_times))
+    result["add_candidates"] = float(np.mean([timed(model.add_candidates, npr.poisson(model.additional_patients))
+                                              for i in range(arrivals)]))
+    for name, reporter in model_reporter.items():
+        result["reporter:" + name] = timed(reporter, model, calls=REPORTER_CALLS)
+    return result
+
+
+def peak_memory(params, months):
+    """
+    Return the peak memory, in bytes, allocated while building a model and stepping it.
+    """
+    tracemalloc.start()
+    try:
+        model = build_model(params)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(months):
+                model.step()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(cases, months=12, arrivals=10, repeats=3, memory=True):
+    """
+    Run every benchmark case and return the results, keyed by case name.  Each timing is the
+    fastest of the repeats, which is the least disturbed by other work on the machine.
+
+    args:
+    cases: list of dictionaries of WaitingList arguments
+    months: number of steps to time in each case
+    arrivals: number of monthly add_candidates calls to time in each case
+    repeats: number of times each case is timed
+    memory: also measure the peak memory of each case
+    """
+    # Warm up the imports, data files and allocator before the first timing
+    build_model(cases[0])
+
+    results = {}
+    for params in cases:
+        name = case_name(params)
+        timings = [time_case(params, months, arrivals) for i in range(repeats)]
+        result = {measurement: min(timing[measurement] for timing in timings) for measurement in timings[0]}
+        if memory:
+            result["peak_memory"] = peak_memory(params, months)
+        results[name] = result
+        print("%-60s init %7.3fs  step %7.4fs  add %7.4fs%s" % (
+            name, result["init"], result["step"], result["add_candidates"],
+            "  peak %7.1f MB" % (result["peak_memory"] / 1e6) if memory else ""))
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print the ratio of every result to its baseline value, and return the list of
+    (case, measurement, ratio) that are more than tolerance slower (or larger) than the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print("%s: not in the baseline" % name)
+            continue
+        for measurement, value in result.items():
+            base = baseline[name].get(measurement)
+            if not base:
+                continue
+            ratio = value / base
+            flag = ""
+            if ratio > 1 + tolerance:
+                regressions.append((name, measurement, ratio))
+                flag = "  REGRESSION"
+            print("%-60s %-36s %6.2fx%s" % (name, measurement, ratio, flag))
+    return regressions
+
+
+def environment():
+    """
+    Return a description of the machine and library versions the benchmarks ran with.
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "system": platform.platform()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the waiting list model.")
+    parser.add_argument("--dsas", nargs="+", default=[SMALL_DSAS, "ALL"])
+    parser.add_argument("--advantage-probs", type=float, nargs="+", default=[0.05, 0.2])
+    parser.add_argument("--smart-listing", choices=["on", "off"], nargs="+", default=["on", "off"])
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 2, 10],
+                        help="population multipliers (see WaitingList population_scale)")
+    parser.add_argument("--engine", default="arrays")
+    parser.add_argument("--active-set", action="store_true")
+    parser.add_argument("--batched-draws", action="store_true")
+    parser.add_argument("--kernels", action="store_true")
+    parser.add_argument("--months", type=int, default=12, help="steps timed in each case")
+    parser.add_argument("--arrivals", type=int, default=10, help="monthly add_candidates calls timed")
+    parser.add_argument("--repeats", type=int, default=3, help="times each case is timed, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory pass")
+    parser.add_argument("--save", default=None, help="write the results to this baseline file")
+    parser.add_argument("--compare", default=None, help="compare the results to this baseline file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    cases = []
+    for dsas, p, smart, scale in itertools.product(args.dsas, args.advantage_probs, args.smart_listing, args.scales):
+        cases.append({"DSAs": dsas,
+                      "advantage_prob": p,
+                      "smart_listing": smart == "on",
+                      "population_scale": scale,
+                      "seed": args.seed,
+                      "engine": args.engine,
+                      "active_set": args.active_set,
+                      "batched_draws": args.batched_draws,
+                      "kernels": args.kernels})
+
+    results = run_benchmarks(cases, args.months, args.arrivals, args.repeats, not args.no_memory)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"environment": environment(), "settings": vars(args), "results": results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        print("%d regressions" % len(regressions))
+        sys.exit(1 if regressions else 0)
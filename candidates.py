@@ -0,0 +1,199 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Random generation of the candidates (new patients) joining the waiting lists.  """
+
+from collections import namedtuple
+
+import numpy as np
+
+from patient_arrays import MAX_LISTINGS
+
+# Create probability tables on the waiting list time from the OTPN data on the website.
+WAITING_RANGES = [[0, 1], [1, 3], [3, 6], [6, 12], [12, 24], [24, 36], [36, 60], [60, 80]]
+WAITING_RANGE_PROBABILITIES = [0.0411, 0.0665, 0.0825, 0.1368, 0.2004, 0.1409, 0.1830, 0.1488]
+
+# A batch of candidates, one entry (or row of listings) per candidate:
+#   listings: listing regions, the primary region first, padded with -1
+#   lifespan: lifespan of the candidate
+#   waiting: time already spent waiting (non-zero only for the initial waiting list)
+CandidateBatch = namedtuple('CandidateBatch', ['listings', 'lifespan', 'waiting'])
+
+
+def smart_listing_scores(rates, queue_sizes):
+    """
+    Return the score of each region for smart listing: the number of transplants per queue size.
+    """
+    return np.array(rates).astype('float') / (np.array(queue_sizes) + 1)
+
+
+def draw_candidates_sequential(rng, num_to_add, queue_probabilities, advantage_probability,
+                               average_lifespan, initial=False, rates=None, queue_sizes=None):
+    """
+    Draw candidates one at a time, in the order the model has always drawn them.  An advantaged
+    candidate is listed in 1 to 3 more regions, but never in more than the other regions there are
+    (with a score above 0, for smart listing).
+
+    args:
+    rng: numpy.random module or a RandomState to draw from
+    num_to_add: number of candidates to draw
+    queue_probabilities: probability of each region being the primary listing
+    advantage_probability: probability that a candidate is listed in more than one region
+    average_lifespan: average lifespan of a candidate
+    initial: whether the candidates form the initial waiting list (and already have waiting time)
+    rates: transplant rates of the regions, only needed for smart listing
+    queue_sizes: number of patients waiting on each list, for smart listing (None to choose secondary
+        regions uniformly).  The sizes, and the scores of the lists that change, are updated as each
+        candidate is listed.
+    """
+    regions = len(queue_probabilities)
+    listings = np.full((num_to_add, MAX_LISTINGS), -1, dtype=np.int64)
+    lifespan = np.zeros(num_to_add)
+    waiting = np.zeros(num_to_add, dtype=np.int64)
+    if queue_sizes is not None:
+        queue_sizes = list(queue_sizes)
+        scores = smart_listing_scores(rates, queue_sizes)
+    region_ids = np.arange(regions)
+
+    if initial:
+        # Choose the waiting range for the patient
+        patient_waiting_range = list(rng.choice(len(WAITING_RANGES), num_to_add, replace=True,
+                                                p=WAITING_RANGE_PROBABILITIES))
+
+    # Generate the list of regions to add patients to
+    all_patient_regions = rng.choice(regions, num_to_add, replace=True, p=queue_probabilities)
+
+    # Place a person in each region
+    for i in range(num_to_add):
+
+        # Set the regions for this patient
+        primary_region = all_patient_regions[i]
+        patient_region = [primary_region]
+
+        # Determine if the patient is advantaged
+        if rng.rand() <= advantage_probability:
+            # Remove the primary region from the list of possibilities
+            possible_regions = np.concatenate((region_ids[:primary_region], region_ids[primary_region + 1:]))
+
+            # if using smart-listing, remove the chosen primary region from the rankings
+            if queue_sizes is not None:
+                # Compute the best regions to add to by computing the number
+                # of TX per queue size
+                best_choice_score = np.concatenate((scores[:primary_region], scores[primary_region + 1:]))
+                # Summed in order, as sum() always has, so the probabilities are unchanged
+                probs = best_choice_score/best_choice_score.cumsum()[-1]
+
+                # Select 1 to 3 more regions to join the waiting list, as many as there are with few regions
+                count = min(rng.randint(1, 4), np.count_nonzero(probs))
+                secondary_listings = list(rng.choice(possible_regions, count, replace=False, p=probs))
+            else:
+                count = min(rng.randint(1, 4), len(possible_regions))
+                secondary_listings = list(rng.choice(possible_regions, count, replace=False))
+
+            patient_region.extend(secondary_listings)
+
+        listings[i, :len(patient_region)] = patient_region
+        if queue_sizes is not None:
+            for q in patient_region:
+                queue_sizes[q] += 1
+                scores[q] = rates[q] / (queue_sizes[q] + 1.0)
+
+        # If this is the initial patient addition, provide the patient with waiting time.
+        if initial:
+            # Use the time range to select the waiting time - uniformly distributed within the range.
+            waiting[i] = rng.randint(WAITING_RANGES[patient_waiting_range[i]][0],
+                                     WAITING_RANGES[patient_waiting_range[i]][1])
+            lifespan[i] = 5*rng.randn(1)[0] + average_lifespan
+
+            # Ensure Patients don't have a shorter lifespan than
+            # the time they've already spend waiting.
+            # RE-compute the lifespan until it's longer than their
+            # time waiting.  We assume that any patient with
+            # a shorted lifespan than their time waiting has
+            # passed away before the start of the simulation.
+            while waiting[i] > lifespan[i]:
+                lifespan[i] = 5*rng.randn(1)[0] + average_lifespan
+
+        else:
+            # Set the patient's lifespan using a normal random
+            # number distribution N(average_lifespan, 25)
+            lifespan[i] = 5*rng.randn(1)[0] + average_lifespan
+
+    return CandidateBatch(listings, lifespan, waiting)
+
+
+def draw_candidates(rng, num_to_add, queue_probabilities, advantage_probability,
+                    average_lifespan, initial=False, scores=None, groups=None):
+    """
+    Draw a batch of candidates with array-valued random draws.  The candidates have the same
+    distribution as with draw_candidates_sequential, except that the smart listing scores are
+    taken once for the whole batch, and the random numbers are consumed differently, so the
+    results differ from the sequential draws.
+
+    args:
+    rng: numpy.random module or a RandomState to draw from
+    num_to_add: number of candidates to draw
+    queue_probabilities: probability of each region being the primary listing
+    advantage_probability: probability that a candidate is listed in more than one region
+    average_lifespan: average lifespan of a candidate
+    initial: whether the candidates form the initial waiting list (and already have waiting time)
+    scores: smart listing score of each region (see smart_listing_scores), secondary regions are
+        chosen with probability proportional to their score.  None to choose them uniformly.
+    groups: with a 2-D array of scores (one row of region scores per group of candidates), the
+        row of scores used for each candidate
+
+    Reproducibility contract: for a given state of rng and the same arguments, the batch is
+    always the same.  The draws are made in this order, and nothing else is drawn:
+    1. initial only: the waiting range of every candidate, rng.choice(8, n, p=...)
+    2. the primary region of every candidate, rng.choice(regions, n, p=queue_probabilities)
+    3. the advantage test of every candidate, rng.random_sample(n) <= advantage_probability
+    4. initial only: the waiting time of every candidate, one rng.randint(low, high) call
+    5. the lifespan of every candidate, rng.standard_normal(n); for the initial waiting list the
+       candidates with waiting > lifespan are redrawn, in rounds of rng.standard_normal(k) over
+       the k rejected candidates in order, until none are rejected
+    6. the number of secondary listings of each advantaged candidate, rng.randint(1, 4, a)
+    7. the secondary regions of all advantaged candidates, from one rng.random_sample((a, regions))
+       array: each region gets the key log(score) - log(-log(u)) and the candidate is listed in
+       the regions with the largest keys (Gumbel top-k), which is the same as drawing regions one
+       by one without replacement with probability proportional to their score.  Regions with a
+       key of -inf (the primary region, and regions with a score of 0) are never chosen, so with
+       few regions a candidate can get fewer secondary listings than drawn
+    """
+    regions = len(queue_probabilities)
+    listings = np.full((num_to_add, MAX_LISTINGS), -1, dtype=np.int64)
+    waiting = np.zeros(num_to_add, dtype=np.int64)
+
+    if initial:
+        waiting_range = rng.choice(len(WAITING_RANGES), num_to_add, replace=True,
+                                   p=WAITING_RANGE_PROBABILITIES)
+    listings[:, 0] = rng.choice(regions, num_to_add, replace=True, p=queue_probabilities)
+    advantaged = np.flatnonzero(rng.random_sample(num_to_add) <= advantage_probability)
+
+    # Initial waiting times, uniformly distributed within the chosen range
+    if initial and num_to_add > 0:
+        bounds = np.array(WAITING_RANGES)
+        waiting[:] = rng.randint(bounds[waiting_range, 0], bounds[waiting_range, 1])
+
+    # Lifespans ~ N(average_lifespan, 25), redrawn for the initial candidates that would
+    # already have passed away before the start of the simulation
+    lifespan = 5*rng.standard_normal(num_to_add) + average_lifespan
+    if initial:
+        rejected = np.flatnonzero(waiting > lifespan)
+        while len(rejected) > 0:
+            lifespan[rejected] = 5*rng.standard_normal(len(rejected)) + average_lifespan
+            rejected = rejected[waiting[rejected] > lifespan[rejected]]
+
+    # Secondary listings for the advantaged candidates, the primary region can not be chosen again
+    counts = rng.randint(1, 4, len(advantaged))
+    keys = -np.log(-np.log(rng.random_sample((len(advantaged), regions))))
+    if scores is not None:
+        if groups is not None:
+            scores = scores[groups[advantaged]]
+        with np.errstate(divide='ignore'):
+            keys += np.log(scores)
+    keys[np.arange(len(advantaged)), listings[advantaged, 0]] = -np.inf
+    best = np.argsort(-keys, axis=1, kind='stable')[:, :MAX_LISTINGS - 1]
+    chosen = np.arange(best.shape[1]) < counts[:, None]
+    chosen &= np.isfinite(np.take_along_axis(keys, best, 1))
+    listings[advantaged, 1:1 + best.shape[1]] = np.where(chosen, best, -1)
+
+    return CandidateBatch(listings, lifespan, waiting)
@@ -0,0 +1,272 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Cohort storage for the single-listed patients of the waiting list model.  """
+
+import numpy as np
+
+from patient_arrays import PatientEvents
+
+
+class CohortGroup:
+    """
+    The patients that joined a region's waiting list in the same month.  Multiply listed
+    patients are kept individually; single-listed patients only differ by the time they had
+    already waited when they joined and the month they die, so they are counted in bins.
+
+    Attributes:
+        entry: clock value of the month the patients joined
+        bins: number of single-listed patients still waiting, by (initial waiting, death month)
+        singles: total number of single-listed patients still waiting
+        individuals: indices of the multiply listed patients in the order they joined, some may no
+            longer be waiting
+        cursor: position of the first of the individuals that has not been taken from the queue
+        order: order the remaining patients are taken in, set once the group reaches the front of
+            the queue: the key of a single-listed patient, or None for the next of the individuals
+        position: position of the next patient to take in order
+    """
+    __slots__ = ("entry", "bins", "singles", "individuals", "cursor", "order", "position")
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.bins = {}
+        self.singles = 0
+        self.individuals = []
+        self.cursor = 0
+        self.order = None
+        self.position = 0
+
+
+class CohortQueue:
+    """
+    Waiting list for one region of the cohort engine: a FIFO of CohortGroups, oldest first.
+    Patients are taken from the oldest group that still has someone waiting.  Within a group,
+    the multiply listed patients are taken in the order they joined, as in every other queue
+    they are listed in, and the single-listed patients are interleaved among them in a random
+    order, drawn when the group reaches the front of the queue.  New patients are drawn in a
+    random order, so this gives the same distribution of outcomes as the other engines, without
+    keeping the order of the single-listed patients while they wait.
+
+    Attributes:
+        groups: the groups of the queue, only the groups from head onwards may still have patients
+        head: position of the oldest group that may still have patients
+        live: number of queued patients that are still waiting
+        patients: the PatientCohorts storage, for the clock and the random number generator
+    """
+    # Do not bother compacting queues with fewer emptied groups than this
+    MIN_COMPACT = 64
+
+    def __init__(self, patients):
+        """
+        Create an empty queue
+        """
+        self.groups = []
+        self.head = 0
+        self.live = 0
+        self.patients = patients
+
+    def __len__(self):
+        """
+        Return the number of patients in the queue that are still waiting.
+        """
+        return self.live
+
+    def __iter__(self):
+        """
+        Iterate over the queued patients that are still waiting, oldest group first: the index of
+        each multiply listed patient, and an (initial waiting, death month) key for each
+        single-listed patient.
+        """
+        for group in self.groups[self.head:]:
+            for index in group.individuals[group.cursor:]:
+                if self.patients.is_waiting(index):
+                    yield index
+            for key, count in group.bins.items():
+                for i in range(count):
+                    yield key
+
+    def entries(self):
+        """
+        Return the number of entries held from the head on: a bin counts as one entry, and each
+        multiply listed patient (including those no longer waiting) as one.
+        """
+        return sum(len(group.bins) + len(group.individuals) - group.cursor for group in self.groups[self.head:])
+
+    def group(self):
+        """
+        Return the group of the current month, starting it if needed.
+        """
+        clock = self.patients.clock
+        if len(self.groups) == self.head or self.groups[-1].entry != clock:
+            self.groups.append(CohortGroup(clock))
+        return self.groups[-1]
+
+    def extend(self, items):
+        """
+        Add multiply listed patients, given by index, to the current month.
+        """
+        group = self.group()
+        group.individuals.extend(items)
+        group.order = None
+        self.live += len(items)
+
+    def add_singles(self, keys, counts):
+        """
+        Add single-listed patients to the current month, counts[i] of them with the
+        (initial waiting, death month) keys[i].  Returns the group they were added to.
+        """
+        group = self.group()
+        for key, count in zip(keys, counts):
+            group.bins[key] = group.bins.get(key, 0) + count
+        group.singles += sum(counts)
+        group.order = None
+        self.live += sum(counts)
+        return group
+
+    def discard(self, count=1):
+        """
+        Record that count queued patients stopped waiting.
+        """
+        self.live -= count
+
+    def pop_waiting(self):
+        """
+        Take the next patient from the oldest month with patients still waiting.  Returns the
+        index of a multiply listed patient, the (group, key) of the bin of a single-listed
+        patient, or None if nobody in the queue is waiting.
+        """
+        is_waiting = self.patients.is_waiting
+        clock = self.patients.clock
+        while self.head < len(self.groups):
+            group = self.groups[self.head]
+            if group.order is None:
+                self.shuffle(group)
+            order = group.order
+            while group.position < len(order):
+                key = order[group.position]
+                group.position += 1
+                if key is None:
+                    # The next multiply listed patient, skipped if they stopped waiting
+                    index = group.individuals[group.cursor]
+                    group.cursor += 1
+                    if is_waiting(index):
+                        return index
+                elif key[1] > clock:
+                    # A single-listed patient that is still alive
+                    count = group.bins[key]
+                    if count == 1:
+                        del group.bins[key]
+                    else:
+                        group.bins[key] = count - 1
+                    group.singles -= 1
+                    return group, key
+            self.head += 1
+        return None
+
+    def shuffle(self, group):
+        """
+        Draw the order the remaining patients of a group are taken in: a random permutation of
+        the keys of the single-listed patients and one None for each remaining individual.
+        """
+        order = [key for key, count in group.bins.items() for i in range(count)]
+        order += [None] * (len(group.individuals) - group.cursor)
+        group.order = [order[i] for i in self.patients.rng.permutation(len(order)).tolist()]
+        group.position = 0
+
+    def compact(self):
+        """
+        Drop the emptied groups from the front of the queue.
+        """
+        if self.head > self.MIN_COMPACT:
+            self.groups = self.groups[self.head:]
+            self.head = 0
+
+
+class PatientCohorts(PatientEvents):
+    """
+    Patient storage for the cohort engine.  Multiply listed patients are individual records,
+    handled as in PatientEvents.  Single-listed patients are only counted, in the bins of the
+    CohortGroups of their region's queue, and their deaths are kept in a second calendar.
+
+    Attributes (besides those of PatientEvents):
+        regions: number of regions in the model
+        rng: random number generator for the order patients of the same month are taken in,
+            separate from the model's so the other draws are the same as in the other engines
+        cohort_deaths: calendar of the deaths of single-listed patients, mapping a value of clock
+            to the list of (region, group, key) of the bins dying then
+        selected_singles: number of single-listed patients selected since the last step, by region
+    """
+    def __init__(self, regions, seed, capacity=1024):
+        """
+        Create empty storage for a model with the given number of regions
+
+        args:
+        regions: number of regions
+        seed: seed of the generator of the order within a month
+        capacity: initial number of multiply listed patients the arrays can hold
+        """
+        PatientEvents.__init__(self, capacity)
+        self.regions = regions
+        self.rng = np.random.RandomState(seed)
+        self.cohort_deaths = {}
+        self.selected_singles = np.zeros(regions, dtype=np.int64)
+
+    def add_singles(self, queues, region, lifespan, waiting):
+        """
+        Add single-listed patients to the bins of their region's queue.
+
+        args:
+        queues: the model's CohortQueues
+        region: region of each patient
+        lifespan: lifespan of each patient
+        waiting: time each patient has already spent waiting
+        """
+        if len(region) == 0:
+            return
+        death = self.clock + self.months_to_death(lifespan, waiting)
+
+        # Count the patients in each (region, waiting, death) bin, packed into a single integer
+        waiting_span = int(waiting.max()) + 1
+        death_span = int(death.max()) + 1
+        packed, counts = np.unique((region * waiting_span + waiting) * death_span + death, return_counts=True)
+        bin_region = packed // (waiting_span * death_span)
+        bin_waiting = packed // death_span % waiting_span
+        bin_death = packed % death_span
+
+        starts = np.flatnonzero(np.diff(bin_region, prepend=-1))
+        ends = np.append(starts[1:], len(counts))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            region = int(bin_region[start])
+            keys = list(zip(bin_waiting[start:end].tolist(), bin_death[start:end].tolist()))
+            group = queues[region].add_singles(keys, counts[start:end].tolist())
+            for key in keys:
+                self.cohort_deaths.setdefault(key[1], []).append((region, group, key))
+
+    def select_single(self, region, group, key):
+        """
+        Record the selection of a single-listed patient taken from a bin, and return the time
+        they spent waiting.
+        """
+        self.selected_singles[region] += 1
+        return key[0] + self.clock - group.entry
+
+    def age_cohorts(self):
+        """
+        Age the single-listed patients, after age has advanced the clock: the patients selected
+        since the last step become transplanted, and the bins due to die in this step become
+        deceased.  Returns the number of patients transplanted and the number that died, by region.
+        """
+        transplanted = self.selected_singles
+        self.selected_singles = np.zeros(self.regions, dtype=np.int64)
+
+        deceased = np.zeros(self.regions, dtype=np.int64)
+        for region, group, key in self.cohort_deaths.pop(self.clock, []):
+            count = group.bins.pop(key, 0)
+            group.singles -= count
+            deceased[region] += count
+        return transplanted, deceased
+
+    def stored(self):
+        """
+        Return the number of records held: the multiply listed patients and the bins.
+        """
+        return PatientEvents.stored(self) + sum(len(deaths) for deaths in self.cohort_deaths.values())
@@ -1,32 +1,172 @@
-import pandas as pd
+import csv
 import glob
+import heapq
+import json
+import multiprocessing
+import os
 import sys
+import tempfile
 
 
 """
 Python script to combine all the output files into a single file
 Run as:
-python3 combine_files.py output_folder_name
+python3 combine_files.py output_folder_name [processes]
+
+The output files are read in parallel and streamed into the combined file with an external
+merge, sorted by advantage_prob and seed, so memory use does not grow with the number of files.
+A manifest of the files already combined is kept next to the combined file, and running the
+script again only merges the files that are new.  If a file changed or was removed, the
+combined file is rebuilt from all the files.  All the files, and the combined file, must have
+the same columns (in any order); a ValueError is raised otherwise.
 """
 
-# Read in the output folder as a filename
-path = sys.argv[1]
+# Number of output files read and sorted together into one run of the external merge
+SHARDS_PER_RUN = 256
+
+
+def sort_key(row, key_columns):
+    """Return the (advantage_prob, seed) key of a row"""
+    return tuple(float(row[i]) for i in key_columns)
+
+
+def output_header(header):
+    """
+    Return the header of the combined file for the header of an output file: the advantage_prob
+    column is moved first, and the unnamed index column is named as pandas names it.
+    """
+    header = ['Unnamed: 0' if name == '' else name for name in header]
+    return ['advantage_prob'] + [name for name in header if name != 'advantage_prob']
+
+
+def read_header(filename):
+    """Return the header of a CSV file"""
+    with open(filename, newline='') as f:
+        return next(csv.reader(f))
+
+
+def column_order(shard_header, header, shard):
+    """
+    Return the position in an output file of each column of the combined file.  Raises a
+    ValueError if the output file does not have the columns of the combined file.
+    """
+    names = ['Unnamed: 0' if name == '' else name for name in shard_header]
+    if sorted(names) != sorted(header):
+        raise ValueError("%s does not have the columns of the combined file: %s missing, %s extra" % (
+            shard, sorted(set(header) - set(names)), sorted(set(names) - set(header))))
+    return [names.index(name) for name in header]
+
+
+def sort_shards(args):
+    """
+    Read a group of output files and write their rows, in the layout of the combined file with the
+    given header and sorted by advantage_prob and seed, to a temporary run file.  Returns the run
+    file name.
+    """
+    shards, header, temp_dir = args
+    rows = []
+    for shard in shards:
+        with open(shard, newline='') as f:
+            reader = csv.reader(f)
+            order = column_order(next(reader), header, shard)
+            for row in reader:
+                rows.append([row[i] for i in order])
+
+    key_columns = [header.index('advantage_prob'), header.index('seed')]
+    rows.sort(key=lambda row: sort_key(row, key_columns))
+
+    handle, run_file = tempfile.mkstemp(suffix='.csv', dir=temp_dir)
+    with os.fdopen(handle, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return run_file
+
+
+def read_rows(filename):
+    """Yield the rows of a sorted CSV file, after its header"""
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield row
+
+
+def shard_state(filename):
+    """Return the size and modification time recorded in the manifest for an output file"""
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def combine(path, processes=None):
+    """
+    Combine the output files in the folder path into path.csv, merging only the files that are
+    not in the manifest yet.
+    """
+    path = path.rstrip('/')
+    combined = path + '.csv'
+    manifest_file = path + '.manifest.json'
+
+    # Get the names and states of all files
+    shards = {filename: shard_state(filename) for filename in sorted(glob.glob(path + '/*.csv'))}
+
+    manifest = {}
+    if os.path.exists(manifest_file) and os.path.exists(combined):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # Rebuild everything if a combined file changed or disappeared, otherwise only merge new files
+    if any(shards.get(filename) != state for filename, state in manifest.items()):
+        print("Output files changed since the last combine, rebuilding", combined)
+        manifest = {}
+    new_shards = [filename for filename in shards if filename not in manifest]
+    if not new_shards:
+        print("No new output files to combine")
+        return
+
+    # Every file is laid out with the columns of the combined file, or of the first new file
+    if manifest:
+        header = read_header(combined)
+    else:
+        header = output_header(read_header(new_shards[0]))
+    key_columns = [header.index('advantage_prob'), header.index('seed')]
+
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(combined)))
+    try:
+        # Read and sort the new files in parallel, in groups
+        groups = [(new_shards[i:i + SHARDS_PER_RUN], header, temp_dir)
+                  for i in range(0, len(new_shards), SHARDS_PER_RUN)]
+        if processes == 1:
+            run_files = [sort_shards(group) for group in groups]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                run_files = pool.map(sort_shards, groups)
 
-# Get the names of all files
-all_files = glob.glob(path+'/*.csv')
+        # Merge the sorted runs, and the existing combined file, into a new combined file
+        inputs = [read_rows(run_file) for run_file in run_files]
+        if manifest:
+            inputs.append(read_rows(combined))
+        merged = heapq.merge(*inputs, key=lambda row: sort_key(row, key_columns))
 
-# Develop a python data frame to store the code
-frame = pd.DataFrame()
-file_list = []
-for file_ in all_files:
-    df = pd.read_csv(file_, index_col='advantage_prob')
-    file_list.append(df)
+        handle, temporary = tempfile.mkstemp(suffix='.csv', dir=temp_dir)
+        with os.fdopen(handle, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(merged)
+        os.replace(temporary, combined)
+    finally:
+        for filename in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, filename))
+        os.rmdir(temp_dir)
 
-# Concatenate all files together
-df = pd.concat(file_list)
+    # Record the combined files
+    manifest.update({filename: shards[filename] for filename in new_shards})
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+    print("Combined %d new output files into %s" % (len(new_shards), combined))
 
-# Sort the df
-df.sort_index(inplace=True)
 
-# Write out to a .CSV
-df.to_csv(path + '.csv')
+if __name__ == '__main__':
+    # Read in the output folder as a filename
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    combine(sys.argv[1], processes)
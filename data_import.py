@@ -2,10 +2,34 @@
 
 """Helper functions to read in data elements from OPTN data files. """
 
+from collections import namedtuple
+from functools import lru_cache
+import hashlib
+import os
+import sys
+
 import numpy.random as npr
 import numpy as np
 import pandas as pd
 
+# Input files, and the folder holding the compiled snapshots of the parameters built from them
+DATA_FILES = ['data/WLAdditions.csv', 'data/Transplants.csv', 'data/WLRemoval.csv', 'data/WL.csv']
+SNAPSHOT_DIR = 'data/compiled'
+
+# Columns of the parameter table, and the column of read_data they are taken from
+PARAMETER_COLUMNS = {'transplants': '2017-TX',
+                     'additions': 'WL-Add-2017-Candidates',
+                     'candidates': 'WL-Candidates',
+                     'ignored_removals': 'WL-Ignored-Removals'}
+
+# Model inputs for a selection of DSAs, listed in the order of the data files
+DSAParameters = namedtuple('DSAParameters', ['dsas', 'rates', 'initial_queue_probabilities',
+                                             'additional_queue_probabilities', 'wl_size',
+                                             'additional_patients'])
+
+# Parameter table, built once per process by get_parameter_table
+_parameter_table = None
+
 
 def read_data():
     """Read in the data Files"""
@@ -39,48 +63,120 @@ def read_data():
     return all_data
 
 
+def data_hash():
+    """Return a hash of the contents of the data files, used to key the compiled snapshots"""
+    digest = hashlib.sha1()
+    for filename in DATA_FILES:
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def snapshot_path():
+    """Return the path of the compiled snapshot matching the current data files"""
+    return os.path.join(SNAPSHOT_DIR, 'parameters-%s.npz' % data_hash())
+
+
+def build_parameter_table():
+    """Build the parameter table (a dictionary of arrays, one entry per DSA) from the data files"""
+    all_data = read_data()
+    table = {'DSA': np.array(list(all_data.DSA), dtype=str)}
+    for name, column in PARAMETER_COLUMNS.items():
+        table[name] = all_data[column].to_numpy(dtype=np.int64)
+    return table
+
+
+def compile_snapshot():
+    """Write the parameter table to a compiled snapshot so later processes can skip the CSV parsing"""
+    table = build_parameter_table()
+    path = snapshot_path()
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    # Write to a temporary file first, so concurrent jobs never load a partial snapshot
+    temporary = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+    np.savez(temporary, **table)
+    os.replace(temporary, path)
+    return path
+
+
+def get_parameter_table():
+    """
+    Return the parameter table for all DSAs.  It is built once per process, from the compiled
+    snapshot if one matches the data files, otherwise from the CSV files.
+    """
+    global _parameter_table
+    if _parameter_table is None:
+        path = snapshot_path()
+        if os.path.exists(path):
+            with np.load(path) as snapshot:
+                _parameter_table = {name: snapshot[name] for name in snapshot.files}
+        else:
+            _parameter_table = build_parameter_table()
+    return _parameter_table
+
+
+@lru_cache(maxsize=None)
+def _select_dsas(dsas):
+    """Return the rows of the parameter table for a tuple of DSAs, in the order of the data files"""
+    table = get_parameter_table()
+    selected = np.isin(table['DSA'], dsas)
+    return {name: values[selected] for name, values in table.items()}
+
+
+def get_dsa_parameters(dsas):
+    """Return all of the model inputs (DSAParameters) for the selected DSAs in a single lookup"""
+    selected = _select_dsas(tuple(dsas))
+    additions = selected['additions']
+    candidates = selected['candidates']
+    return DSAParameters(dsas=selected['DSA'].tolist(),
+                         rates=(selected['transplants'] / float(12)).tolist(),
+                         initial_queue_probabilities=(candidates / candidates.sum()).tolist(),
+                         additional_queue_probabilities=(additions / additions.sum()).tolist(),
+                         wl_size=int(candidates.sum()),
+                         additional_patients=int((additions - selected['ignored_removals']).sum()) / float(12))
+
+
+def clear_parameter_cache():
+    """Forget the parameter table loaded by this process, so the next lookup loads it again"""
+    global _parameter_table
+    _parameter_table = None
+    _select_dsas.cache_clear()
+
+
 def get_all_dsas():
     """Return a list of all DSAs in the database"""
-    all_data = read_data()
-    return list(all_data.DSA)
+    return get_parameter_table()['DSA'].tolist()
 
 
 def get_wl_size(dsas):
     """Return the expected total Waiting List size (for initial model generation.)"""
-    all_data = read_data()
-    selected_data = all_data[all_data['DSA'].isin(dsas)]
-    return sum(selected_data['WL-Candidates'])
+    return get_dsa_parameters(dsas).wl_size
 
 
 def get_additional_patients(dsas):
     """Return the expected additional monthly patients."""
-    all_data = read_data()
-    selected_data = all_data[all_data['DSA'].isin(dsas)]
     # Return the number of candidates added in a year, minus those not acknowledged in the model and
     # divide by 12 to get the monthly rate
-    return sum(selected_data['WL-Add-2017-Candidates'] - selected_data['WL-Ignored-Removals'])/float(12)
+    return get_dsa_parameters(dsas).additional_patients
 
 
 def get_transplant_rates(dsas):
     """Return the monthly transplants in each DSA"""
-    all_data = read_data()
-    selected_data = all_data[all_data['DSA'].isin(dsas)]
-    transplant_rates = selected_data[['DSA', '2017-TX']]
     # Divide by 12 to get the correct number in months
-    return list(transplant_rates['2017-TX'] / float(12) )
+    return get_dsa_parameters(dsas).rates
 
 
 def get_additional_queue_probabilities(dsas):
     """Return the yearly queue probabilities for additions in each DSA"""
-    all_data = read_data()
-    selected_data = all_data[all_data['DSA'].isin(dsas)]
-    queue_probabilities = selected_data['WL-Add-2017-Candidates'] / sum(selected_data['WL-Add-2017-Candidates'])
-    return list(queue_probabilities)
+    return get_dsa_parameters(dsas).additional_queue_probabilities
 
 
 def get_initial_queue_probabilities(dsas):
     """Return the yearly queue probabilities for the initial WL size in each DSA"""
-    all_data = read_data()
-    selected_data = all_data[all_data['DSA'].isin(dsas)]
-    queue_probabilities = selected_data['WL-Candidates'] / sum(selected_data['WL-Candidates'])
-    return list(queue_probabilities)
\ No newline at end of file
+    return get_dsa_parameters(dsas).initial_queue_probabilities
+
+
+if __name__ == '__main__':
+    # Compile the snapshot of the parameters, run as:
+    # python3 data_import.py
+    print("Wrote", compile_snapshot())
+    sys.exit(0)
@@ -0,0 +1,169 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Append-only binary log of the patients' transitions, and a memory-mapped reader for it.
+Summarize a log with:
+python3 eventlog.py log_file"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from patient_arrays import CONDITIONS, WAITING, SELECTED
+
+# One record per transition: the patient, the tick it happened in, the region, the condition
+# the patient entered (WAITING for each listing, SELECTED, TRANSPLANTED or DECEASED) and
+# whether the patient is advantaged
+RECORD = np.dtype([("patient", "<i8"), ("tick", "<i4"), ("region", "<i2"), ("event", "u1"), ("advantaged", "u1")])
+
+# The file starts with MAGIC, the length of the JSON header as a 4-byte integer and the header,
+# padded so the records start on a multiple of the record size
+MAGIC = b"TXEVLOG1"
+
+
+class EventLog:
+    """
+    Buffered writer of the event log of one run.  Records are collected in a NumPy buffer and
+    appended to the file when it fills up.  Pickling the log (as save_checkpoint does) flushes
+    it and remembers the length of the file, and a log loaded from a checkpoint drops any records
+    written after it, so a resumed run gives the same log as one that was never interrupted.
+
+    Attributes:
+        path: file the log is written to
+        buffer: records not yet written, only the first size are filled in
+        size: number of records in the buffer
+        file: the open log file, None once the log is closed
+    """
+    def __init__(self, path, region_codes=(), capacity=65536):
+        """
+        Create the log file, replacing any existing file
+
+        args:
+        path: file to write the log to
+        region_codes: DSA code of each region, stored in the header
+        capacity: number of records buffered before they are written
+        """
+        self.path = path
+        self.buffer = np.zeros(capacity, dtype=RECORD)
+        self.size = 0
+        header = json.dumps({"region_codes": [str(code) for code in region_codes],
+                             "events": list(CONDITIONS)}).encode()
+        header += b" " * (-(len(MAGIC) + 4 + len(header)) % RECORD.itemsize)
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+
+    def append(self, patient, tick, region, event, advantaged):
+        """
+        Record a single transition.
+        """
+        if self.size == len(self.buffer):
+            self.flush()
+        self.buffer[self.size] = (patient, tick, region, event, advantaged)
+        self.size += 1
+
+    def extend(self, patients, tick, regions, event, advantaged):
+        """
+        Record the same transition for an array of patients, in the given tick.  The regions and
+        advantaged flags are arrays matching the patients, or single values.
+        """
+        count = len(patients)
+        if count > len(self.buffer) - self.size:
+            self.flush()
+            if count > len(self.buffer):
+                self.buffer = np.zeros(count, dtype=RECORD)
+        records = self.buffer[self.size:self.size + count]
+        records["patient"] = patients
+        records["tick"] = tick
+        records["region"] = regions
+        records["event"] = event
+        records["advantaged"] = advantaged
+        self.size += count
+
+    def flush(self):
+        """
+        Write the buffered records to the file.
+        """
+        self.file.write(self.buffer[:self.size].tobytes())
+        self.size = 0
+
+    def close(self):
+        """
+        Write the buffered records and close the file.
+        """
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __getstate__(self):
+        if self.file is not None:
+            self.flush()
+            self.file.flush()
+        state = dict(self.__dict__)
+        if self.file is not None:
+            state["offset"] = self.file.tell()
+        del state["file"]
+        state["buffer"] = len(self.buffer)
+        return state
+
+    def __setstate__(self, state):
+        offset = state.pop("offset", None)
+        self.__dict__.update(state)
+        self.buffer = np.zeros(state["buffer"], dtype=RECORD)
+        self.file = None
+        if offset is not None:
+            self.file = open(self.path, "r+b")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+
+
+def read_events(path):
+    """
+    Memory-map an event log, and return its records as a NumPy structured array with the fields
+    of RECORD, and its header (a dictionary with the region codes and the event names).
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not an event log: %s" % path)
+        length = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+        header = json.loads(f.read(length))
+    offset = len(MAGIC) + 4 + length
+    count = (os.path.getsize(path) - offset) // RECORD.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RECORD), header
+    return np.memmap(path, dtype=RECORD, mode="r", offset=offset, shape=(count,)), header
+
+
+def event_ticks(events, event):
+    """
+    Return the tick each patient entered a condition in, indexed by patient, -1 for patients that
+    never entered it.  Listing (WAITING) records give the tick the patient joined the lists.
+    """
+    chosen = events[events["event"] == event]
+    ticks = np.full(int(events["patient"].max()) + 1 if len(events) else 0, -1, dtype=np.int64)
+    ticks[chosen["patient"]] = chosen["tick"]
+    return ticks
+
+
+def listing_counts(events):
+    """
+    Return the number of regions each patient is listed in, indexed by patient.
+    """
+    listed = events["patient"][events["event"] == WAITING]
+    return np.bincount(listed, minlength=int(events["patient"].max()) + 1 if len(events) else 0)
+
+
+if __name__ == '__main__':
+    events, header = read_events(sys.argv[1])
+    regions = header["region_codes"]
+    print("%d events, %d patients" % (len(events), len(listing_counts(events))))
+    print("%-14s" % "" + " ".join("%8s" % code for code in regions))
+    for event, name in enumerate(header["events"]):
+        counts = np.bincount(events["region"][events["event"] == event], minlength=len(regions))
+        print("%-14s" % name + " ".join("%8d" % count for count in counts))
+    selected = event_ticks(events, SELECTED)
+    joined = event_ticks(events, WAITING)
+    waited = (selected - joined)[selected >= 0]
+    if len(waited):
+        print("Months from listing to selection: mean %.2f, median %.1f" % (waited.mean(), np.median(waited)))
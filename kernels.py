@@ -0,0 +1,181 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Compiled kernels for the aging and allocation loops of the array engine.
+The kernels are compiled with Numba when it is installed, otherwise they run as plain Python.
+Check that the kernels give the same results as the reference implementation with:
+python3 kernels.py [seed ...]"""
+
+import contextlib
+import io
+import sys
+
+import numpy as np
+
+from patient_arrays import WAITING, SELECTED, TRANSPLANTED, DECEASED, MAX_LISTINGS
+
+try:
+    from numba import njit
+    COMPILED = True
+except ImportError:
+    COMPILED = False
+
+
+def jit(function):
+    """
+    Compile a kernel with Numba if it is installed, otherwise leave it as a Python function.
+    """
+    if COMPILED:
+        return njit(cache=True)(function)
+    return function
+
+
+@jit
+def age_all(condition, waiting, lifespan, size):
+    """
+    Age the first size patients (see PatientArrays.age), and return the indices of the patients
+    transplanted and deceased in this step.
+    """
+    transplanted = np.empty(size, dtype=np.int64)
+    deceased = np.empty(size, dtype=np.int64)
+    num_transplanted = 0
+    num_deceased = 0
+    for patient in range(size):
+        if condition[patient] == SELECTED:
+            condition[patient] = TRANSPLANTED
+            transplanted[num_transplanted] = patient
+            num_transplanted += 1
+        elif condition[patient] == WAITING:
+            waiting[patient] += 1
+            if waiting[patient] >= lifespan[patient]:
+                condition[patient] = DECEASED
+                deceased[num_deceased] = patient
+                num_deceased += 1
+    return transplanted[:num_transplanted], deceased[:num_deceased]
+
+
+@jit
+def age_active(active, condition, waiting, lifespan):
+    """
+    Age the patients in the active index (see PatientArrays.age), and return the indices of the
+    patients transplanted and deceased in this step, and the new active index.
+    """
+    transplanted = np.empty(len(active), dtype=np.int64)
+    deceased = np.empty(len(active), dtype=np.int64)
+    still_active = np.empty(len(active), dtype=np.int64)
+    num_transplanted = 0
+    num_deceased = 0
+    num_active = 0
+    for patient in active:
+        if condition[patient] == SELECTED:
+            condition[patient] = TRANSPLANTED
+            transplanted[num_transplanted] = patient
+            num_transplanted += 1
+        elif condition[patient] == WAITING:
+            waiting[patient] += 1
+            if waiting[patient] >= lifespan[patient]:
+                condition[patient] = DECEASED
+                deceased[num_deceased] = patient
+                num_deceased += 1
+            else:
+                still_active[num_active] = patient
+                num_active += 1
+    return transplanted[:num_transplanted], deceased[:num_deceased], still_active[:num_active]
+
+
+@jit
+def select_patients(items, head, end, num_to_select, region, condition, waiting, listings,
+                    counts, advantaged, transplant_wait, queue_live, queue_lengths, rates, listing_scores,
+                    selected):
+    """
+    Select up to num_to_select waiting patients from the front of a region's queue, the same way
+    WaitingList.step does: mark them selected, update the outcome counters, and take them off
+    the queues they are listed in.
+
+    args:
+    items, head, end: the buffer of the region's ArrayQueue and its current head and end
+    num_to_select: number of transplants to perform
+    region: the region the patients are selected in
+    condition, waiting, listings: the PatientArrays fields
+    counts, advantaged, transplant_wait: the OutcomeCounters arrays
+    queue_live: number of waiting patients in each region's queue
+    queue_lengths, rates, listing_scores: the model's queue lengths, transplant rates and smart
+        listing scores
+    selected: array of at least num_to_select entries, filled with the indices of the patients
+        selected, in order
+
+    Returns the new head of the queue, the number of patients selected whose primary region is
+    and is not the region, and the total waiting time of the advantaged patients selected.
+    """
+    primary_selected = 0
+    alternate_selected = 0
+    advantaged_wait = 0
+    while primary_selected + alternate_selected < num_to_select and head < end:
+        patient = items[head]
+        head += 1
+        if condition[patient] != WAITING:
+            continue
+
+        condition[patient] = SELECTED
+        selected[primary_selected + alternate_selected] = patient
+        primary = listings[patient, 0]
+        counts[WAITING, primary] -= 1
+        counts[SELECTED, primary] += 1
+        transplant_wait[primary] += waiting[patient]
+        if listings[patient, 1] >= 0:
+            advantaged[WAITING] -= 1
+            advantaged[SELECTED] += 1
+            advantaged_wait += waiting[patient]
+
+        for k in range(MAX_LISTINGS):
+            listed = listings[patient, k]
+            if listed >= 0:
+                queue_live[listed] -= 1
+                queue_lengths[listed] -= 1
+                listing_scores[listed] = rates[listed] / (queue_lengths[listed] + 1.0)
+
+        if primary == region:
+            primary_selected += 1
+        else:
+            alternate_selected += 1
+    return head, primary_selected, alternate_selected, advantaged_wait
+
+
+def check_equivalence(seeds=(0, 1, 2), **params):
+    """
+    Run the array engine with and without the kernels for each seed, and return the list of
+    (seed, output) whose values differ.  Both runs must give exactly the same results.
+
+    args:
+    seeds: seeds to run
+    params: other WaitingList arguments, by default a 4-DSA model run for 3 years
+    """
+    from reporters import model_reporter
+    from waitinglist import WaitingList
+
+    params = dict({"DSAs": "CAOP,ILIP,INOP,MNOP", "advantage_prob": 0.2, "years": 3}, **params)
+    differences = []
+    for seed in seeds:
+        outputs = []
+        for kernels in (False, True):
+            with contextlib.redirect_stdout(io.StringIO()):
+                model = WaitingList(seed=seed, engine="arrays", kernels=kernels, **params)
+                while model.running:
+                    model.step()
+            output = {name: np.asarray(reporter(model)).tolist() for name, reporter in model_reporter.items()}
+            output["patients"] = [field.tolist() for field in model.get_patient_table()]
+            output["primary_listing_transplant"] = model.primary_listing_transplant
+            output["alternate_listing_transplant"] = model.alternate_listing_transplant
+            outputs.append(output)
+        differences += [(seed, name) for name in outputs[0] if outputs[0][name] != outputs[1][name]]
+    return differences
+
+
+if __name__ == '__main__':
+    seeds = [int(seed) for seed in sys.argv[1:]] or [0, 1, 2]
+    print("Kernels are", "compiled with Numba" if COMPILED else "running as plain Python")
+    failed = False
+    for active_set in (False, True):
+        differences = check_equivalence(seeds, active_set=active_set)
+        failed = failed or bool(differences)
+        print("active_set=%s:" % active_set, "same results" if not differences else differences)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,283 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Durable sweep orchestration through a SQLite store of work units and results.
+Declare a grid of WaitingList parameters and load it into a store (running init again with a
+larger grid only adds the new points):
+python3 orchestrator.py init sweep.db sweep_grid.json
+Start any number of workers, on this node or on others that share the file system; each worker
+process loads the data once and runs work units until none are left:
+python3 orchestrator.py work sweep.db --processes 7
+Check progress, and write the results of the finished runs:
+python3 orchestrator.py status sweep.db
+python3 orchestrator.py export sweep.db results.csv
+
+The grid file is JSON with the arguments shared by every run under "fixed", and lists of
+values to sweep over under "variable", as for sweep.run_sweep."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from results_io import save_results
+from sweep import checkpoint_name, load_data, parameter_grid, run_model
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Run states
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+# A running unit not finished after this many seconds is assumed lost (its worker died) and
+# handed out again
+DEFAULT_LEASE = 6 * 3600
+
+# Number of times a failing run is attempted
+DEFAULT_ATTEMPTS = 3
+
+
+def connect(path):
+    """
+    Open the store, creating its tables if needed.  Writers wait for each other's locks.
+    """
+    connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def to_json(value):
+    """
+    Convert NumPy values in a run's parameters or results to plain Python values for JSON.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Can not store %r" % (value,))
+
+
+def add_grid(connection, grid):
+    """
+    Add every point of a grid to the store as a pending run, skipping the points already in it.
+    Returns the number of runs added.
+
+    args:
+    connection: connection to the store
+    grid: dictionary with the "fixed" WaitingList arguments and the "variable" lists of values
+    """
+    runs = parameter_grid(grid.get("fixed", {}), grid.get("variable", {}))
+    connection.execute("BEGIN IMMEDIATE")
+    before = connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    connection.executemany("INSERT OR IGNORE INTO runs (key, params) VALUES (?, ?)",
+                           [(checkpoint_name(params, ""), json.dumps(params, sort_keys=True)) for params in runs])
+    after = connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    metadata = {"grid": json.dumps(grid, sort_keys=True),
+                "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": sys.version.split()[0],
+                "numpy": np.__version__}
+    connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+    connection.execute("COMMIT")
+    return after - before
+
+
+def claim(connection, worker, lease=DEFAULT_LEASE, attempts=DEFAULT_ATTEMPTS):
+    """
+    Atomically take the next run to do: a pending run, or a failed run or a running run whose
+    lease expired with attempts left.  Running runs whose lease expired without attempts left
+    (their worker keeps dying) are marked as failed.  Returns (id, params), or None if there is
+    nothing to do.
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("UPDATE runs SET status = ?, finished = ?, error = ?"
+                       " WHERE status = ? AND started < ? AND attempts >= ?",
+                       (FAILED, now, "The lease of the last attempt expired, its worker was lost",
+                        RUNNING, now - lease, attempts))
+    row = connection.execute(
+        "SELECT id, params FROM runs WHERE status = ? OR (status = ? AND attempts < ?)"
+        " OR (status = ? AND started < ? AND attempts < ?) ORDER BY id LIMIT 1",
+        (PENDING, FAILED, attempts, RUNNING, now - lease, attempts)).fetchone()
+    if row is not None:
+        connection.execute("UPDATE runs SET status = ?, worker = ?, started = ?, attempts = attempts + 1"
+                           " WHERE id = ?", (RUNNING, worker, now, row[0]))
+    connection.execute("COMMIT")
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+
+def work(path, checkpoint_dir=None, checkpoint_every=12, lease=DEFAULT_LEASE, attempts=DEFAULT_ATTEMPTS,
+         max_runs=None, event_log_dir=None):
+    """
+    Run work units from the store until there are none left (or max_runs have been run), in
+    this process.  Returns the number of runs completed.
+
+    args:
+    path: file of the store
+    checkpoint_dir: folder to keep a checkpoint of the current run in, so a run handed out again
+        after its worker died resumes where it stopped.  None for no checkpoints.
+    checkpoint_every: number of months between checkpoints
+    lease: seconds after which a running unit is handed out again
+    attempts: number of times a failing run is attempted
+    max_runs: largest number of runs to do, None for no limit
+    event_log_dir: folder to write the event log of every run to (see eventlog.py), None for no logs
+    """
+    connection = connect(path)
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    completed = 0
+    while max_runs is None or completed < max_runs:
+        unit = claim(connection, worker, lease, attempts)
+        if unit is None:
+            break
+        run_id, params = unit
+        name = checkpoint_name(params, "")
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            params["checkpoint_path"] = os.path.join(checkpoint_dir, name + ".pkl")
+            params["checkpoint_every"] = checkpoint_every
+        if event_log_dir is not None:
+            os.makedirs(event_log_dir, exist_ok=True)
+            params["event_log_path"] = os.path.join(event_log_dir, name + ".bin")
+
+        try:
+            # The data of each set of DSAs is only loaded once per worker process
+            load_data(params["DSAs"])
+            row = run_model(params)
+        except Exception:
+            connection.execute("UPDATE runs SET status = ?, finished = ?, error = ? WHERE id = ? AND worker = ?",
+                               (FAILED, time.time(), traceback.format_exc(), run_id, worker))
+            print("Run %d failed" % run_id)
+            continue
+
+        row.pop("checkpoint_path", None)
+        row.pop("checkpoint_every", None)
+        # Only the worker holding the run records it, a worker whose lease expired while it ran
+        # must not overwrite the run of the worker that took it over
+        updated = connection.execute(
+            "UPDATE runs SET status = ?, finished = ?, error = NULL, result = ? WHERE id = ? AND worker = ?",
+            (DONE, time.time(), json.dumps(row, default=to_json), run_id, worker)).rowcount
+        if updated == 0:
+            print("Run %d was handed out to another worker, its result is not recorded" % run_id)
+            continue
+        completed += 1
+    connection.close()
+    return completed
+
+
+def _work(args):
+    """
+    Entry point of a worker process started by run_workers.
+    """
+    return work(*args)
+
+
+def run_workers(path, processes=None, **kwargs):
+    """
+    Start processes worker processes (all cores by default) on the store, and wait for them.
+    Returns the number of runs completed.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        return work(path, **kwargs)
+    arguments = (path, kwargs.get("checkpoint_dir"), kwargs.get("checkpoint_every", 12),
+                 kwargs.get("lease", DEFAULT_LEASE), kwargs.get("attempts", DEFAULT_ATTEMPTS),
+                 kwargs.get("max_runs"), kwargs.get("event_log_dir"))
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.map(_work, [arguments] * processes, chunksize=1))
+
+
+def status(connection):
+    """
+    Return the number of runs in each state.
+    """
+    return dict(connection.execute("SELECT status, COUNT(*) FROM runs GROUP BY status").fetchall())
+
+
+def load_results(connection):
+    """
+    Return the results of the finished runs as a DataFrame, with one row per run in grid order,
+    and the worker, start time and duration of each run.
+    """
+    rows = []
+    for result, worker, started, finished in connection.execute(
+            "SELECT result, worker, started, finished FROM runs WHERE status = ? ORDER BY id", (DONE,)):
+        row = json.loads(result)
+        row["worker"] = worker
+        row["started"] = started
+        row["seconds"] = finished - started
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a parameter sweep through a SQLite store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init = commands.add_parser("init", help="add the points of a grid to the store")
+    init.add_argument("store")
+    init.add_argument("grid", help="JSON file with the fixed and variable parameters")
+
+    worker = commands.add_parser("work", help="run work units until none are left")
+    worker.add_argument("store")
+    worker.add_argument("--processes", type=int, default=None)
+    worker.add_argument("--checkpoint-dir", default=None)
+    worker.add_argument("--checkpoint-every", type=int, default=12)
+    worker.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                        help="seconds after which an unfinished run is handed out again")
+    worker.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS)
+    worker.add_argument("--max-runs", type=int, default=None, help="runs per worker process")
+    worker.add_argument("--event-log-dir", default=None,
+                        help="write a binary log of every patient transition of every run to this folder")
+
+    report = commands.add_parser("status", help="count the runs in each state, and show the failures")
+    report.add_argument("store")
+
+    export = commands.add_parser("export", help="write the results of the finished runs")
+    export.add_argument("store")
+    export.add_argument("output_file", help="file to write the results to (.csv, .npz or .parquet)")
+
+    args = parser.parse_args()
+    if args.command == "init":
+        with open(args.grid) as f:
+            grid = json.load(f)
+        connection = connect(args.store)
+        print("Added %d runs" % add_grid(connection, grid))
+    elif args.command == "work":
+        done = run_workers(args.store, args.processes, checkpoint_dir=args.checkpoint_dir,
+                           checkpoint_every=args.checkpoint_every, lease=args.lease,
+                           attempts=args.attempts, max_runs=args.max_runs, event_log_dir=args.event_log_dir)
+        print("Completed %d runs" % done)
+    elif args.command == "status":
+        connection = connect(args.store)
+        for state, count in sorted(status(connection).items()):
+            print("%-8s %d" % (state, count))
+        for run_id, params, error in connection.execute(
+                "SELECT id, params, error FROM runs WHERE status = ?", (FAILED,)):
+            print("\nRun %d %s failed:\n%s" % (run_id, params, error))
+    else:
+        save_results(load_results(connect(args.store)), args.output_file)
@@ -0,0 +1,94 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Running counters of patient outcomes, updated whenever a patient changes condition.  """
+
+import numpy as np
+
+from patient_arrays import CONDITIONS, SELECTED
+
+
+class OutcomeCounters:
+    """
+    Counts of the patients in each condition, kept up to date at the point where a patient
+    changes condition so the model reporters never have to scan the patients.
+
+    Attributes:
+        counts: number of patients in each condition, by primary region (conditions x regions)
+        advantaged: number of advantaged patients in each condition
+        transplant_wait: total waiting time of the selected and transplanted patients, by primary region
+        advantaged_transplant_wait: total waiting time of the selected and transplanted advantaged patients
+    """
+    def __init__(self, regions):
+        """
+        Create counters for a model with the given number of regions
+        """
+        self.regions = regions
+        self.counts = np.zeros((len(CONDITIONS), regions), dtype=np.int64)
+        self.advantaged = np.zeros(len(CONDITIONS), dtype=np.int64)
+        self.transplant_wait = np.zeros(regions, dtype=np.int64)
+        self.advantaged_transplant_wait = 0
+
+    def add(self, condition, primary, advantaged):
+        """
+        Count a new patient in the given condition.
+        """
+        self.counts[condition, primary] += 1
+        if advantaged:
+            self.advantaged[condition] += 1
+
+    def add_many(self, condition, primary, advantaged):
+        """
+        Count new patients in the given condition, from arrays of primary regions and advantaged flags.
+        """
+        self.counts[condition] += np.bincount(primary, minlength=self.regions)
+        self.advantaged[condition] += int(np.count_nonzero(advantaged))
+
+    def transition(self, old, new, primary, advantaged, waiting=0):
+        """
+        Move a patient from the old to the new condition.  The waiting time of the patient is
+        recorded when they are selected, since it does not change after that.
+        """
+        self.counts[old, primary] -= 1
+        self.counts[new, primary] += 1
+        if advantaged:
+            self.advantaged[old] -= 1
+            self.advantaged[new] += 1
+        if new == SELECTED:
+            self.transplant_wait[primary] += waiting
+            if advantaged:
+                self.advantaged_transplant_wait += waiting
+
+    def transition_counts(self, old, new, counts):
+        """
+        Move counts[region] patients that are not advantaged, with the given primary region, from
+        the old to the new condition (not to SELECTED, which needs the waiting times).
+        """
+        self.counts[old] -= counts
+        self.counts[new] += counts
+
+    def transition_many(self, old, new, primary, advantaged, waiting=None):
+        """
+        Vectorized transition for arrays of patients.
+
+        args:
+        old: condition the patients are leaving
+        new: condition the patients are entering
+        primary: array of primary regions
+        advantaged: boolean array of advantaged flags
+        waiting: array of waiting times, only needed when new is SELECTED
+        """
+        moved = np.bincount(primary, minlength=self.regions)
+        self.counts[old] -= moved
+        self.counts[new] += moved
+        num_advantaged = int(np.count_nonzero(advantaged))
+        self.advantaged[old] -= num_advantaged
+        self.advantaged[new] += num_advantaged
+        if new == SELECTED:
+            self.transplant_wait += np.bincount(primary, weights=waiting, minlength=self.regions).astype(np.int64)
+            self.advantaged_transplant_wait += int(waiting[advantaged].sum())
+
+    def total(self, condition):
+        """
+        Return the number of patients in the given condition.
+        """
+        return int(self.counts[condition].sum())
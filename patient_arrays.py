@@ -0,0 +1,317 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Array-backed (struct-of-arrays) patient storage for the waiting list model.  """
+
+from array import array
+
+
+import numpy as np
+
+# Integer codes for the patient conditions, indexed in the same order as CONDITIONS
+WAITING, SELECTED, TRANSPLANTED, DECEASED = range(4)
+CONDITIONS = ("Waiting", "Selected", "Transplanted", "Deceased")
+
+# A patient is listed in their primary region plus at most three secondary regions
+MAX_LISTINGS = 4
+
+
+class PatientArrays:
+    """
+    Struct-of-arrays storage for all of the patients in a model.  Patient i is described by
+    the i-th entry of each array, and patients are never removed, so an index is a stable
+    patient identifier.
+
+    Attributes:
+        size: number of patients stored
+        waiting: amount of time spent waiting on the list
+        lifespan: lifespan of the patient before selection
+        condition: condition code (WAITING, SELECTED, TRANSPLANTED or DECEASED)
+        primary: primary listing region of the patient
+        listings: all listing regions of the patient, padded with -1
+    """
+    # Per-patient arrays, grown together by _reserve (besides listings)
+    FIELDS = ("waiting", "lifespan", "condition", "primary")
+
+    def __init__(self, capacity=1024, active_set=False, kernels=False):
+        """
+        Create empty storage with room for capacity patients
+
+        args:
+        capacity: initial number of patients the arrays can hold
+        active_set: only age the patients that are still waiting or selected, instead of every
+            patient that has ever been added
+        kernels: age the patients with the compiled loops of kernels.py
+        """
+        self.size = 0
+        self.kernels = kernels
+        if kernels:
+            # Imported here so Numba is only loaded when the kernels are used
+            from kernels import age_all, age_active
+            self.age_all = age_all
+            self.age_active = age_active
+        self.active = np.zeros(0, dtype=np.int64) if active_set else None
+        self.active_end = 0
+        self.waiting = np.zeros(capacity, dtype=np.int64)
+        self.lifespan = np.zeros(capacity, dtype=np.float64)
+        self.condition = np.zeros(capacity, dtype=np.int8)
+        self.primary = np.zeros(capacity, dtype=np.int64)
+        self.listings = np.full((capacity, MAX_LISTINGS), -1, dtype=np.int64)
+
+    def _reserve(self, needed):
+        """
+        Grow the arrays (by doubling) until they can hold needed patients.
+        """
+        capacity = len(self.waiting)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        listings = np.full((capacity, MAX_LISTINGS), -1, dtype=np.int64)
+        listings[:self.size] = self.listings[:self.size]
+        self.listings = listings
+
+    def add_many(self, listings, lifespan, waiting):
+        """
+        Add a batch of waiting patients and return the index of the first one.
+
+        args:
+        listings: listing regions of each patient (rows padded with -1), the primary region first
+        lifespan: lifespan of each patient
+        waiting: time each patient has already spent waiting
+        """
+        first = self.size
+        last = first + len(listings)
+        self._reserve(last)
+        self.waiting[first:last] = waiting
+        self.lifespan[first:last] = lifespan
+        self.condition[first:last] = WAITING
+        self.primary[first:last] = listings[:, 0]
+        self.listings[first:last] = listings
+        self.size = last
+        return first
+
+    def advantaged(self, index=None):
+        """
+        Return whether the patients are listed in more than one region, for the patients at the
+        given index (an integer or an array of indices) or for all patients.
+        """
+        if index is None:
+            return self.listings[:self.size, 1] >= 0
+        return self.listings[index, 1] >= 0
+
+    def is_waiting(self, index):
+        """
+        Return whether the patient at the given index is waiting.
+        """
+        return self.condition[index] == WAITING
+
+    def select(self, index):
+        """
+        Mark the patient at the given index as selected for a transplant, and return the time
+        they spent waiting.
+        """
+        self.condition[index] = SELECTED
+        return int(self.waiting[index])
+
+    def current_waiting(self):
+        """
+        Return the time spent waiting by every patient.
+        """
+        return self.waiting[:self.size]
+
+    def stored(self):
+        """
+        Return the number of patients visited when the patients are aged.
+        """
+        if self.active is None:
+            return self.size
+        return len(self.active) + self.size - self.active_end
+
+    def age(self):
+        """
+        Vectorized equivalent of Patient.step for every patient:
+        Age the waiting patients by one time step.
+        Selected patients become transplanted.
+        Waiting patients with waiting >= lifespan become deceased.
+
+        Returns the indices of the patients that were transplanted and that died in this step.
+        """
+        if self.kernels:
+            if self.active is None:
+                return self.age_all(self.condition, self.waiting, self.lifespan, self.size)
+            active = np.concatenate([self.active, np.arange(self.active_end, self.size)])
+            transplanted, deceased, self.active = self.age_active(active, self.condition, self.waiting,
+                                                                  self.lifespan)
+            self.active_end = self.size
+            return transplanted, deceased
+
+        if self.active is None:
+            condition = self.condition[:self.size]
+            waiting = self.waiting[:self.size]
+            is_waiting = condition == WAITING
+            transplanted = np.flatnonzero(condition == SELECTED)
+            waiting[is_waiting] += 1
+            deceased = np.flatnonzero(is_waiting & (waiting >= self.lifespan[:self.size]))
+            condition[transplanted] = TRANSPLANTED
+            condition[deceased] = DECEASED
+            return transplanted, deceased
+
+        # Only visit the active patients and the ones added since the last step
+        active = np.concatenate([self.active, np.arange(self.active_end, self.size)])
+        condition = self.condition[active]
+        waiting_index = active[condition == WAITING]
+        transplanted = active[condition == SELECTED]
+        self.waiting[waiting_index] += 1
+        deceased = waiting_index[self.waiting[waiting_index] >= self.lifespan[waiting_index]]
+        self.condition[transplanted] = TRANSPLANTED
+        self.condition[deceased] = DECEASED
+
+        # Retire the patients that reached a terminal condition
+        self.active = active[self.condition[active] <= SELECTED]
+        self.active_end = self.size
+        return transplanted, deceased
+
+
+class PatientEvents(PatientArrays):
+    """
+    Patient storage for the event-driven engine.  Nothing is done for a waiting patient from
+    month to month: their waiting time is computed from the month they entered the model, and
+    the month they will die if they are still waiting then is computed when they are added and
+    kept in a calendar of deaths.  Each step only handles the patients selected in the previous
+    step and the deaths due in this step.
+
+    Attributes (besides those of PatientArrays):
+        clock: number of months the patients have been aged (steps taken)
+        waiting: time spent waiting when the patient entered, for waiting patients, and the final
+            waiting time for the others
+        entry: value of clock when the patient entered the model
+        death: value of clock at which the patient dies if they are still waiting
+        deaths: calendar of the deaths, mapping a value of clock to the list of arrays of the
+            patients dying then; patients that are no longer waiting are skipped when it comes up
+        selected: indices of the patients selected since the last step
+    """
+    FIELDS = PatientArrays.FIELDS + ("entry", "death")
+
+    def __init__(self, capacity=1024):
+        """
+        Create empty storage with room for capacity patients
+        """
+        PatientArrays.__init__(self, capacity)
+        self.clock = 0
+        self.entry = np.zeros(capacity, dtype=np.int64)
+        self.death = np.zeros(capacity, dtype=np.int64)
+        self.deaths = {}
+        self.selected = []
+
+    @staticmethod
+    def months_to_death(lifespan, waiting):
+        """
+        Return the number of steps until patients with the given lifespans and waiting times die,
+        if they are still waiting: the smallest k >= 1 with waiting + k >= lifespan, compared the
+        way the monthly engines compare them (as floats).
+        """
+        months = np.maximum(np.ceil(lifespan - waiting), 1).astype(np.int64)
+        # Correct the rounding of lifespan - waiting
+        months[(months > 1) & (waiting + months - 1 >= lifespan)] -= 1
+        months[waiting + months < lifespan] += 1
+        return months
+
+    def add_many(self, listings, lifespan, waiting):
+        """
+        Add a batch of waiting patients, schedule their deaths, and return the index of the first one.
+        """
+        first = PatientArrays.add_many(self, listings, lifespan, waiting)
+        last = self.size
+        death = self.clock + self.months_to_death(lifespan, waiting)
+        self.entry[first:last] = self.clock
+        self.death[first:last] = death
+
+        # File the patients in the calendar under their month of death
+        order = np.argsort(death, kind='stable')
+        months, starts = np.unique(death[order], return_index=True)
+        for month, patients in zip(months.tolist(), np.split(order + first, starts[1:])):
+            self.deaths.setdefault(month, []).append(patients)
+        return first
+
+    def select(self, index):
+        """
+        Mark the patient at the given index as selected, fixing their waiting time, which is returned.
+        """
+        self.waiting[index] += self.clock - self.entry[index]
+        self.condition[index] = SELECTED
+        self.selected.append(index)
+        return int(self.waiting[index])
+
+    def current_waiting(self):
+        """
+        Return the time spent waiting by every patient.
+        """
+        waiting = self.waiting[:self.size].copy()
+        is_waiting = self.condition[:self.size] == WAITING
+        waiting[is_waiting] += self.clock - self.entry[:self.size][is_waiting]
+        return waiting
+
+    def stored(self):
+        """
+        Return the number of patients in the calendar of deaths.
+        """
+        return sum(len(patients) for month in self.deaths.values() for patients in month)
+
+    def age(self):
+        """
+        Event-driven equivalent of PatientArrays.age: the patients selected since the last step
+        become transplanted, and the waiting patients whose death is due in this step become
+        deceased.  Returns the indices of the patients that were transplanted and that died.
+        """
+        self.clock += 1
+        transplanted = np.array(self.selected, dtype=np.int64)
+        self.condition[transplanted] = TRANSPLANTED
+        self.selected = []
+
+        due = self.deaths.pop(self.clock, [])
+        deceased = np.concatenate(due) if due else np.zeros(0, dtype=np.int64)
+        deceased = deceased[self.condition[deceased] == WAITING]
+        self.waiting[deceased] += self.clock - self.entry[deceased]
+        self.condition[deceased] = DECEASED
+        return transplanted, deceased
+
+
+class PatientArchive:
+    """
+    Compact archive of the patients that have left the active schedule (transplanted or
+    deceased).  Only the fields needed by the model reporters are kept, in typed arrays.
+    """
+    def __init__(self):
+        """
+        Create an empty archive
+        """
+        self.condition = array('b')
+        self.primary = array('q')
+        self.waiting = array('q')
+        self.advantaged = array('b')
+        self.counts = [0] * len(CONDITIONS)  # Number of archived patients in each condition
+
+    def __len__(self):
+        return len(self.condition)
+
+    def add(self, condition, primary, waiting, advantaged):
+        """
+        Archive a single patient.
+        """
+        self.condition.append(condition)
+        self.primary.append(primary)
+        self.waiting.append(waiting)
+        self.advantaged.append(advantaged)
+        self.counts[condition] += 1
+
+    def as_arrays(self):
+        """
+        Return the condition, primary, waiting and advantaged fields as NumPy arrays.
+        """
+        return (np.array(self.condition, dtype=np.int8), np.array(self.primary, dtype=np.int64),
+                np.array(self.waiting, dtype=np.int64), np.array(self.advantaged, dtype=bool))
@@ -2,95 +2,107 @@
 
 '''Model to simulate the waiting list and multiple registrations in the organ transplant system.  '''
 
-import numpy.random as npr
-import numpy as np
-import pandas as pd
+from patient_arrays import CONDITIONS, WAITING, SELECTED, TRANSPLANTED, DECEASED
 
-import matplotlib.pyplot as plt
-
-from mesa import Model, Agent
-from mesa.time import RandomActivation
-from mesa.space import Grid
-from mesa.datacollection import DataCollector
-from mesa.batchrunner import BatchRunner 
-
-class Patient(Agent):
+class Patient:
     '''
-    A patient in the simulation.
-    
+    A patient in the simulation.  Patients are scheduled by the Mesa scheduler, which only
+    needs a unique_id and a step method, so they do not subclass Agent and keep their fields
+    in __slots__ instead of a per-instance __dict__.
+
     Attributes:
-        condition: Waiting or Selected or Transplanted or Deceased
-        regions: regions where the patient is waiting
-        my_id: Integer identifier, represents order the agent is added to the model
+        unique_id: Integer identifier, represents order the agent is added to the model
+        model: the WaitingList the patient belongs to
+        condition: condition code, WAITING, SELECTED, TRANSPLANTED or DECEASED
+        regions: tuple of the regions where the patient is waiting
         primary: Primary listing region of the agent
         lifespan: Lifespan of the agent before selection
         waiting: amount of time spent waiting on the list
         advantaged: whether or not the patient is advantaged
-        
+
     '''
+    __slots__ = ("unique_id", "model", "condition", "regions", "primary", "lifespan", "waiting", "advantaged")
+
     def __init__(self, unique_id, model, regions, lifespan, waiting=0):
         '''
         Create a new agent
-        Args: 
+        Args:
         '''
-        super().__init__(unique_id, model)
-        self.my_id = str(unique_id)
-        self.regions = regions
+        self.unique_id = unique_id
+        self.model = model
+        self.regions = tuple(regions)
         self.primary = self.regions[0]
-        self.condition = "Waiting"
-        self.lifespan = lifespan
+        self.condition = WAITING
+        self.lifespan = float(lifespan)
         self.waiting = waiting
-        if len(regions) > 1:
-            self.advantaged = True
-        else:
-            self.advantaged = False
-        
+        self.advantaged = len(regions) > 1
+
     def selected(self):
         '''
         Set the patient's condition to "Selected"
         '''
-        self.condition = "Selected"
-        
+        self.condition = SELECTED
+        self.model.outcomes.transition(WAITING, SELECTED, self.primary, self.advantaged, self.waiting)
+        self.model.leave_queues(self.regions, self)
+
     def get_advantaged(self):
         '''
         Check if patient is advantaged
         '''
         return self.advantaged
-    
+
     def get_waiting(self):
         '''
         Get the patient's waiting years
         '''
         return self.waiting
-        
+
     def get_primary(self):
         '''
         Return the patient's primary listing
         '''
         return self.primary
-            
+
+    def is_waiting(self):
+        '''
+        Check if the patient is still waiting
+        '''
+        return self.condition == WAITING
+
     def get_condition(self):
         '''
-        Return the patient's condition
+        Return the patient's condition, as a string ("Waiting", "Selected", "Transplanted" or "Deceased")
         '''
-        return self.condition
-        
+        return CONDITIONS[self.condition]
+
     def step(self):
         '''
         If a patient is at the top of the list, they will receive a transplant
         Age the patient by one time step.
         If the patient has been selected, change their condition to transplanted
         Else: if the patient is waiting and waiting >= lifespan, change condition to Deceased
+        Transplanted or deceased patients are retired from the schedule in active set mode.
         '''
         # Increment the patient's waiting
-        if self.condition == "Waiting":
+        if self.condition == WAITING:
             self.waiting += 1
         # Convert person to transplant
-        if self.condition == "Selected":
-            self.condition = "Transplanted"
+        if self.condition == SELECTED:
+            self.condition = TRANSPLANTED
+            self.model.outcomes.transition(SELECTED, TRANSPLANTED, self.primary, self.advantaged)
         # Convert person to deceased
-        elif self.condition == "Waiting" and self.waiting >= self.lifespan:
-            self.condition = "Deceased"
-        
+        elif self.condition == WAITING and self.waiting >= self.lifespan:
+            self.condition = DECEASED
+            self.model.outcomes.transition(WAITING, DECEASED, self.primary, self.advantaged)
+            self.model.leave_queues(self.regions, self)
+        else:
+            return
+        if self.model.event_log is not None:
+            self.model.event_log.append(self.unique_id, self.model.ticks, self.primary, self.condition,
+                                        self.advantaged)
+        # Move the patient out of the schedule once they reach a final condition
+        if self.model.active_set:
+            self.model.retire(self)
+
     def __str__(self):
-        return str(self.my_id)
\ No newline at end of file
+        return str(self.unique_id)
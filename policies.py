@@ -0,0 +1,195 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Allocation policies deciding which waiting patient of a region is selected next, and the
+indexed heaps the policies order each region's waiting list with.  """
+
+import heapq
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class AllocationPolicy(ABC):
+    """
+    Order in which the waiting patients of a region are selected.  Every patient gets a priority
+    when they join the lists, and the patient with the lowest priority is selected first, ties
+    going to the patient who arrived first.  The priorities do not change while patients wait:
+    every waiting patient ages by one month each step, so orders based on the waiting time or the
+    time left to live can be expressed relative to the month the patient joined.
+
+    Attributes:
+        name: name of the policy, as given to WaitingList
+    """
+    name = None
+
+    @abstractmethod
+    def priority(self, tick, waiting, lifespan):
+        """
+        Return the priority of each patient of a batch joining the lists.
+
+        args:
+        tick: month the patients join the lists
+        waiting: array of the time each patient has already spent waiting
+        lifespan: array of the lifespan of each patient
+        """
+
+
+class FifoPolicy(AllocationPolicy):
+    """
+    Patients are selected in the order they joined the lists, as with the RegionQueue.
+    """
+    name = "fifo"
+
+    def priority(self, tick, waiting, lifespan):
+        return np.zeros(len(waiting))
+
+
+class LongestWaitPolicy(AllocationPolicy):
+    """
+    The patient who has waited longest is selected first, counting the time waited before the
+    start of the simulation.  The accrued wait of a patient at month t is waiting + t - tick.
+    """
+    name = "longest_wait"
+
+    def priority(self, tick, waiting, lifespan):
+        return tick - np.asarray(waiting, dtype=np.float64)
+
+
+class ShortestLifespanPolicy(AllocationPolicy):
+    """
+    The patient with the least time left to live is selected first.  The remaining lifespan of a
+    patient at month t is lifespan - waiting - (t - tick).
+    """
+    name = "shortest_lifespan"
+
+    def priority(self, tick, waiting, lifespan):
+        return np.asarray(lifespan, dtype=np.float64) - waiting + tick
+
+
+# Policies by name
+POLICIES = {policy.name: policy for policy in (FifoPolicy, LongestWaitPolicy, ShortestLifespanPolicy)}
+
+
+def get_policy(name):
+    """
+    Return an instance of the allocation policy with the given name.
+    """
+    if name not in POLICIES:
+        raise ValueError("Unknown allocation policy: %s" % name)
+    return POLICIES[name]()
+
+
+class IndexedHeap:
+    """
+    Binary min-heap (heapq) of items ordered by (priority, order), with an index of the entry
+    of every item.  Push and pop are O(log n).  Removing an item from anywhere in the heap marks
+    its entry through the index in O(1); marked entries are dropped when they reach the top,
+    and the heap is rebuilt without them once they outnumber the items still in it.
+
+    Attributes:
+        heap: heap of [priority, order, item] entries, removed items replaced by REMOVED
+        index: entry of each item in the heap
+        stale: number of removed entries still in the heap
+    """
+    # Marks the entry of a removed item
+    REMOVED = None
+
+    # Do not bother rebuilding heaps with fewer removed entries than this
+    MIN_COMPACT = 256
+
+    def __init__(self):
+        """
+        Create an empty heap
+        """
+        self.heap = []
+        self.index = {}
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def push(self, item, priority, order):
+        """
+        Add an item (which must not be in the heap).  Items with a lower priority come out first,
+        ties by the lowest order, which must be unique.
+        """
+        entry = [priority, order, item]
+        self.index[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    def pop(self):
+        """
+        Remove and return the item with the lowest priority, None if the heap is empty.
+        """
+        heap = self.heap
+        while heap:
+            item = heapq.heappop(heap)[2]
+            if item is not self.REMOVED:
+                del self.index[item]
+                return item
+            self.stale -= 1
+        return None
+
+    def remove(self, item):
+        """
+        Remove an item from the heap.  Returns False if it was not in the heap.
+        """
+        entry = self.index.pop(item, None)
+        if entry is None:
+            return False
+        entry[2] = self.REMOVED
+        self.stale += 1
+        return True
+
+    def compact(self):
+        """
+        Rebuild the heap without the removed entries once they outnumber the items in it.
+        """
+        if self.stale > self.MIN_COMPACT and self.stale > len(self.index):
+            self.heap = [entry for entry in self.heap if entry[2] is not self.REMOVED]
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+
+class RegionHeap(IndexedHeap):
+    """
+    Waiting list for one region ordered by an allocation policy, used by WaitingList in place of
+    the RegionQueue.  Patients that stop waiting are removed from the heap of every region they
+    are listed in (WaitingList.leave_queues), so only waiting patients come out of the heap.
+    Patients are ordered by their priority, then by their number: patients are numbered in
+    arrival order.
+    """
+    def extend(self, items, priorities, ids=None):
+        """
+        Add waiting patients with the given priorities.  ids are the patient numbers, the items
+        themselves (patient indices) by default.
+        """
+        for item, priority, patient_id in zip(items, priorities, items if ids is None else ids):
+            self.push(item, priority, patient_id)
+
+    def entries(self):
+        """
+        Return the number of entries held, including removed patients not yet dropped.
+        """
+        return len(self.heap)
+
+    def __iter__(self):
+        """
+        Iterate over the waiting patients in the order they would be selected.
+        """
+        for entry in sorted(self.index.values()):
+            yield entry[2]
+
+    def discard(self, count=1):
+        """
+        Nothing to do, patients that stop waiting are removed from the heap with remove.
+        """
+
+    def pop_waiting(self):
+        """
+        Take the next patient to select off the heap, None if nobody is waiting.
+        """
+        return self.pop()
@@ -0,0 +1,116 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Optional per-phase timing and resource use of a WaitingList run.  """
+
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Units of ru_maxrss per MB: it is in bytes on macOS and in kilobytes on Linux and the BSDs
+MAXRSS_PER_MB = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+
+# Phases of a run that are timed, in the order they happen
+PHASES = ("init", "aging", "collect", "allocation", "candidates", "checkpoint", "reporters")
+
+# Extra result columns written when a run is profiled
+PROFILE_COLUMNS = ["Time_" + phase.capitalize() for phase in PHASES] + \
+                  ["Peak_Patients", "Peak_Queue_Entries", "Peak_RSS_MB"]
+
+
+class StepProfile:
+    """
+    Cumulative wall time and call count of each phase of a run, with the number of patients
+    and queue entries held by the model after every tick.  A model only builds a profile when
+    it is created with profile=True, otherwise none of this is measured.
+
+    Attributes:
+        seconds: cumulative wall time of each phase
+        calls: number of times each phase ran
+        patients: number of patients stored in the schedule (or visited by the array engine's
+            aging) after each tick
+        alive: number of patients waiting or selected after each tick
+        queue_entries: number of entries held by the region queues after each tick, including the
+            entries of patients that stopped waiting and were not removed yet
+        rss_reset: whether the peak resident memory of the process was reset when the profile was
+            created, so peak_rss measures this run rather than everything the process ran before
+    """
+    def __init__(self):
+        """
+        Create an empty profile
+        """
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.patients = []
+        self.alive = []
+        self.queue_entries = []
+        self.rss_reset = self.reset_peak_rss()
+
+    def lap(self, phase, start):
+        """
+        Add the time since start (a time.perf_counter value) to a phase, and return the current
+        time so it can start the next phase.
+        """
+        now = time.perf_counter()
+        self.seconds[phase] += now - start
+        self.calls[phase] += 1
+        return now
+
+    def record_tick(self, patients, alive, queue_entries):
+        """
+        Record the number of patients and queue entries held by the model after a tick.
+        """
+        self.patients.append(patients)
+        self.alive.append(alive)
+        self.queue_entries.append(queue_entries)
+
+    @staticmethod
+    def reset_peak_rss():
+        """
+        Reset the peak resident memory of this process to its current resident memory.  Only
+        possible on Linux, through /proc/self/clear_refs.  Returns whether it was reset.
+        """
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+    def peak_rss(self):
+        """
+        Return the peak resident memory of this process in MB, or None if it is not available.
+        On Linux this is the peak since the profile was created, which includes the memory the
+        process already held then.  Elsewhere it is the peak since the process started, so in a
+        worker running several models it covers all the runs so far.
+        """
+        if self.rss_reset:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024.0
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / MAXRSS_PER_MB
+
+    def as_dict(self):
+        """
+        Return the profile as a dictionary of plain Python values.
+        """
+        return {"seconds": dict(self.seconds),
+                "calls": dict(self.calls),
+                "patients": list(self.patients),
+                "alive": list(self.alive),
+                "queue_entries": list(self.queue_entries),
+                "peak_rss_mb": self.peak_rss()}
+
+    def columns(self):
+        """
+        Return the summary of the profile as the values of PROFILE_COLUMNS.
+        """
+        values = [self.seconds[phase] for phase in PHASES]
+        values += [max(self.patients, default=0), max(self.queue_entries, default=0), self.peak_rss()]
+        return dict(zip(PROFILE_COLUMNS, values))
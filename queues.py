@@ -0,0 +1,176 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""FIFO waiting list queue for a single region of the model.  """
+
+import numpy as np
+
+
+class RegionQueue:
+    """
+    Waiting list for one region.  Patients are appended at the back and taken from the front
+    through a head cursor, so taking a patient is O(1).  Patients that stop waiting (selected
+    in another region or deceased) stay in the list and are skipped lazily when the cursor
+    reaches them; the list is compacted once the skipped entries dominate it.
+
+    Attributes:
+        items: stored patients, only the entries from head onwards are still queued
+        head: position of the first patient that has not been taken from the queue
+        live: number of queued patients that are still waiting
+        is_waiting: function telling whether a stored patient is still waiting
+    """
+    # Do not bother compacting queues with fewer stale entries than this
+    MIN_COMPACT = 256
+
+    def __init__(self, is_waiting):
+        """
+        Create an empty queue
+
+        args:
+        is_waiting: function called with a stored patient, returning True if they are still waiting
+        """
+        self.items = []
+        self.head = 0
+        self.live = 0
+        self.is_waiting = is_waiting
+
+    def __len__(self):
+        """
+        Return the number of patients in the queue that are still waiting.
+        """
+        return self.live
+
+    def __iter__(self):
+        """
+        Iterate over the queued patients that are still waiting, front first.
+        """
+        for item in self.items[self.head:]:
+            if self.is_waiting(item):
+                yield item
+
+    def entries(self):
+        """
+        Return the number of entries held from the head on, including patients no longer waiting.
+        """
+        return len(self.items) - self.head
+
+    def append(self, item):
+        """
+        Add a waiting patient to the back of the queue.
+        """
+        self.items.append(item)
+        self.live += 1
+
+    def extend(self, items):
+        """
+        Add waiting patients to the back of the queue, in order.
+        """
+        self.items.extend(items)
+        self.live += len(items)
+
+    def discard(self, count=1):
+        """
+        Record that count queued patients stopped waiting (they are removed lazily).
+        """
+        self.live -= count
+
+    def pop_waiting(self):
+        """
+        Take the first waiting patient off the front of the queue, skipping the patients that
+        are no longer waiting.  Returns None if nobody in the queue is waiting.
+        """
+        items = self.items
+        while self.head < len(items):
+            item = items[self.head]
+            self.head += 1
+            if self.is_waiting(item):
+                return item
+        return None
+
+    def compact(self):
+        """
+        Drop the taken and no longer waiting entries once they outnumber the waiting patients.
+        """
+        stale = len(self.items) - self.live
+        if stale > self.MIN_COMPACT and stale > self.live:
+            self.items = [item for item in self.items[self.head:] if self.is_waiting(item)]
+            self.head = 0
+
+
+class ArrayQueue(RegionQueue):
+    """
+    RegionQueue holding patient indices in a NumPy buffer, so the compiled allocation kernel
+    (kernels.select_patients) can walk it.  The number of waiting patients of every region's
+    queue is kept in an array shared by the queues, which the kernel updates directly.
+
+    Attributes (besides those of RegionQueue):
+        region: region of the queue, its entry in lives
+        lives: number of waiting patients in the queue of each region
+        end: number of entries used in items
+    """
+    def __init__(self, is_waiting, region, lives, capacity=256):
+        """
+        Create an empty queue
+
+        args:
+        is_waiting: function called with a patient index, returning True if they are still waiting
+        region: region of the queue
+        lives: array of the number of waiting patients in the queue of each region
+        capacity: initial number of entries the buffer can hold
+        """
+        self.region = region
+        self.lives = lives
+        RegionQueue.__init__(self, is_waiting)
+        self.items = np.zeros(capacity, dtype=np.int64)
+        self.end = 0
+
+    @property
+    def live(self):
+        return int(self.lives[self.region])
+
+    @live.setter
+    def live(self, value):
+        self.lives[self.region] = value
+
+    def __iter__(self):
+        for item in self.items[self.head:self.end]:
+            if self.is_waiting(item):
+                yield item
+
+    def entries(self):
+        return self.end - self.head
+
+    def append(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        """
+        Add waiting patients to the back of the queue, in order, growing the buffer if needed.
+        """
+        needed = self.end + len(items)
+        if needed > len(self.items):
+            items_buffer = np.zeros(max(needed, 2 * len(self.items)), dtype=np.int64)
+            items_buffer[:self.end] = self.items[:self.end]
+            self.items = items_buffer
+        self.items[self.end:needed] = items
+        self.end = needed
+        self.live += len(items)
+
+    def pop_waiting(self):
+        while self.head < self.end:
+            item = self.items[self.head]
+            self.head += 1
+            if self.is_waiting(item):
+                return item
+        return None
+
+    def compact(self):
+        """
+        Drop the taken and no longer waiting entries once they outnumber the waiting patients.
+        """
+        stale = self.end - self.live
+        if stale > self.MIN_COMPACT and stale > self.live:
+            items = self.items[self.head:self.end]
+            items = items[self.is_waiting(items)]
+            self.items[:len(items)] = items
+            self.head = 0
+            self.end = len(items)
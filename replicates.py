@@ -0,0 +1,462 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Simulation of several replicates (seeds) of one scenario in a single pass over arrays.
+Every per-DSA quantity has a leading replicate axis, and each month the transplant and arrival
+draws, the allocation, the arrivals and the aging are array operations over all the replicates
+at once, so the Python overhead of a month is paid once for the whole batch.  Run with:
+python3 replicates.py output_file --dsas ALL --years 20 --seeds 0 100 200 300 400 --advantage-prob 0.3"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from candidates import draw_candidates, smart_listing_scores
+from data_import import get_dsa_parameters, get_all_dsas
+from patient_arrays import PatientArrays, CONDITIONS, WAITING, SELECTED, TRANSPLANTED, DECEASED
+from results_io import save_results
+from waitinglist import WaitingList
+
+# WaitingList features a batch does not have, they must be off in its parameters
+UNSUPPORTED = ("checkpoint_path", "checkpoint_every", "time_series_path", "record_interval", "event_log_path",
+               "steady_state", "profile", "allocation_policy", "kernels")
+
+# WaitingList parameters that do not change how a batch runs: it always keeps its patients in
+# arrays with an active set and draws its candidates as batches, and never prints a summary
+IGNORED = ("seed", "engine", "active_set", "batched_draws", "output")
+
+
+class ReplicateCounters:
+    """
+    OutcomeCounters of a batch of replicates, with a leading replicate axis.  Patients are known
+    by their batch region, region i of replicate r being batch region r x regions + i.
+
+    Attributes:
+        replicates: number of replicates
+        regions: number of regions of each replicate
+        counts: number of patients in each condition, by replicate and primary region
+            (conditions x replicates x regions)
+        advantaged: number of advantaged patients in each condition, by replicate (replicates x conditions)
+        transplant_wait: total waiting time of the selected and transplanted patients, by replicate
+            and primary region
+        advantaged_transplant_wait: total waiting time of the selected and transplanted advantaged
+            patients, by replicate
+    """
+    def __init__(self, replicates, regions):
+        self.replicates = replicates
+        self.regions = regions
+        self.counts = np.zeros((len(CONDITIONS), replicates, regions), dtype=np.int64)
+        self.advantaged = np.zeros((replicates, len(CONDITIONS)), dtype=np.int64)
+        self.transplant_wait = np.zeros((replicates, regions), dtype=np.int64)
+        self.advantaged_transplant_wait = np.zeros(replicates, dtype=np.int64)
+
+    def by_region(self, primary, weights=None):
+        """
+        Return the number (or the sum of the weights) of the patients with the given batch regions,
+        by replicate and region.
+        """
+        return np.bincount(primary, weights=weights, minlength=self.replicates * self.regions).reshape(
+            self.replicates, self.regions)
+
+    def add_many(self, condition, primary, advantaged):
+        """
+        Count new patients in the given condition, from arrays of batch regions and advantaged flags.
+        """
+        self.counts[condition] += self.by_region(primary)
+        self.advantaged[:, condition] += np.bincount(primary[advantaged] // self.regions,
+                                                     minlength=self.replicates)
+
+    def transition_many(self, old, new, primary, advantaged, waiting=None):
+        """
+        Move patients, given by arrays of batch regions and advantaged flags, from the old to the
+        new condition.  The waiting times are only needed when new is SELECTED.
+        """
+        moved = self.by_region(primary)
+        self.counts[old] -= moved
+        self.counts[new] += moved
+        moved_advantaged = np.bincount(primary[advantaged] // self.regions, minlength=self.replicates)
+        self.advantaged[:, old] -= moved_advantaged
+        self.advantaged[:, new] += moved_advantaged
+        if new == SELECTED:
+            self.transplant_wait += self.by_region(primary, waiting).astype(np.int64)
+            self.advantaged_transplant_wait += np.bincount(primary[advantaged] // self.regions,
+                                                           weights=waiting[advantaged],
+                                                           minlength=self.replicates).astype(np.int64)
+
+    def replicate(self, r):
+        """
+        Return the counters of replicate r as plain OutcomeCounters-like views.
+        """
+        outcomes = ReplicateCounters.__new__(ReplicateCounters)
+        outcomes.replicates = 1
+        outcomes.regions = self.regions
+        outcomes.counts = self.counts[:, r]
+        outcomes.advantaged = self.advantaged[r]
+        outcomes.transplant_wait = self.transplant_wait[r]
+        outcomes.advantaged_transplant_wait = int(self.advantaged_transplant_wait[r])
+        return outcomes
+
+    def total(self, condition):
+        """
+        Return the number of patients in the given condition, over all the regions of the counters.
+        """
+        return int(self.counts[condition].sum())
+
+
+class ListingQueues:
+    """
+    The waiting lists of every batch region, in one array.  Each region has a segment of the
+    array, patients[starts[g]:starts[g + 1]], which holds its entries from heads[g] to ends[g], in
+    the order the patients joined the list, followed by room for new entries.  Patients that stop
+    waiting stay in the lists and are skipped when the allocation reaches them.  New patients are
+    written into the room left at the end of their lists; once a list has no room left, all the
+    lists are rebuilt without the entries taken or no longer waiting, each with as much room again
+    as it has entries.
+
+    Attributes:
+        regions: number of batch regions
+        patients: patient index of every entry, grouped by region
+        starts: position of the segment of each region, followed by the size of the array
+        heads: position of the first entry of each region that has not been taken
+        ends: position after the last entry of each region
+    """
+    # Room left at the end of every list when the lists are rebuilt, besides as many entries as it holds
+    MIN_ROOM = 16
+
+    def __init__(self, regions):
+        self.regions = regions
+        self.patients = np.zeros(0, dtype=np.int64)
+        self.starts = np.zeros(regions + 1, dtype=np.int64)
+        self.heads = np.zeros(regions, dtype=np.int64)
+        self.ends = np.zeros(regions, dtype=np.int64)
+
+    def entries(self):
+        """
+        Return the number of entries held, including patients no longer waiting.
+        """
+        return int((self.ends - self.heads).sum())
+
+    def rebuild(self, condition, added):
+        """
+        Rebuild the lists with only the entries of waiting patients, leaving room for added[g] new
+        entries and as many again as the list holds then at the end of each list.
+        """
+        lengths = self.ends - self.heads
+        region = np.repeat(np.arange(self.regions), lengths)
+        position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+            np.repeat(self.heads, lengths)
+        patients = self.patients[position]
+        kept = condition[patients] == WAITING
+        patients, region = patients[kept], region[kept]
+
+        lengths = np.bincount(region, minlength=self.regions)
+        self.starts[1:] = np.cumsum(2 * (lengths + added) + self.MIN_ROOM)
+        self.heads = self.starts[:-1].copy()
+        self.ends = self.heads + lengths
+        self.patients = np.empty(self.starts[-1], dtype=np.int64)
+        self.patients[np.arange(len(region)) - (np.cumsum(lengths) - lengths)[region] + self.heads[region]] = patients
+
+    def extend(self, listings, first, condition):
+        """
+        Add new patients to the back of the lists they are listed in.
+
+        args:
+        listings: batch regions of each new patient, padded with -1
+        first: index of the first new patient, the others follow in order
+        condition: condition of every patient
+        """
+        rows, columns = np.nonzero(listings >= 0)
+        region = listings[rows, columns]
+        order = np.argsort(region, kind='stable')
+        patients, region = rows[order] + first, region[order]
+        added = np.bincount(region, minlength=self.regions)
+        if (self.ends + added > self.starts[1:]).any():
+            self.rebuild(condition, added)
+
+        # Each list's new entries follow its old ones, in arrival order (patients are numbered in
+        # arrival order)
+        self.patients[np.arange(len(region)) - (np.cumsum(added) - added)[region] + self.ends[region]] = patients
+        self.ends += added
+
+    def take(self, regions, counts, condition):
+        """
+        Take up to counts[k] waiting patients off the front of the list of each batch region
+        regions[k], skipping the patients that are no longer waiting.  The regions must be distinct.
+        Returns the patients taken, and the region that took each of them.
+
+        The front of each list is read in windows a little larger than the number of patients
+        still wanted; a list whose window held too few waiting patients reads another one.
+        """
+        taken = []
+        taken_regions = []
+        wanted = np.asarray(counts, dtype=np.int64)
+        while True:
+            heads = self.heads[regions]
+            ends = self.ends[regions]
+            left = (wanted > 0) & (heads < ends)
+            if not left.any():
+                break
+            regions, wanted, heads, ends = regions[left], wanted[left], heads[left], ends[left]
+
+            # Windows of the lists' fronts, one after another
+            width = np.minimum(2 * wanted + 8, ends - heads)
+            window = np.repeat(np.arange(len(regions)), width)
+            offsets = np.cumsum(width) - width
+            position = np.arange(width.sum()) - offsets[window] + heads[window]
+            patients = self.patients[position]
+            waiting = condition[patients] == WAITING
+
+            # The first wanted waiting patients of each window are taken
+            waiting_before = np.cumsum(waiting) - waiting
+            rank = waiting_before - waiting_before[offsets][window]
+            chosen = np.flatnonzero(waiting & (rank < wanted[window]))
+            taken.append(patients[chosen])
+            taken_regions.append(regions[window[chosen]])
+            got = np.bincount(window[chosen], minlength=len(regions))
+
+            # Lists that got what they wanted move past their last patient taken, the others past
+            # their window
+            heads = heads + width
+            done = np.flatnonzero(got == wanted)
+            last = np.searchsorted(window[chosen], done, side='right') - 1
+            heads[done] = position[chosen[last]] + 1
+            self.heads[regions] = heads
+            wanted = wanted - got
+        if not taken:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(taken), np.concatenate(taken_regions)
+
+
+class ReplicateView:
+    """
+    The results of one replicate of a batch, with the attributes the model reporters (see
+    reporters.py) read from a WaitingList.
+    """
+    get_transplants = WaitingList.get_transplants
+    get_advantaged_transplants = WaitingList.get_advantaged_transplants
+
+    def __init__(self, batch, r):
+        self.region_codes = batch.region_codes
+        self.outcomes = batch.outcomes.replicate(r)
+        self.primary_listing_transplant = batch.primary_listing_transplant[r].tolist()
+        self.alternate_listing_transplant = batch.alternate_listing_transplant[r].tolist()
+        self.primary_waiting = batch.primary_waiting[r].tolist()
+        self.alternate_waiting = batch.alternate_waiting[r].tolist()
+
+
+class ReplicateBatch:
+    """
+    Several replicates of one scenario, simulated together.  The per-region state has a leading
+    replicate axis (replicates x regions), and the patients of all the replicates share one
+    PatientArrays, where region i of replicate r is known as batch region r x regions + i.  Each
+    month, with one array operation for all the replicates:
+    1. the patients are aged, and the deaths are counted and taken off the lists
+    2. the number of transplants of every region and a random order of the regions are drawn for
+       every replicate.  The regions are then allocated in rounds: round k allocates the k-th
+       region in the order of every replicate, which selects the first waiting patients of its
+       list (ListingQueues.take).  Replicates do not share patients, so the regions of a round
+       never compete for a patient.
+    3. the arrivals of every replicate are drawn in one batch of candidates (candidates.draw_candidates),
+       with the smart listing scores of their own replicate
+    The batch draws from a single random stream seeded with all its seeds, so replicate r is not
+    the same run as a WaitingList with seeds[r], but it has the same distribution of outcomes as
+    one with batched draws.
+
+    Attributes:
+        seeds: seed of each replicate
+        replicates: number of replicates
+        regions: number of regions of each replicate
+        rng: random number generator of the batch
+        patients: the patients of all the replicates
+        outcomes: the ReplicateCounters of all the replicates
+        queues: the ListingQueues of all the batch regions
+        queue_lengths: number of patients waiting on each list (replicates x regions)
+        running: whether each replicate is still running
+    """
+    def __init__(self, DSAs, seeds, advantage_prob=0.05, average_lifespan=98, years=20, smart_listing=True,
+                 population_scale=1):
+        """
+        Create the batch, with the initial waiting lists of every replicate
+
+        args:
+        DSAs, advantage_prob, average_lifespan, years, smart_listing, population_scale: as for WaitingList
+        seeds: seed of each replicate
+        """
+        print("Running %d replicates for: " % len(seeds), advantage_prob)
+        if DSAs == 'ALL':
+            DSAs = get_all_dsas()
+        else:
+            DSAs = DSAs.split(',')
+        parameters = get_dsa_parameters(DSAs)
+        self.region_codes = parameters.dsas
+        self.seeds = [int(seed) for seed in seeds]
+        self.replicates = len(self.seeds)
+        self.regions = len(DSAs)
+        self.advantage_probability = advantage_prob
+        self.average_lifespan = average_lifespan
+        self.smart_listing = smart_listing
+        self.months = years * 12
+        self.rates = np.array(parameters.rates, dtype=np.float64) * population_scale
+        self.initial_queue_probabilities = parameters.initial_queue_probabilities
+        self.additional_queue_probabilities = parameters.additional_queue_probabilities
+        self.initial_patients = int(round(parameters.wl_size * population_scale))
+        self.additional_patients = parameters.additional_patients * population_scale
+        self.rng = np.random.RandomState(self.seeds)
+        self.ticks = 0
+        self.running = np.ones(self.replicates, dtype=bool)
+
+        shape = (self.replicates, self.regions)
+        self.patients = PatientArrays(active_set=True)
+        self.outcomes = ReplicateCounters(*shape)
+        self.queues = ListingQueues(self.replicates * self.regions)
+        self.queue_lengths = np.zeros(shape, dtype=np.int64)
+        self.primary_listing_transplant = np.zeros(shape, dtype=np.int64)
+        self.alternate_listing_transplant = np.zeros(shape, dtype=np.int64)
+        self.primary_waiting = np.zeros(shape, dtype=np.int64)
+        self.alternate_waiting = np.zeros(shape, dtype=np.int64)
+
+        self.add_candidates(np.full(self.replicates, self.initial_patients), initial=True)
+
+    def add_candidates(self, counts, initial=False):
+        """
+        Draw counts[r] new patients for each replicate r, in one batch, and list them all.
+        """
+        if initial:
+            queue_probabilities = self.initial_queue_probabilities
+        else:
+            queue_probabilities = self.additional_queue_probabilities
+        replicate = np.repeat(np.arange(self.replicates), counts)
+        scores = smart_listing_scores(self.rates, self.queue_lengths) if self.smart_listing else None
+        batch = draw_candidates(self.rng, len(replicate), queue_probabilities, self.advantage_probability,
+                                self.average_lifespan, initial, scores, replicate)
+
+        # Move the listings to the replicate's batch regions
+        listings = np.where(batch.listings >= 0, batch.listings + (replicate * self.regions)[:, None], -1)
+        primary = listings[:, 0]
+        advantaged = listings[:, 1] >= 0
+        primary_counts = self.outcomes.by_region(primary)
+        alternate_counts = self.outcomes.by_region(listings[:, 1:][listings[:, 1:] >= 0])
+        self.primary_waiting += primary_counts
+        self.alternate_waiting += alternate_counts
+        self.outcomes.add_many(WAITING, primary, advantaged)
+        self.queue_lengths += primary_counts + alternate_counts
+
+        first = self.patients.add_many(listings, batch.lifespan, batch.waiting)
+        self.queues.extend(listings, first, self.patients.condition)
+
+    def leave_queues(self, listings):
+        """
+        Record that the patients with the given rows of batch regions are no longer waiting.
+        """
+        self.queue_lengths -= self.outcomes.by_region(listings[listings >= 0])
+
+    def select(self, selected, regions):
+        """
+        Mark patients as selected for a transplant in the given batch regions.
+        """
+        patients = self.patients
+        patients.condition[selected] = SELECTED
+        primary = patients.primary[selected]
+        self.outcomes.transition_many(WAITING, SELECTED, primary, patients.advantaged(selected),
+                                      patients.waiting[selected])
+        self.leave_queues(patients.listings[selected])
+        is_primary = primary == regions
+        self.primary_listing_transplant += self.outcomes.by_region(regions[is_primary])
+        self.alternate_listing_transplant += self.outcomes.by_region(regions[~is_primary])
+
+    def step(self):
+        """
+        Advance every running replicate by one month.
+        """
+        patients = self.patients
+        transplanted, deceased = patients.age()
+        self.outcomes.transition_many(SELECTED, TRANSPLANTED, patients.primary[transplanted],
+                                      patients.advantaged(transplanted))
+        self.outcomes.transition_many(WAITING, DECEASED, patients.primary[deceased], patients.advantaged(deceased))
+        self.leave_queues(patients.listings[deceased])
+
+        # Print out the year
+        if (self.ticks % 12) == 0:
+            print("... Model Year:\t %d" % (self.ticks / 12))
+
+        # Transplants of every region, and the order the regions of each replicate are allocated in
+        num_to_select = self.rng.poisson(self.rates, (self.replicates, self.regions))
+        num_to_select[~self.running] = 0
+        region_order = np.argsort(self.rng.random_sample(num_to_select.shape), axis=1)
+        batch_order = region_order + (np.arange(self.replicates) * self.regions)[:, None]
+        num_to_select = np.take_along_axis(num_to_select, region_order, 1)
+        for k in range(self.regions):
+            allocating = np.flatnonzero(num_to_select[:, k])
+            selected, regions = self.queues.take(batch_order[allocating, k], num_to_select[allocating, k],
+                                                 patients.condition)
+            self.select(selected, regions)
+
+        # Add new patients
+        self.add_candidates(self.rng.poisson(self.additional_patients, self.replicates) * self.running)
+
+        self.ticks += 1
+
+        # Replicates halt once nobody is waiting, and all of them after the last month.  The
+        # patients of a halted replicate are all selected, so aging them further changes nothing
+        # the reporters count
+        self.running &= self.outcomes.counts[WAITING].sum(axis=1) > 0
+        if self.ticks > self.months:
+            self.running[:] = False
+
+    def run(self):
+        """
+        Step the batch until every replicate has halted.
+        """
+        while self.running.any():
+            self.step()
+
+    def replicate(self, r):
+        """
+        Return the results of replicate r, as a ReplicateView the model reporters can read.
+        """
+        return ReplicateView(self, r)
+
+
+def run_replicates(params, seeds):
+    """
+    Run the replicates of one scenario as a batch, and return one row per replicate (in the order
+    of seeds), with the same columns as sweep.run_model.
+
+    args:
+    params: WaitingList arguments of the scenario, the seed is replaced by each of the seeds
+    seeds: seed of each replicate
+    """
+    from reporters import model_reporter
+
+    enabled = [name for name in UNSUPPORTED if params.get(name)]
+    if enabled:
+        raise ValueError("A replicate batch can not use: %s" % ", ".join(enabled))
+    if params.get("engine") == "cohort":
+        raise ValueError("A replicate batch keeps every patient, it can not stand in for the cohort engine")
+    arguments = {name: value for name, value in params.items() if name not in UNSUPPORTED + IGNORED}
+    batch = ReplicateBatch(seeds=seeds, **arguments)
+    batch.run()
+    rows = []
+    for r, seed in enumerate(batch.seeds):
+        view = batch.replicate(r)
+        row = dict(params, seed=seed)
+        row["region_codes"] = batch.region_codes
+        for name, reporter in model_reporter.items():
+            row[name] = reporter(view)
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run several seeds of one scenario together.")
+    parser.add_argument("output_file", help="file to write the results to (.csv, .npz or .parquet)")
+    parser.add_argument("--dsas", default="ALL")
+    parser.add_argument("--years", type=int, default=20)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 100, 200, 300, 400])
+    parser.add_argument("--advantage-prob", type=float, default=0.05)
+    parser.add_argument("--average-lifespan", type=float, default=91)
+    args = parser.parse_args()
+
+    params = {"DSAs": args.dsas, "advantage_prob": args.advantage_prob, "average_lifespan": args.average_lifespan,
+              "years": args.years}
+    save_results(pd.DataFrame(run_replicates(params, args.seeds)), args.output_file)
@@ -0,0 +1,30 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Model reporters computed at the end of each run, and the columns of the result files.  """
+
+from waitinglist import WaitingList
+
+# At the end of each model run, calculate the outcomes of the waiting lists
+model_reporter = {"Primary_Transplants": WaitingList.get_primary_center_transplants,
+                  "Alternate_Transplants": WaitingList.get_alternate_center_transplants,
+                  "Transplants": WaitingList.get_transplants,
+                  "Primary_Listings": WaitingList.get_primary_listings,
+                  "Alternate_Listings": WaitingList.get_alternate_listings,
+                  "Count_Waiting": WaitingList.get_waiting,
+                  "Count_Deceased": WaitingList.get_deceased,
+                  "Count_Advantaged_Deceased": WaitingList.get_advantaged_deceased,
+                  "Advantaged_Transplants": WaitingList.get_advantaged_transplants,
+                  "Average_Wait": WaitingList.get_average_waiting,
+                  "Death_Region": WaitingList.get_primary_deaths_regional,
+                  "Primary_WL": WaitingList.get_primary_wl_regional,
+                  "Primary_TX": WaitingList.get_primary_tx_regional,
+                  "Wait_Rates": WaitingList.get_primary_waiting_rates,
+                  "Advantaged_Wait": WaitingList.get_average_waiting_advantaged}
+
+# Sort the columns
+columns = ["DSAs", "advantage_prob", "seed", "Primary_Transplants",
+           "Alternate_Transplants", "Transplants", "Primary_Listings",
+           "Alternate_Listings", "Count_Waiting", "Count_Deceased",
+           "Count_Advantaged_Deceased", "Advantaged_Transplants",
+           "Average_Wait", "Death_Region", "Primary_WL",
+           "Primary_TX", "Wait_Rates", "Advantaged_Wait"]
@@ -0,0 +1,160 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Columnar storage of run results, with the per-DSA outputs kept as numeric arrays.
+The results of a sweep can be written as CSV (as main.py always has), as a compressed NumPy
+.npz file, or as a Parquet file (which needs pyarrow)."""
+
+import json
+import os
+
+import numpy as np
+
+from profiling import PROFILE_COLUMNS
+from steady_state import STEADY_STATE_COLUMNS
+from reporters import columns
+
+# Outputs holding one value per DSA, and their types
+REGION_COLUMNS = {"Death_Region": np.int64,
+                  "Primary_WL": np.int64,
+                  "Primary_TX": np.int64,
+                  "Wait_Rates": np.float64}
+
+# Types of the outputs holding a single value per run
+SCALAR_COLUMNS = {"DSAs": str,
+                  "advantage_prob": np.float64,
+                  "seed": np.int64,
+                  "Primary_Transplants": np.int64,
+                  "Alternate_Transplants": np.int64,
+                  "Transplants": np.int64,
+                  "Primary_Listings": np.int64,
+                  "Alternate_Listings": np.int64,
+                  "Count_Waiting": np.int64,
+                  "Count_Deceased": np.int64,
+                  "Count_Advantaged_Deceased": np.int64,
+                  "Advantaged_Transplants": np.int64,
+                  "Average_Wait": np.float64,
+                  "Advantaged_Wait": np.float64}
+
+# Columns orchestrator.load_results adds to the runs it exports: the worker that ran each run,
+# when it started and how many seconds it took
+RUN_COLUMNS = {"worker": str,
+               "started": np.float64,
+               "seconds": np.float64}
+
+# Columns only written when the runs produced them, and their types
+OPTIONAL_COLUMNS = dict([(column, np.int64) for column in STEADY_STATE_COLUMNS] +
+                        [(column, np.float64) for column in PROFILE_COLUMNS] +
+                        list(RUN_COLUMNS.items()))
+
+
+def results_to_arrays(df):
+    """
+    Convert a DataFrame of run results (from sweep.run_sweep) to a dictionary of typed arrays:
+    one array per scalar output, a (runs x regions) array per per-DSA output, and the DSA code
+    labelling each region under "region_codes".
+    """
+    region_codes = set(tuple(codes) for codes in df["region_codes"])
+    if len(region_codes) != 1:
+        raise ValueError("All runs in a columnar result file must use the same DSAs")
+
+    arrays = {"region_codes": np.array(region_codes.pop(), dtype=str)}
+    for column in columns:
+        if column in REGION_COLUMNS:
+            arrays[column] = np.array([list(values) for values in df[column]], dtype=REGION_COLUMNS[column])
+        else:
+            arrays[column] = np.array(df[column].tolist(), dtype=SCALAR_COLUMNS[column])
+    for column in optional_columns(df):
+        arrays[column] = np.array(df[column].tolist(), dtype=OPTIONAL_COLUMNS[column])
+    return arrays
+
+
+def optional_columns(df):
+    """
+    Return the optional columns (the steady state tick, the profiling columns and the
+    orchestrator's run columns, see OPTIONAL_COLUMNS) present in the run results.
+    """
+    return [column for column in OPTIONAL_COLUMNS if column in df]
+
+
+def write_results(df, path):
+    """
+    Write run results to a .npz or .parquet file, depending on the extension of path.
+    """
+    arrays = results_to_arrays(df)
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        region_codes = arrays.pop("region_codes")
+        fields = {}
+        for column, values in arrays.items():
+            if column in REGION_COLUMNS:
+                fields[column] = pa.FixedSizeListArray.from_arrays(pa.array(values.ravel()), len(region_codes))
+            else:
+                fields[column] = pa.array(values)
+        table = pa.table(fields, metadata={"region_codes": json.dumps(region_codes.tolist())})
+        pq.write_table(table, path)
+    else:
+        np.savez_compressed(path, **arrays)
+
+
+def check_region_codes(region_codes, expected, path, reference):
+    """
+    Raise a ValueError if a result file does not have the DSAs, in the same order, of the file
+    it is read with.
+    """
+    if list(region_codes) != list(expected):
+        raise ValueError("%s does not have the DSAs of %s: %s missing, %s extra" % (
+            path, reference, sorted(set(expected) - set(region_codes)), sorted(set(region_codes) - set(expected))))
+
+
+def read_results(paths):
+    """
+    Read one or more result files written by write_results (all .npz or all .parquet, with the
+    same DSAs) and return a dictionary of arrays, with the runs of all the files concatenated.
+    Raises a ValueError if the files do not all have the same DSAs.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    if paths[0].endswith(".parquet"):
+        import pyarrow.dataset as ds
+
+        region_codes = json.loads(ds.dataset(paths[0], format="parquet").schema.metadata[b"region_codes"])
+        for path in paths[1:]:
+            check_region_codes(json.loads(ds.dataset(path, format="parquet").schema.metadata[b"region_codes"]),
+                               region_codes, path, paths[0])
+        table = ds.dataset(paths, format="parquet").to_table()
+        arrays = {"region_codes": np.array(region_codes, dtype=str)}
+        for column in table.column_names:
+            values = table.column(column).combine_chunks()
+            if column in REGION_COLUMNS:
+                arrays[column] = values.flatten().to_numpy().reshape(-1, len(region_codes))
+            else:
+                arrays[column] = np.asarray(values.to_numpy(zero_copy_only=False))
+        return arrays
+
+    loaded = [np.load(path) for path in paths]
+    try:
+        arrays = {"region_codes": loaded[0]["region_codes"]}
+        for path, f in zip(paths[1:], loaded[1:]):
+            check_region_codes(f["region_codes"].tolist(), arrays["region_codes"].tolist(), path, paths[0])
+        for column in columns + [column for column in OPTIONAL_COLUMNS if column in loaded[0]]:
+            arrays[column] = np.concatenate([f[column] for f in loaded])
+    finally:
+        for f in loaded:
+            f.close()
+    return arrays
+
+
+def save_results(df, path):
+    """
+    Save run results to path: CSV with the columns main.py has always written, or a columnar
+    file if the extension is .npz or .parquet.  The steady state tick, the profiling columns and
+    the orchestrator's run columns are added after them if the runs have them.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension in (".npz", ".parquet"):
+        write_results(df, path)
+    else:
+        df[columns + optional_columns(df)].to_csv(path)
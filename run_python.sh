@@ -1,4 +1,4 @@
-#!/bin/bash 
+#!/bin/bash
 # Submit the job with a specific name
 #MSUB -N queuing_model
 # Specify resources
@@ -8,23 +8,28 @@
 #MSUB -o queuing.out
 # Pass environment variables
 #MSUB -E
-# Run as a job array from 0-1009
-#MSUB -t jobarrays[0-1009]
+# Run as a job array of workers, each takes runs from the store until none are left
+#MSUB -t jobarrays[0-19]
 
 # Move into user's working directory
 cd $PBS_O_WORKDIR
 
-# Asign and create an output directory
+# Asign and create an output directory, holding the store of runs and results
 OUTPUT_DIR='20181127'
 mkdir -p ${OUTPUT_DIR}
+STORE=${OUTPUT_DIR}/sweep.db
 
+# Add the points of the grid to the store; points already in it are kept, so resubmitting
+# the array only runs what is left
+python3 orchestrator.py init ${STORE} sweep_grid.json
 
-# Convet the JOBID to a number and define the advantage probability and the seed
-let "JOB_ID = $((MOAB_JOBARRAYINDEX))"
-let "ADV_PROB = $JOB_ID % 101"
-let "SEED = $JOB_ID / 101"
+# Run a worker process on each core, resuming runs from checkpoints if a job was cut short.
+# The lease is shorter than the walltime, so the runs of a job killed at its walltime are
+# handed out again to the next job instead of staying claimed for the default 6 hours.
+python3 orchestrator.py work ${STORE} --processes 7 --checkpoint-dir ${OUTPUT_DIR}/checkpoints --lease 3000
 
-# Run Python Code
-python3 main.py $SEED $ADV_PROB ${OUTPUT_DIR}/${MOAB_JOBARRAYINDEX}.csv
+echo -e "Job submitted by $PBS_O_LOGNAME ran on $HOSTNAME with:\n\tJOBARRAYINDEX=$MOAB_JOBARRAYINDEX"
 
-echo -e "Job submitted by $PBS_O_LOGNAME ran on $HOSTNAME with:\n\tJOBARRAYINDEX=$MOAB_JOBARRAYINDEX\n\tADV_PROB=$ADV_PROB\n\tSEED=$SEED"
+# Once every job is done, write the results with:
+# python3 orchestrator.py status ${STORE}
+# python3 orchestrator.py export ${STORE} ${OUTPUT_DIR}/results.csv
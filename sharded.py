@@ -0,0 +1,569 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Region-sharded execution of a single large run over several worker processes.
+The DSAs are split among shards, and each shard keeps the patients whose primary listing is in
+its DSAs and the queues of its DSAs, in its own process and with its own random number stream.
+A coordinator passes the listings, deaths and selections of the multiply listed patients between
+the shards every month.  Run with:
+python3 sharded.py output_file --dsas ALL --years 40 --shards 7 --seed 0 --advantage-prob 0.3"""
+
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from candidates import draw_candidates, smart_listing_scores
+from data_import import get_dsa_parameters, get_all_dsas
+from outcomes import OutcomeCounters
+from patient_arrays import PatientArrays, WAITING, SELECTED
+from queues import RegionQueue
+from results_io import save_results
+from waitinglist import WaitingList
+
+
+def partition_regions(weights, shards):
+    """
+    Assign each region to a shard, balancing the total weight (share of the patients) of the
+    shards: regions are taken from the heaviest, each to the lightest shard so far (ties go to
+    the lowest shard).  Returns the shard of each region.
+    """
+    owner = np.zeros(len(weights), dtype=np.int64)
+    loads = np.zeros(shards)
+    for region in np.argsort(-np.asarray(weights), kind='stable'):
+        shard = int(np.argmin(loads))
+        owner[region] = shard
+        loads[shard] += weights[region]
+    return owner
+
+
+class RegionShard:
+    """
+    The part of a sharded run owned by one shard: the patients whose primary region is one of
+    the shard's regions (in a PatientArrays), and the queues of its regions.  Patients are known
+    across shards by a global id, local index x shards + shard.  The queues of the shard also
+    hold patients of other shards (foreign patients) listed in its regions; those are waiting
+    until the coordinator reports that they left the lists.
+
+    Counters are kept with one entry per region of the whole model, only the shard's own
+    entries are used, so the counters of the shards add up to those of the run.  The shard has
+    the attributes of a WaitingList that its aging and queue bookkeeping use, and borrows those
+    methods from WaitingList, with queues only for its own regions (None for the others).
+
+    Foreign patients that left the lists are remembered in gone until none of the shard's queues
+    holds them anymore: every time gone doubles in size, it is pruned down to the patients still
+    in a queue.
+
+    Attributes:
+        shard: number of this shard
+        shards: number of shards
+        owner: shard of each region
+        owned: regions of this shard
+        rng: random number generator of the shard
+        patients: the patients of the shard
+        queues: queue of each region, None for the regions of other shards
+        cross: the shard's own patients that are also listed in other shards' regions
+        gone: foreign patients that are no longer waiting, and may still be in a queue
+        kept: size of gone after it was last pruned
+        departed: global ids of the shard's patients that died this month listed in other shards
+        pending: patients claimed in this month's current round, whose selection is not settled
+        demand: number of patients each region still has to select this month
+    """
+    # Do not bother pruning gone while it holds fewer patients than this
+    MIN_PRUNE = 4096
+
+    age_patients = WaitingList.age_patients
+    count_transplant = WaitingList.count_transplant
+    leave_queues = WaitingList.leave_queues
+    leave_queues_counts = WaitingList.leave_queues_counts
+
+    def __init__(self, shard, owner, seed, rates, initial_queue_probabilities, additional_queue_probabilities,
+                 additional_patients, advantage_prob, average_lifespan, smart_listing):
+        self.shard = shard
+        self.shards = int(owner.max()) + 1
+        self.owner = owner
+        self.owned = np.flatnonzero(owner == shard)
+        self.rng = np.random.RandomState([int(seed), shard])
+        self.rates = np.asarray(rates, dtype=np.float64)
+        self.advantage_probability = advantage_prob
+        self.average_lifespan = average_lifespan
+        self.smart_listing = smart_listing
+
+        # Primary listings restricted to the shard's regions, and the shard's share of the arrivals
+        self.regions = regions = len(owner)
+        mine = owner == shard
+        initial = np.where(mine, initial_queue_probabilities, 0.0)
+        additional = np.where(mine, additional_queue_probabilities, 0.0)
+        self.initial_queue_probabilities = initial / initial.sum()
+        self.additional_queue_probabilities = additional / additional.sum()
+        self.additional_patients = additional_patients * additional.sum()
+
+        self.patients = PatientArrays(active_set=True)
+        self.outcomes = OutcomeCounters(regions)
+        self.queue_lengths = np.zeros(regions, dtype=np.int64)
+        self.listing_scores = smart_listing_scores(self.rates, self.queue_lengths)
+        self.policy = None
+        self.event_log = None
+        self.primary_listing_transplant = np.zeros(regions, dtype=np.int64)
+        self.alternate_listing_transplant = np.zeros(regions, dtype=np.int64)
+        self.primary_waiting = np.zeros(regions, dtype=np.int64)
+        self.alternate_waiting = np.zeros(regions, dtype=np.int64)
+        self.queues = [RegionQueue(self.is_waiting) if mine[region] else None for region in range(regions)]
+        self.cross = set()
+        self.gone = set()
+        self.kept = 0
+        self.departed = []
+        self.pending = set()
+        self.demand = {}
+
+    def is_waiting(self, patient):
+        """
+        Return whether the patient with the given global id is still waiting.
+        """
+        if patient % self.shards == self.shard:
+            return self.patients.condition[patient // self.shards] == WAITING
+        return patient not in self.gone
+
+    def own_regions(self, listings):
+        """
+        Return the listing regions of a patient that belong to this shard.
+        """
+        return [region for region in listings.tolist() if region >= 0 and self.owner[region] == self.shard]
+
+    def arrive(self, global_queue_lengths, count=None, initial=False):
+        """
+        Draw this month's new patients whose primary region belongs to the shard, and store them.
+
+        args:
+        global_queue_lengths: number of patients waiting on the list of every region, for smart listing
+        count: number of patients to draw, drawn from the shard's share of the arrivals if None
+        initial: whether the patients form the initial waiting list
+
+        Returns, for each shard, the (patient, region, primary flag, rank) of the new listings in its
+        regions, the patients listed in more than one shard with their listings, and the number
+        of patients of this shard still waiting.
+        """
+        if count is None:
+            count = self.rng.poisson(self.additional_patients)
+        probabilities = self.initial_queue_probabilities if initial else self.additional_queue_probabilities
+        scores = smart_listing_scores(self.rates, global_queue_lengths) if self.smart_listing else None
+        batch = draw_candidates(self.rng, count, probabilities, self.advantage_probability, self.average_lifespan,
+                                initial, scores)
+        listings = batch.listings
+        first = self.patients.add_many(listings, batch.lifespan, batch.waiting)
+        self.outcomes.add_many(WAITING, listings[:, 0], listings[:, 1] >= 0)
+        ids = (np.arange(first, first + count) * self.shards + self.shard)
+
+        rows, columns = np.nonzero(listings >= 0)
+        regions = listings[rows, columns]
+        shard_of = self.owner[regions]
+        # Place of each patient in the batch, as a fraction, to merge the batches of the shards
+        rank = (rows + 0.5) / count
+        new_listings = [(ids[rows[shard_of == shard]], regions[shard_of == shard], columns[shard_of == shard] == 0,
+                         rank[shard_of == shard]) for shard in range(self.shards)]
+
+        # Patients listed in another shard's regions
+        foreign = np.zeros(count, dtype=bool)
+        foreign[rows[shard_of != self.shard]] = True
+        self.cross.update(ids[foreign].tolist())
+        return new_listings, (ids[foreign], listings[foreign]), self.outcomes.total(WAITING)
+
+    def admit(self, new_listings):
+        """
+        Add new listings in the shard's regions to their queues.  new_listings holds the
+        (patient, region, primary flag, rank) arrays of each shard.  The batches of the shards are
+        interleaved by the rank of the patients in their batch, so no shard's patients are always
+        queued ahead of the others' (which matters for the large initial waiting list).
+        """
+        patients, regions, primary, rank = [np.concatenate(column) for column in zip(*new_listings)]
+        order = np.lexsort((rank, regions))
+        patients, regions, primary = patients[order], regions[order], primary[order]
+        self.queue_lengths += np.bincount(regions, minlength=len(self.owner))
+        self.primary_waiting += np.bincount(regions[primary], minlength=len(self.owner))
+        self.alternate_waiting += np.bincount(regions[~primary], minlength=len(self.owner))
+        starts = np.flatnonzero(np.diff(regions, prepend=-1))
+        ends = np.append(starts[1:], len(regions))
+        patients = patients.tolist()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.queues[int(regions[start])].extend(patients[start:end])
+
+    def age(self, new_listings):
+        """
+        Queue the listings of last month's new patients, then age the shard's patients, as
+        WaitingList.step does.  Returns the global ids of the patients that died and were listed
+        in other shards, for the coordinator to take them off those lists.
+        """
+        self.admit(new_listings)
+        self.age_patients()
+        return self.departed
+
+    def leave_queues_many(self, listings, patients=None):
+        """
+        Take the shard's patients that died off the lists of the shard's regions, and keep the
+        global ids of those also listed in other shards' regions in departed.
+        """
+        listed = listings[listings >= 0]
+        self.leave_queues_counts(np.bincount(listed[self.owner[listed] == self.shard], minlength=self.regions))
+        foreign = np.any((listings >= 0) & (self.owner[np.maximum(listings, 0)] != self.shard), axis=1)
+        self.departed = patients[foreign] * self.shards + self.shard
+        self.cross.difference_update(self.departed.tolist())
+
+    def allocate(self, departures, order):
+        """
+        Start this month's allocation: take the patients that died in other shards off the
+        queues, draw the number of transplants of each region, and make the first round of claims.
+
+        args:
+        departures: (patient, region) arrays of foreign patients that left the shard's lists
+        order: the month's order of the regions, which settles the conflicts between claims
+        """
+        self.depart(*departures)
+        self.prune_gone()
+        self.order = [region for region in order.tolist() if self.owner[region] == self.shard]
+        self.demand = dict(zip(self.order, self.rng.poisson(self.rates[self.order]).tolist()))
+        return self.claim()
+
+    def depart(self, patients, regions):
+        """
+        Take the given (patient, region) listings of patients that stopped waiting off the queues.
+        """
+        for region in regions.tolist():
+            self.leave_queues((region,))
+        self.gone.update(patients.tolist())
+
+    def prune_gone(self):
+        """
+        Forget the foreign patients that left the lists and are no longer held by any queue of the
+        shard, once gone has doubled in size since it was last pruned.
+        """
+        if len(self.gone) < max(self.MIN_PRUNE, 2 * self.kept):
+            return
+        held = set()
+        for region in self.owned.tolist():
+            queue = self.queues[region]
+            held.update(queue.items[queue.head:])
+        self.gone &= held
+        self.kept = len(self.gone)
+
+    def claim(self):
+        """
+        Have every region of the shard take patients off the front of its queue, in the month's
+        order, until it has taken as many as it still has to select.  Patients only listed in
+        this shard are selected at once; the others are claimed, and returned as (patient,
+        region) arrays for the coordinator to settle against the claims of other shards.
+        Returns the claims and the list lengths of the shard's regions.
+        """
+        claimed, claimed_regions = [], []
+        self.pending = set()
+        for region in self.order:
+            queue = self.queues[region]
+            while self.demand[region] > 0:
+                patient = queue.pop_waiting()
+                if patient is None:
+                    self.demand[region] = 0
+                    break
+                if patient in self.pending:
+                    # Claimed by an earlier region of this shard, it will be selected either way
+                    continue
+                self.demand[region] -= 1
+                if patient % self.shards == self.shard and patient not in self.cross:
+                    self.select(patient, region)
+                else:
+                    self.pending.add(patient)
+                    claimed.append(patient)
+                    claimed_regions.append(region)
+            queue.compact()
+        return (np.array(claimed, dtype=np.int64), np.array(claimed_regions, dtype=np.int64)), \
+            self.queue_lengths[self.owned]
+
+    def select(self, patient, region):
+        """
+        Select one of the shard's patients for a transplant in the given region.
+        """
+        patients = self.patients
+        index = patient // self.shards
+        primary = int(patients.primary[index])
+        waiting = patients.select(index)
+        self.outcomes.transition(WAITING, SELECTED, primary, patients.advantaged(index), waiting)
+        self.leave_queues(self.own_regions(patients.listings[index]))
+        self.cross.discard(patient)
+        if self.owner[region] == self.shard:
+            self.count_transplant(region, primary)
+
+    def settle(self, departures, selected, won, lost):
+        """
+        Apply the coordinator's decisions on the last round of claims, and make the next round.
+
+        args:
+        departures: (patient, region) arrays of foreign patients that left the shard's lists
+        selected: (patient, region) arrays of the shard's patients selected, and where
+        won: (region, primary region) arrays of the claims of the shard's regions that were
+            granted to foreign patients
+        lost: regions of the shard that lost a claim to an earlier region
+        """
+        for patient, region in zip(*[column.tolist() for column in selected]):
+            self.select(patient, region)
+        self.depart(*departures)
+        for region, primary in zip(*[column.tolist() for column in won]):
+            self.count_transplant(region, primary)
+        for region in lost.tolist():
+            self.demand[region] += 1
+        return self.claim()
+
+    def finish(self, new_listings):
+        """
+        Queue the listings of the last month's new patients, and return the shard's counters.
+        """
+        self.admit(new_listings)
+        return {"counts": self.outcomes.counts, "advantaged": self.outcomes.advantaged,
+                "transplant_wait": self.outcomes.transplant_wait,
+                "advantaged_transplant_wait": self.outcomes.advantaged_transplant_wait,
+                "primary_listing_transplant": self.primary_listing_transplant,
+                "alternate_listing_transplant": self.alternate_listing_transplant,
+                "primary_waiting": self.primary_waiting, "alternate_waiting": self.alternate_waiting}
+
+
+def serve(connection, arguments):
+    """
+    Run a RegionShard in a worker process, calling the methods the coordinator sends.
+    """
+    shard = RegionShard(*arguments)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        method, args = message
+        connection.send(getattr(shard, method)(*args))
+    connection.close()
+
+
+class ShardedRun:
+    """
+    A single run of the model with its regions split among shards.  Each month the coordinator:
+    1. has every shard queue last month's new listings and age its patients, and takes the
+       multiply listed patients that died off the lists of the other shards
+    2. draws the month's order of the regions, and settles the claims of the shards in rounds:
+       a patient claimed by several regions goes to the region that comes first in the order,
+       and the others take further patients in the next round, until no claims are left
+    3. has every shard draw its new patients, with smart listing scores from the list lengths
+       of all the shards
+    The run is deterministic for a seed and number of shards, whether the shards run in worker
+    processes or in this process.  It is not the same as a WaitingList run with the same seed,
+    which draws from a single stream, but it has the same distribution of outcomes, except that
+    a region that loses a patient to an earlier region only takes a replacement in the next
+    round, after the other regions' first claims are granted.
+
+    The attributes the model reporters read (outcomes, primary_listing_transplant, ...) are
+    filled in when the run finishes.
+    """
+    get_transplants = WaitingList.get_transplants
+    get_advantaged_transplants = WaitingList.get_advantaged_transplants
+
+    def __init__(self, DSAs, shards=4, seed=42, advantage_prob=0.05, average_lifespan=98, years=20,
+                 smart_listing=True, population_scale=1, processes=True):
+        """
+        Create the shards and their initial waiting lists
+
+        args:
+        DSAs, seed, advantage_prob, average_lifespan, years, smart_listing, population_scale: as for
+            WaitingList
+        shards: number of shards, at most the number of DSAs
+        processes: run each shard in its own worker process, otherwise in this process
+        """
+        print("Running sharded model for: ", advantage_prob)
+        if DSAs == 'ALL':
+            DSAs = get_all_dsas()
+        else:
+            DSAs = DSAs.split(',')
+        parameters = get_dsa_parameters(DSAs)
+        self.region_codes = parameters.dsas
+        self.regions = len(DSAs)
+        self.shards = min(shards, self.regions)
+        self.months = years * 12
+        self.ticks = 0
+        self.rng = np.random.RandomState(int(seed))
+        rates = np.array(parameters.rates) * population_scale
+        initial_patients = int(round(parameters.wl_size * population_scale))
+        self.owner = partition_regions(parameters.initial_queue_probabilities, self.shards)
+        arguments = [(shard, self.owner, seed, rates, parameters.initial_queue_probabilities,
+                      parameters.additional_queue_probabilities, parameters.additional_patients * population_scale,
+                      advantage_prob, average_lifespan, smart_listing) for shard in range(self.shards)]
+
+        if processes:
+            self.connections = []
+            self.workers = []
+            for shard_arguments in arguments:
+                parent, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=serve, args=(child, shard_arguments), daemon=True)
+                worker.start()
+                self.connections.append(parent)
+                self.workers.append(worker)
+        else:
+            self.shard_objects = [RegionShard(*shard_arguments) for shard_arguments in arguments]
+            self.connections = None
+
+        # Multiply listed patients listed in more than one shard, with their listings
+        self.listings = {}
+        shares = np.bincount(self.owner, weights=parameters.initial_queue_probabilities, minlength=self.shards)
+        counts = self.rng.multinomial(initial_patients, shares / shares.sum())
+        self.arrive(np.zeros(self.regions, dtype=np.int64), [(count, True) for count in counts.tolist()])
+        self.running = True
+
+    def call(self, method, arguments):
+        """
+        Call a method of every shard, with the given tuple of arguments for each, and return their
+        results.  Worker processes run their calls at the same time.
+        """
+        if self.connections is None:
+            return [getattr(shard, method)(*args) for shard, args in zip(self.shard_objects, arguments)]
+        for connection, args in zip(self.connections, arguments):
+            connection.send((method, args))
+        return [connection.recv() for connection in self.connections]
+
+    def departures(self, patients, exclude):
+        """
+        Return the (patient, region) arrays for each shard of the listings of the given multiply
+        listed patients, except in the shard in exclude for each patient (its owner, which
+        already took the patient off its lists).
+        """
+        rows, regions = [], []
+        for patient, skip in zip(patients, exclude):
+            for region in self.listings.pop(patient).tolist():
+                if region >= 0 and self.owner[region] != skip:
+                    rows.append(patient)
+                    regions.append(region)
+        rows = np.array(rows, dtype=np.int64)
+        regions = np.array(regions, dtype=np.int64)
+        shard_of = self.owner[regions]
+        return [(rows[shard_of == shard], regions[shard_of == shard]) for shard in range(self.shards)]
+
+    def arrive(self, queue_lengths, arguments):
+        """
+        Have every shard draw its new patients, and collect their listings for each shard.
+        """
+        results = self.call("arrive", [(queue_lengths,) + args for args in arguments])
+        self.new_listings = [[result[0][shard] for result in results] for shard in range(self.shards)]
+        for result in results:
+            patients, listings = result[1]
+            self.listings.update(zip(patients.tolist(), listings))
+        self.waiting = sum(result[2] for result in results)
+
+    def step(self):
+        """
+        Advance the run by one month.
+        """
+        deceased = self.call("age", [(listings,) for listings in self.new_listings])
+        deceased = np.concatenate(deceased).tolist()
+        departures = self.departures(deceased, [patient % self.shards for patient in deceased])
+
+        if (self.ticks % 12) == 0:
+            print("... Model Year:\t %d" % (self.ticks / 12))
+
+        order = self.rng.permutation(self.regions)
+        position = np.empty(self.regions, dtype=np.int64)
+        position[order] = np.arange(self.regions)
+        results = self.call("allocate", [(departures[shard], order) for shard in range(self.shards)])
+        while any(len(result[0][0]) for result in results):
+            results = self.settle([result[0] for result in results], position)
+        queue_lengths = np.zeros(self.regions, dtype=np.int64)
+        for shard, result in enumerate(results):
+            queue_lengths[self.owner == shard] = result[1]
+
+        self.arrive(queue_lengths, [() for shard in range(self.shards)])
+        self.ticks += 1
+        if self.waiting == 0 or self.ticks > self.months:
+            self.finish()
+
+    def settle(self, claims, position):
+        """
+        Settle a round of claims: each claimed patient goes to the claiming region that comes
+        first in the month's order.  Sends the outcome to the shards and returns their next claims.
+        """
+        patients = np.concatenate([claim[0] for claim in claims])
+        regions = np.concatenate([claim[1] for claim in claims])
+        order = np.lexsort((position[regions], patients))
+        patients, regions = patients[order], regions[order]
+        first = np.diff(patients, prepend=-1) != 0
+        winners, winning_regions = patients[first], regions[first]
+        lost = regions[~first]
+
+        selected = [[] for shard in range(self.shards)]
+        won = [[] for shard in range(self.shards)]
+        exclude = []
+        for patient, region in zip(winners.tolist(), winning_regions.tolist()):
+            owner = patient % self.shards
+            selected[owner].append((patient, region))
+            primary = int(self.listings[patient][0])
+            if self.owner[region] != owner:
+                won[self.owner[region]].append((region, primary))
+            exclude.append(owner)
+        departures = self.departures(winners.tolist(), exclude)
+
+        arguments = []
+        for shard in range(self.shards):
+            shard_selected = np.array(selected[shard], dtype=np.int64).reshape(-1, 2).T
+            shard_won = np.array(won[shard], dtype=np.int64).reshape(-1, 2).T
+            arguments.append((departures[shard], tuple(shard_selected), tuple(shard_won),
+                              lost[self.owner[lost] == shard]))
+        return self.call("settle", arguments)
+
+    def finish(self):
+        """
+        Collect the counters of the shards into the attributes the reporters read, and stop the
+        worker processes.
+        """
+        results = self.call("finish", [(listings,) for listings in self.new_listings])
+        self.outcomes = OutcomeCounters(self.regions)
+        self.outcomes.counts = sum(result["counts"] for result in results)
+        self.outcomes.advantaged = sum(result["advantaged"] for result in results)
+        self.outcomes.transplant_wait = sum(result["transplant_wait"] for result in results)
+        self.outcomes.advantaged_transplant_wait = int(sum(result["advantaged_transplant_wait"] for result in results))
+        for name in ("primary_listing_transplant", "alternate_listing_transplant", "primary_waiting",
+                     "alternate_waiting"):
+            setattr(self, name, sum(result[name] for result in results).tolist())
+        if self.connections is not None:
+            for connection, worker in zip(self.connections, self.workers):
+                connection.send(None)
+                worker.join()
+        self.running = False
+
+    def run(self):
+        """
+        Step the run until it halts.
+        """
+        while self.running:
+            self.step()
+
+
+def run_sharded(params, shards=4, processes=True):
+    """
+    Run a single sharded run, and return its parameters and the values of the model reporters,
+    as sweep.run_model does.
+    """
+    from reporters import model_reporter
+
+    run = ShardedRun(shards=shards, processes=processes, **params)
+    run.run()
+    row = dict(params)
+    row["region_codes"] = run.region_codes
+    for name, reporter in model_reporter.items():
+        row[name] = reporter(run)
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a single model with its DSAs split among worker processes.")
+    parser.add_argument("output_file", help="file to write the results to (.csv, .npz or .parquet)")
+    parser.add_argument("--dsas", default="ALL")
+    parser.add_argument("--years", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--advantage-prob", type=float, default=0.05)
+    parser.add_argument("--average-lifespan", type=float, default=91)
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--in-process", action="store_true", help="run the shards in this process")
+    args = parser.parse_args()
+
+    params = {"DSAs": args.dsas, "seed": args.seed, "advantage_prob": args.advantage_prob,
+              "average_lifespan": args.average_lifespan, "years": args.years}
+    row = run_sharded(params, args.shards, not args.in_process)
+    save_results(pd.DataFrame([row]), args.output_file)
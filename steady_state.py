@@ -0,0 +1,87 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Detection of the steady state of a run, to stop it (or flag it) once its outputs settle.  """
+
+import numpy as np
+
+from patient_arrays import SELECTED, TRANSPLANTED, DECEASED
+
+# Result column holding the tick the run reached its steady state, -1 if it never did
+STEADY_STATE_COLUMNS = ["Steady_State_Tick"]
+
+
+class SteadyStateMonitor:
+    """
+    Tracks the per-region number of patients waiting on each list and the number of patients
+    selected and dying each month, over the last two windows of months.  The run is steady once,
+    for a whole window of consecutive months, the mean of every series in the recent window is
+    within tolerance (relative) of its mean in the window before, give or take z standard errors
+    of the difference, so the monthly noise of small regions does not keep them from settling.
+
+    Attributes:
+        window: number of months in each of the two windows compared
+        tolerance: largest relative change of a series mean between the windows
+        z: number of standard errors of the difference allowed on top of the tolerance
+        stop: whether the run stops once it is steady, or only records when it was
+        values: the series of the last 2 x window months, as a ring buffer
+        count: number of months recorded
+        streak: number of consecutive months the windows have passed the test
+        last: cumulative selections and deaths of each region at the last record
+        tick: tick the run became steady, None until then
+    """
+    def __init__(self, regions, window=24, tolerance=0.02, z=3.0, stop=True):
+        """
+        Create a monitor for a model with the given number of regions
+
+        args:
+        regions: number of regions
+        window: number of months in each window
+        tolerance: largest relative change between the windows
+        z: standard errors of the difference allowed on top of the tolerance
+        stop: whether the run stops once steady
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.z = z
+        self.stop = stop
+        self.values = np.zeros((2 * window, 3 * regions))
+        self.count = 0
+        self.streak = 0
+        self.last = np.zeros(2 * regions, dtype=np.int64)
+        self.tick = None
+
+    def update(self, model):
+        """
+        Record the current month of the model, and return whether the run is steady (or was
+        steady at an earlier tick).
+        """
+        counts = model.outcomes.counts
+        cumulative = np.concatenate([counts[SELECTED] + counts[TRANSPLANTED], counts[DECEASED]])
+        self.values[self.count % len(self.values)] = np.concatenate([model.queue_lengths, cumulative - self.last])
+        self.last = cumulative
+        self.count += 1
+        if self.tick is not None:
+            return True
+        if self.count < len(self.values):
+            return False
+
+        # Order the ring buffer from the oldest month
+        values = np.roll(self.values, -(self.count % len(self.values)), axis=0)
+        older, recent = values[:self.window], values[self.window:]
+        older_mean, recent_mean = older.mean(axis=0), recent.mean(axis=0)
+        error = np.sqrt((older.var(axis=0, ddof=1) + recent.var(axis=0, ddof=1)) / self.window)
+        if np.all(np.abs(recent_mean - older_mean) <= self.tolerance * np.abs(older_mean) + self.z * error):
+            self.streak += 1
+        else:
+            self.streak = 0
+        # A slow trend can pause for a few months, so the test must pass for a whole window
+        if self.streak >= self.window:
+            self.tick = model.ticks
+            return True
+        return False
+
+    def columns(self):
+        """
+        Return the result column of the monitor.
+        """
+        return {"Steady_State_Tick": -1 if self.tick is None else self.tick}
@@ -0,0 +1,321 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Run a grid of WaitingList parameters on a pool of worker processes.
+Run as:
+python3 sweep.py output_file --seeds 0 100 200 --advantage-probs 0 0.05 0.1 --processes 7
+or, adding replications until the 95% confidence intervals are narrow enough:
+python3 sweep.py output_file --advantage-probs 0 0.05 0.1 --targets Average_Wait=0.5 Count_Deceased=100"""
+
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_import import get_dsa_parameters, get_all_dsas
+from policies import POLICIES
+from replicates import run_replicates
+from reporters import model_reporter
+from results_io import save_results
+from waitinglist import WaitingList
+
+
+def parameter_grid(fixed_params, variable_params):
+    """
+    Return the list of keyword arguments for every combination of the variable parameters.
+
+    args:
+    fixed_params: dictionary of parameters shared by every run
+    variable_params: dictionary mapping parameter names to the list of values to sweep over
+    """
+    names = list(variable_params.keys())
+    runs = []
+    for values in itertools.product(*[variable_params[name] for name in names]):
+        params = dict(fixed_params)
+        params.update(zip(names, values))
+        runs.append(params)
+    return runs
+
+
+def run_model(params):
+    """
+    Run a single WaitingList to completion, and return its parameters and the values of the
+    model reporters as a dictionary.  Every run seeds the random number generator of the process
+    it runs in from its own seed, so results do not depend on which worker ran it, or when.
+
+    If the parameters include a checkpoint_path and that file exists, the run resumes from the
+    checkpoint instead of starting over.  The checkpoint is removed once the run completes.
+    """
+    checkpoint_path = params.get("checkpoint_path")
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        model = WaitingList.resume(checkpoint_path)
+    else:
+        model = WaitingList(**params)
+    while model.running:
+        model.step()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    row = dict(params)
+    row["region_codes"] = model.region_codes
+    if model.profile is not None:
+        start = time.perf_counter()
+    for name, reporter in model_reporter.items():
+        row[name] = reporter(model)
+    if model.profile is not None:
+        model.profile.lap("reporters", start)
+        row.update(model.profile.columns())
+    if model.steady_state is not None:
+        row.update(model.steady_state.columns())
+    return row
+
+
+def load_data(DSAs):
+    """
+    Load the DSA parameters into the process-wide cache.  Called before the pool starts, so
+    forked workers share the loaded data instead of reading it again.
+    """
+    if DSAs == 'ALL':
+        get_dsa_parameters(get_all_dsas())
+    else:
+        get_dsa_parameters(DSAs.split(','))
+
+
+def checkpoint_name(params, extension=".pkl"):
+    """
+    Return a checkpoint (or other per-run) file name that is unique to a set of run parameters.
+    """
+    key = repr(sorted((name, repr(value)) for name, value in params.items()))
+    return "run-%s%s" % (hashlib.sha1(key.encode()).hexdigest()[:16], extension)
+
+
+def run_sweep(fixed_params, variable_params, processes=None, checkpoint_dir=None, checkpoint_every=12,
+              time_series_dir=None, event_log_dir=None, replicate_batches=False):
+    """
+    Run every combination of the variable parameters and return the results as a DataFrame with
+    one row per run, in grid order.
+
+    args:
+    fixed_params: dictionary of WaitingList arguments shared by every run (must include DSAs)
+    variable_params: dictionary mapping WaitingList arguments to the list of values to sweep over
+    processes: number of worker processes, all cores by default.  1 runs in this process.
+    checkpoint_dir: folder to keep a checkpoint of every run in, so an interrupted sweep started
+        again with the same arguments resumes each run where it stopped.  None for no checkpoints.
+    checkpoint_every: number of months between checkpoints
+    time_series_dir: folder to write the monthly time series of every run to (as .npz files named
+        like the checkpoints), None to not record the time series
+    event_log_dir: folder to write the event log of every run to (see eventlog.py, as .bin files
+        named like the checkpoints), None for no event logs
+    replicate_batches: run the seeds of each combination of the other parameters together, as one
+        replicates.ReplicateBatch.  The results have the same distribution as with batched_draws,
+        but are not the same for a seed.  Can not be used with checkpoints, time series or event logs.
+    """
+    runs = parameter_grid(fixed_params, variable_params)
+    names = [checkpoint_name(params, "") for params in runs]
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for params, name in zip(runs, names):
+            params["checkpoint_path"] = os.path.join(checkpoint_dir, name + ".pkl")
+            params["checkpoint_every"] = checkpoint_every
+    if time_series_dir is not None:
+        os.makedirs(time_series_dir, exist_ok=True)
+        for params, name in zip(runs, names):
+            params["time_series_path"] = os.path.join(time_series_dir, name + ".npz")
+            params.setdefault("record_interval", 1)
+    if event_log_dir is not None:
+        os.makedirs(event_log_dir, exist_ok=True)
+        for params, name in zip(runs, names):
+            params["event_log_path"] = os.path.join(event_log_dir, name + ".bin")
+    for DSAs in set(params["DSAs"] for params in runs):
+        load_data(DSAs)
+
+    if replicate_batches:
+        return pd.DataFrame(run_batches(runs, processes))
+    if processes == 1:
+        rows = [run_model(params) for params in runs]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            rows = pool.map(run_model, runs, chunksize=1)
+    return pd.DataFrame(rows)
+
+
+def run_batches(runs, processes=None):
+    """
+    Run the runs of a sweep as one replicate batch per combination of the parameters other than
+    the seed, and return their rows in the order of runs.
+    """
+    scenarios = {}
+    for index, params in enumerate(runs):
+        key = repr(sorted((name, repr(value)) for name, value in params.items() if name != "seed"))
+        scenarios.setdefault(key, []).append(index)
+    batches = [(runs[indices[0]], [runs[i].get("seed", 42) for i in indices]) for indices in scenarios.values()]
+    if processes == 1:
+        results = [run_replicates(*batch) for batch in batches]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(run_replicates, batches, chunksize=1)
+
+    rows = [None] * len(runs)
+    for indices, batch_rows in zip(scenarios.values(), results):
+        for index, row in zip(indices, batch_rows):
+            rows[index] = row
+    return rows
+
+
+# Two-sided 95% quantiles of Student's t distribution for 1 to 30 degrees of freedom
+T_QUANTILES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def confidence_interval_width(values):
+    """
+    Return the width of the 95% confidence interval for the mean of the values.
+    """
+    n = len(values)
+    if n < 2:
+        return float('inf')
+    t = T_QUANTILES_95[n - 2] if n - 1 <= len(T_QUANTILES_95) else 1.960
+    return 2 * t * np.std(values, ddof=1) / np.sqrt(n)
+
+
+def replication_seed(replication, probability_index, common_random_numbers=True):
+    """
+    Return the seed of a replication.  With common random numbers, replication i uses the seed
+    i * 100 at every advantage probability (the seeds main.py uses), so neighbouring probabilities
+    are compared on the same random numbers.  Otherwise every run gets its own seed.
+    """
+    if common_random_numbers:
+        return replication * 100
+    return int(np.random.SeedSequence([replication, probability_index]).generate_state(1)[0])
+
+
+def run_adaptive(fixed_params, advantage_probs, targets, min_replications=5, max_replications=30,
+                 batch_size=2, common_random_numbers=True, processes=None):
+    """
+    Run replications of each advantage probability until the 95% confidence interval of the
+    mean of every target output is at most the target width, or max_replications is reached.
+    Returns a DataFrame with one row per run, sorted by advantage_prob and seed.
+
+    args:
+    fixed_params: dictionary of WaitingList arguments shared by every run (must include DSAs)
+    advantage_probs: list of advantage probabilities to run
+    targets: dictionary mapping output columns (e.g. "Average_Wait") to their target interval width
+    min_replications: number of replications to run before checking the intervals
+    max_replications: largest number of replications for a probability
+    batch_size: number of replications added to each unfinished probability in a round
+    common_random_numbers: use the same seeds at every probability (see replication_seed)
+    processes: number of worker processes, all cores by default
+    """
+    load_data(fixed_params["DSAs"])
+    rows = {p: [] for p in advantage_probs}
+    unfinished = list(advantage_probs)
+
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        while unfinished:
+            # Queue up the next replications of every unfinished probability
+            runs = []
+            for p in unfinished:
+                done = len(rows[p])
+                count = max(min_replications - done, batch_size)
+                for replication in range(done, min(done + count, max_replications)):
+                    params = dict(fixed_params)
+                    params["advantage_prob"] = p
+                    params["seed"] = replication_seed(replication, advantage_probs.index(p),
+                                                      common_random_numbers)
+                    runs.append(params)
+
+            if pool is None:
+                results = [run_model(params) for params in runs]
+            else:
+                results = pool.map(run_model, runs, chunksize=1)
+            for row in results:
+                rows[row["advantage_prob"]].append(row)
+
+            # Stop the probabilities whose outputs are precise enough
+            for p in list(unfinished):
+                done = len(rows[p])
+                precise = all(confidence_interval_width([row[name] for row in rows[p]]) <= width
+                              for name, width in targets.items())
+                if done >= max_replications or (done >= min_replications and precise):
+                    print("Finished advantage_prob %s after %d replications" % (p, done))
+                    unfinished.remove(p)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    df = pd.DataFrame([row for p in advantage_probs for row in rows[p]])
+    return df.sort_values(["advantage_prob", "seed"]).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of the waiting list model.")
+    parser.add_argument("output_file", help="file to write the results to (.csv, .npz or .parquet)")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[s * 100 for s in range(5)])
+    parser.add_argument("--advantage-probs", type=float, nargs="+", default=[0.05])
+    parser.add_argument("--dsas", default="ALL")
+    parser.add_argument("--years", type=int, default=20)
+    parser.add_argument("--average-lifespan", type=float, default=91)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--checkpoint-dir", default=None)
+    parser.add_argument("--checkpoint-every", type=int, default=12)
+    parser.add_argument("--kernels", action="store_true",
+                        help="run the aging and allocation loops as compiled kernels (needs numba to be fast)")
+    parser.add_argument("--profile", action="store_true",
+                        help="add the time spent in each phase and the peak memory of every run to the results")
+    parser.add_argument("--time-series-dir", default=None,
+                        help="write the monthly per-DSA time series of every run to this folder")
+    parser.add_argument("--record-interval", type=int, default=1,
+                        help="months between samples of the time series")
+    parser.add_argument("--event-log-dir", default=None,
+                        help="write a binary log of every patient transition of every run to this folder")
+    parser.add_argument("--steady-state", choices=["stop", "flag"], default=None,
+                        help="stop each run once its outputs settle, or only record the month they settled")
+    parser.add_argument("--replicate-batches", action="store_true",
+                        help="run the seeds of each probability together in one replicate batch")
+    parser.add_argument("--allocation-policy", choices=sorted(POLICIES), default=None,
+                        help="order each DSA's waiting list by this policy instead of plain arrival order")
+    parser.add_argument("--targets", nargs="+", default=None, metavar="OUTPUT=WIDTH",
+                        help="add replications until the 95%% confidence intervals are this narrow")
+    parser.add_argument("--min-replications", type=int, default=5)
+    parser.add_argument("--max-replications", type=int, default=30)
+    parser.add_argument("--independent-seeds", action="store_true",
+                        help="do not use common random numbers across probabilities")
+    args = parser.parse_args()
+
+    fixed_params = {"DSAs": args.dsas,
+                    "output": False,
+                    "average_lifespan": args.average_lifespan,
+                    "years": args.years,
+                    "smart_listing": True,
+                    "engine": "arrays",
+                    "active_set": True,
+                    "kernels": args.kernels}
+    if args.profile:
+        fixed_params["profile"] = True
+    if args.steady_state:
+        fixed_params["steady_state"] = args.steady_state
+    if args.allocation_policy:
+        fixed_params["allocation_policy"] = args.allocation_policy
+    if args.time_series_dir:
+        fixed_params["record_interval"] = args.record_interval
+    variable_params = {"advantage_prob": args.advantage_probs,
+                       "seed": args.seeds}
+
+    if args.targets:
+        targets = {}
+        for target in args.targets:
+            name, width = target.split("=")
+            targets[name] = float(width)
+        df = run_adaptive(fixed_params, args.advantage_probs, targets, args.min_replications,
+                          args.max_replications, common_random_numbers=not args.independent_seeds,
+                          processes=args.processes)
+    else:
+        df = run_sweep(fixed_params, variable_params, args.processes, args.checkpoint_dir, args.checkpoint_every,
+                       args.time_series_dir, args.event_log_dir, args.replicate_batches)
+    save_results(df, args.output_file)
@@ -0,0 +1,8 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Make the model modules importable from the tests, which run from the repository root.  """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
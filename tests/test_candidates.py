@@ -0,0 +1,52 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of the random generation of candidates.  """
+
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from candidates import draw_candidates, draw_candidates_sequential
+from patient_arrays import WAITING
+from waitinglist import WaitingList
+
+
+def assert_distinct_listings(listings, regions):
+    for row in listings:
+        listed = row[row >= 0]
+        assert len(listed) == len(set(listed.tolist()))
+        assert len(listed) <= regions
+        assert (row[len(listed):] == -1).all()
+
+
+@pytest.mark.parametrize("regions", [2, 3])
+@pytest.mark.parametrize("smart_listing", [False, True])
+def test_few_regions(regions, smart_listing):
+    rng = np.random.RandomState(0)
+    probabilities = np.full(regions, 1.0 / regions)
+    rates = np.arange(1, regions + 1, dtype=np.float64)
+    sizes = np.zeros(regions, dtype=np.int64)
+
+    batch = draw_candidates(rng, 2000, probabilities, 1.0, 91, scores=rates if smart_listing else None)
+    assert_distinct_listings(batch.listings, regions)
+    assert (batch.listings[:, 1] >= 0).all()
+
+    batch = draw_candidates_sequential(rng, 500, probabilities, 1.0, 91, rates=rates,
+                                       queue_sizes=sizes if smart_listing else None)
+    assert_distinct_listings(batch.listings, regions)
+    assert (batch.listings[:, 1] >= 0).all()
+
+
+@pytest.mark.parametrize("batched_draws", [False, True])
+def test_queue_lengths_with_few_regions(batched_draws):
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = WaitingList("CAOP,ILIP", advantage_prob=1.0, years=1, engine="arrays",
+                            batched_draws=batched_draws)
+        while model.running:
+            model.step()
+    assert_distinct_listings(model.patients.listings[:model.patients.size], 2)
+    waiting = model.patients.condition[:model.patients.size] == WAITING
+    listings = model.patients.listings[:model.patients.size][waiting]
+    assert model.queue_lengths.tolist() == np.bincount(listings[listings >= 0], minlength=2).tolist()
@@ -0,0 +1,43 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of combining the output files of a sweep.  """
+
+import pandas as pd
+import pytest
+
+from combine_files import combine
+
+
+def write_output(folder, name, rows, columns):
+    pd.DataFrame(rows, columns=columns).to_csv(str(folder / name))
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    folder = tmp_path / "outputs"
+    folder.mkdir()
+    write_output(folder, "a.csv", [[0, 0.1, 5.0]], ["seed", "advantage_prob", "Average_Wait"])
+    return folder
+
+
+def test_columns_in_another_order(outputs):
+    write_output(outputs, "b.csv", [[4.0, 0.0, 1]], ["Average_Wait", "advantage_prob", "seed"])
+    combine(str(outputs), processes=1)
+    combined = pd.read_csv(str(outputs) + ".csv")
+    assert list(combined.columns) == ["advantage_prob", "Unnamed: 0", "seed", "Average_Wait"]
+    assert combined[["advantage_prob", "seed", "Average_Wait"]].values.tolist() == [[0.0, 1, 4.0],
+                                                                                    [0.1, 0, 5.0]]
+
+
+def test_different_columns_raise(outputs):
+    write_output(outputs, "b.csv", [[1, 0.0, 4.0]], ["seed", "advantage_prob", "Average_Time"])
+    with pytest.raises(ValueError, match="b.csv"):
+        combine(str(outputs), processes=1)
+
+
+def test_new_file_must_match_combined_file(outputs):
+    combine(str(outputs), processes=1)
+    write_output(outputs, "b.csv", [[1, 0.0]], ["seed", "advantage_prob"])
+    with pytest.raises(ValueError, match="Average_Wait"):
+        combine(str(outputs), processes=1)
+    assert len(pd.read_csv(str(outputs) + ".csv")) == 1
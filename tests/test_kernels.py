@@ -0,0 +1,12 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of the compiled kernels of the array engine.  """
+
+import pytest
+
+import kernels
+
+
+@pytest.mark.parametrize("active_set", [False, True])
+def test_kernels_match_reference(active_set):
+    assert kernels.check_equivalence((0, 1), active_set=active_set) == []
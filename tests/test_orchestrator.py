@@ -0,0 +1,96 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of the SQLite sweep orchestrator.  """
+
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import orchestrator
+from results_io import REGION_COLUMNS, RUN_COLUMNS, read_results, save_results
+
+GRID = {"fixed": {"DSAs": "CAOP,ILIP,INOP,MNOP", "years": 1, "output": False, "engine": "arrays",
+                  "active_set": True},
+        "variable": {"advantage_prob": [0.1], "seed": [0, 1]}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = str(tmp_path / "sweep.db")
+    connection = orchestrator.connect(path)
+    assert orchestrator.add_grid(connection, GRID) == 2
+    assert orchestrator.work(path) == 2
+    yield path, connection
+    connection.close()
+
+
+@pytest.mark.parametrize("extension", [".csv", ".npz", ".parquet"])
+def test_export_keeps_run_columns(store, tmp_path, extension):
+    path, connection = store
+    results = orchestrator.load_results(connection)
+    output = str(tmp_path / ("results" + extension))
+    save_results(results, output)
+
+    if extension == ".csv":
+        loaded = pd.read_csv(output)
+    else:
+        if extension == ".parquet":
+            pytest.importorskip("pyarrow")
+        loaded = read_results(output)
+    for column in RUN_COLUMNS:
+        assert column in loaded
+    assert list(np.asarray(loaded["worker"])) == results["worker"].tolist()
+    np.testing.assert_allclose(np.asarray(loaded["seconds"], dtype=float), results["seconds"])
+    np.testing.assert_array_equal(np.asarray(loaded["Transplants"]), results["Transplants"])
+
+
+def test_expired_worker_does_not_overwrite(tmp_path, monkeypatch):
+    path = str(tmp_path / "sweep.db")
+    connection = orchestrator.connect(path)
+    orchestrator.add_grid(connection, {"fixed": GRID["fixed"], "variable": {"advantage_prob": [0.1], "seed": [0]}})
+
+    # Another worker takes the run over while this one is running it
+    def run_model(params):
+        connection.execute("UPDATE runs SET worker = 'other'")
+        return {"Transplants": 1}
+    monkeypatch.setattr(orchestrator, "run_model", run_model)
+    monkeypatch.setattr(orchestrator, "load_data", lambda DSAs: None)
+
+    assert orchestrator.work(path) == 0
+    assert orchestrator.status(connection) == {orchestrator.RUNNING: 1}
+    connection.close()
+
+
+@pytest.mark.parametrize("extension", [".npz", ".parquet"])
+def test_read_results_with_other_dsas(store, tmp_path, extension):
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+    path, connection = store
+    results = orchestrator.load_results(connection)
+    first = str(tmp_path / ("first" + extension))
+    second = str(tmp_path / ("second" + extension))
+    save_results(results, first)
+    results["region_codes"] = [codes[:3] for codes in results["region_codes"]]
+    for column in REGION_COLUMNS:
+        results[column] = [values[:3] for values in results[column]]
+    save_results(results, second)
+
+    assert len(read_results([first, first])["seed"]) == 2 * len(results)
+    with pytest.raises(ValueError, match="second"):
+        read_results([first, second])
+
+
+def test_lost_run_fails_after_its_attempts(tmp_path):
+    path = str(tmp_path / "sweep.db")
+    connection = orchestrator.connect(path)
+    orchestrator.add_grid(connection, {"fixed": GRID["fixed"], "variable": {"advantage_prob": [0.1], "seed": [0]}})
+
+    # Every worker that claims the run dies, and its lease expires
+    for attempt in range(orchestrator.DEFAULT_ATTEMPTS):
+        assert orchestrator.claim(connection, "worker %d" % attempt, lease=0) is not None
+        time.sleep(0.01)
+    assert orchestrator.claim(connection, "last worker", lease=0) is None
+    assert orchestrator.status(connection) == {orchestrator.FAILED: 1}
+    connection.close()
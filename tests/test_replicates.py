@@ -0,0 +1,69 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of the replicate batches: the shared waiting lists, the rows of a batch, and agreement in
+distribution with WaitingList.  """
+
+import numpy as np
+import pytest
+
+from patient_arrays import WAITING, SELECTED, DECEASED
+from replicates import ListingQueues, run_replicates
+from sweep import run_model, run_sweep
+
+PARAMS = {"DSAs": "CAOP,ILIP,INOP,MNOP", "advantage_prob": 0.3, "average_lifespan": 91, "years": 5}
+
+# Outputs compared between the batches and the WaitingList runs
+OUTPUTS = ["Transplants", "Primary_Transplants", "Alternate_Transplants", "Count_Waiting", "Count_Deceased",
+           "Advantaged_Transplants", "Average_Wait", "Advantaged_Wait"]
+
+
+def test_queues_take_waiting_patients_in_order():
+    queues = ListingQueues(3)
+    condition = np.full(40, WAITING, dtype=np.int8)
+    listings = np.array([[0, 1, -1, -1], [1, -1, -1, -1], [0, 2, -1, -1], [0, -1, -1, -1]] * 10)
+    queues.extend(listings, 0, condition)
+    condition[[0, 3, 4]] = DECEASED
+
+    taken, regions = queues.take(np.array([0, 1]), np.array([2, 3]), condition)
+    assert taken.tolist() == [2, 6, 1, 5, 8]
+    assert regions.tolist() == [0, 0, 1, 1, 1]
+    condition[taken] = SELECTED
+
+    # Later patients join at the back, after the patients still waiting
+    queues.extend(np.array([[2, 0, -1, -1]]), 40, np.append(condition, WAITING))
+    condition = np.append(condition, WAITING)
+    taken, regions = queues.take(np.array([0, 2]), np.array([100, 100]), condition)
+    region_0 = [patient for patient in range(7, 40) if patient % 4 != 1 and patient != 8] + [40]
+    region_2 = list(range(10, 40, 4)) + [40]
+    assert taken.tolist() == region_0 + region_2
+    assert queues.take(np.array([0]), np.array([1]), np.zeros(41, dtype=np.int8) + SELECTED)[0].tolist() == []
+
+
+def test_one_row_per_replicate():
+    rows = run_replicates(dict(PARAMS, seed=7, years=1, engine="arrays"), [5, 3])
+    assert [row["seed"] for row in rows] == [5, 3]
+    assert rows[0]["Transplants"] != rows[1]["Transplants"]
+    with pytest.raises(ValueError, match="kernels"):
+        run_replicates(dict(PARAMS, kernels=True), [0, 1])
+
+
+def test_sweep_keeps_grid_order():
+    df = run_sweep(dict(PARAMS, years=1), {"advantage_prob": [0.1, 0.2], "seed": [0, 1]}, processes=1,
+                   replicate_batches=True)
+    assert df[["advantage_prob", "seed"]].values.tolist() == [[0.1, 0], [0.1, 1], [0.2, 0], [0.2, 1]]
+
+
+def test_distribution_matches_waiting_list():
+    """
+    The mean of every output over the replicates is within 4 standard errors of the mean of the
+    same seeds run by a WaitingList with batched draws.
+    """
+    seeds = list(range(12))
+    batch = run_replicates(PARAMS, seeds)
+    model = [run_model(dict(PARAMS, seed=seed, output=False, engine="arrays", active_set=True,
+                            batched_draws=True)) for seed in seeds]
+    for output in OUTPUTS:
+        a = np.array([row[output] for row in batch], dtype=float)
+        b = np.array([row[output] for row in model], dtype=float)
+        error = np.sqrt((a.var(ddof=1) + b.var(ddof=1)) / len(seeds))
+        assert abs(a.mean() - b.mean()) <= 4 * error, output
@@ -0,0 +1,40 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Tests of the region-sharded runs: determinism, and agreement in distribution with WaitingList.  """
+
+import numpy as np
+import pytest
+
+from sharded import run_sharded
+from sweep import run_model
+
+PARAMS = {"DSAs": "CAOP,ILIP,INOP,MNOP", "advantage_prob": 0.3, "average_lifespan": 91, "years": 5}
+
+# Outputs compared between the sharded runs and the WaitingList runs
+OUTPUTS = ["Transplants", "Primary_Transplants", "Alternate_Transplants", "Count_Waiting", "Count_Deceased",
+           "Advantaged_Transplants", "Average_Wait", "Advantaged_Wait"]
+
+
+def test_processes_match_in_process():
+    params = dict(PARAMS, seed=1, years=2)
+    in_process = run_sharded(params, shards=2, processes=False)
+    workers = run_sharded(params, shards=2, processes=True)
+    for output in OUTPUTS + ["Death_Region", "Primary_TX"]:
+        np.testing.assert_array_equal(np.asarray(in_process[output]), np.asarray(workers[output]))
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_distribution_matches_waiting_list(shards):
+    """
+    The mean of every output over the seeds is within 4 standard errors of the mean of the same
+    seeds run by a WaitingList with batched draws.
+    """
+    seeds = range(12)
+    sharded = [run_sharded(dict(PARAMS, seed=seed), shards=shards, processes=False) for seed in seeds]
+    model = [run_model(dict(PARAMS, seed=seed, output=False, engine="arrays", active_set=True,
+                            batched_draws=True)) for seed in seeds]
+    for output in OUTPUTS:
+        a = np.array([row[output] for row in sharded], dtype=float)
+        b = np.array([row[output] for row in model], dtype=float)
+        error = np.sqrt((a.var(ddof=1) + b.var(ddof=1)) / len(seeds))
+        assert abs(a.mean() - b.mean()) <= 4 * error, output
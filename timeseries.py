@@ -0,0 +1,78 @@
+# Modeling Advantages in the Transplant Waiting List.
+
+"""Monthly trajectories of the waiting lists, recorded into preallocated arrays.  """
+
+import numpy as np
+
+from patient_arrays import CONDITIONS
+
+# Series recorded for every region: the patients in each condition by primary region, and the
+# number of patients (primary and alternate listings) still waiting on the region's list
+METRICS = tuple(condition.lower() for condition in CONDITIONS) + ("queue_length",)
+
+
+class TimeSeriesRecorder:
+    """
+    Records the per-region series of METRICS every interval months into an array of shape
+    (samples x metrics x regions) allocated up front.  Each sample reads the model's running
+    outcome counters and queue lengths, so recording does not depend on the number of patients.
+
+    Attributes:
+        interval: number of months between samples
+        ticks: month of each sample
+        values: recorded series, only the first size samples are filled in
+        size: number of samples recorded
+    """
+    def __init__(self, months, regions, interval=1):
+        """
+        Create a recorder for a run of the given number of months
+
+        args:
+        months: number of months the model runs for
+        regions: number of regions in the model
+        interval: number of months between samples
+        """
+        self.interval = interval
+        self.regions = regions
+        # The model steps for months + 1 ticks, from 0 to months
+        samples = months // interval + 1
+        self.ticks = np.zeros(samples, dtype=np.int64)
+        self.values = np.zeros((samples, len(METRICS), regions), dtype=np.int64)
+        self.size = 0
+
+    def record(self, model):
+        """
+        Record a sample of the model, if its current tick is on the sampling interval.
+        """
+        if model.ticks % self.interval:
+            return
+        if self.size == len(self.ticks):
+            # The model was stepped past the months it was created for
+            self.ticks = np.concatenate([self.ticks, np.zeros_like(self.ticks)])
+            self.values = np.concatenate([self.values, np.zeros_like(self.values)])
+
+        self.ticks[self.size] = model.ticks
+        self.values[self.size, :len(CONDITIONS)] = model.outcomes.counts
+        self.values[self.size, len(CONDITIONS)] = model.queue_lengths
+        self.size += 1
+
+    def series(self, metric, region=None):
+        """
+        Return the recorded values of a metric, for one region or summed over all regions.
+        """
+        values = self.values[:self.size, METRICS.index(metric)]
+        if region is None:
+            return values.sum(axis=1)
+        return values[:, region]
+
+    def save(self, path, region_codes=None):
+        """
+        Write the recorded samples to a compressed NumPy .npz file, with one (samples x regions)
+        array per metric, the month of each sample under "ticks", and the DSA code of each region
+        under "region_codes".
+        """
+        arrays = {metric: self.values[:self.size, i] for i, metric in enumerate(METRICS)}
+        arrays["ticks"] = self.ticks[:self.size]
+        if region_codes is not None:
+            arrays["region_codes"] = np.array(region_codes, dtype=str)
+        np.savez_compressed(path, **arrays)
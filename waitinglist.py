@@ -3,11 +3,22 @@
 """Model to simulate the waiting list and multiple registrations in the organ transplant system.  """
 
 from data_import import *
+from candidates import draw_candidates, draw_candidates_sequential, smart_listing_scores
 from patients import Patient
+from outcomes import OutcomeCounters
+from patient_arrays import PatientArrays, PatientEvents, PatientArchive, CONDITIONS, WAITING, SELECTED, TRANSPLANTED, DECEASED
 from mesa import Model
 from mesa.time import RandomActivation
-from mesa.datacollection import DataCollector
-from collections import deque
+from queues import RegionQueue, ArrayQueue
+from cohorts import CohortQueue, PatientCohorts
+from timeseries import TimeSeriesRecorder
+from profiling import StepProfile
+from eventlog import EventLog
+from steady_state import SteadyStateMonitor
+from policies import RegionHeap, get_policy
+import os
+import pickle
+import time
 
 
 class WaitingList(Model):
@@ -16,7 +27,11 @@ class WaitingList(Model):
     transplant system.
     """
     def __init__(self, DSAs, advantage_prob=0.05, output=False, average_lifespan=98, years=20,
-                 smart_listing=True, seed=42):
+                 smart_listing=True, seed=42, engine="agents",
+                 active_set=False, batched_draws=False, checkpoint_path=None, checkpoint_every=0,
+                 record_interval=0, time_series_path=None, population_scale=1,
+                 profile=False, kernels=False, event_log_path=None, steady_state=None, steady_window=24,
+                 steady_tolerance=0.02, allocation_policy=None):
         """
         Method to initialize the model
 
@@ -29,9 +44,69 @@ class WaitingList(Model):
             output: flag for the output of the model, set to true by default, can be turned off in batch mode
             average_lifespan: average lifespan for a patient
             years: number of years to run the model for
-            smart_listing: flag for whether agents will pick alternate waiting lists based on shorter queues
+            smart_listing: flag for whether agents will pick alternate waiting lists based on shorter queues,
+                measured by the number of patients still waiting on each list
             seed: Random seed for model
+            engine: "agents" to represent each patient as a Mesa Patient agent, or "arrays" to store
+                all patients in NumPy arrays (PatientArrays) and age them with vectorized operations.
+                Both engines consume the random numbers in the same order and give the same results.
+                "events" stores the patients in arrays too (PatientEvents), but computes their waiting
+                times from the month they entered and files their deaths in a calendar, so a step only
+                handles the patients selected or dying in it; the results are again the same.
+                "cohort" works like "events" for the patients listed in more than one region, but only
+                counts the single-listed patients, in bins by region, month of entry, waiting time at
+                entry and month of death (cohorts.PatientCohorts).  Patients that joined a list in the
+                same month are taken from it in random order, so the results are not the same as with
+                the other engines, but have the same distribution.
+            active_set: flag for moving transplanted and deceased patients out of the schedule (or the
+                array engine's active index) into a compact archive, so each step only visits patients
+                that are still waiting or selected.  Not used by the "events" engine, which never visits
+                patients that have left the waiting lists.
+            batched_draws: flag for drawing the random numbers of each batch of new patients as arrays
+                (candidates.draw_candidates) rather than one patient at a time.  This is faster, but the
+                results for a seed differ from the sequential draws of earlier versions of the model.
+            checkpoint_path: file to write checkpoints of the full model state to, see save_checkpoint
+            checkpoint_every: number of months between checkpoints, 0 to never write checkpoints
+            record_interval: number of months between samples of the per-region time series
+                (see timeseries.TimeSeriesRecorder), 0 (the default) to not record the time series
+            time_series_path: .npz file to write the time series to when the run ends, needs a
+                record_interval
+            population_scale: multiplier applied to the initial waiting list size, the monthly
+                arrivals and the transplant rates, to model a synthetic population that many times
+                larger than the data (used by benchmark.py to stress the model)
+            profile: flag for timing the phases of each step and recording the patients and queue
+                entries held after each tick, in a profiling.StepProfile kept as self.profile
+            kernels: flag for running the aging and allocation loops of the "arrays" engine as the
+                compiled kernels of kernels.py (compiled with Numba if it is installed, plain Python
+                otherwise).  The results are the same as without the kernels.
+            event_log_path: file to stream every listing, selection, transplant and death to, as an
+                eventlog.EventLog, None for no log.  Not available with the "cohort" engine, which does
+                not keep records of the single-listed patients.
+            steady_state: "stop" to end the run once its outputs settle (see
+                steady_state.SteadyStateMonitor), "flag" to only record the tick they settled at, or None
+                to not monitor them.  The tick is kept in self.steady_state.tick.
+            steady_window: number of months in each of the two windows the monitor compares
+            steady_tolerance: largest relative change between the windows of a steady run
+            allocation_policy: name of the policy ordering each region's waiting list (see policies.py),
+                "fifo", "longest_wait" or "shortest_lifespan".  The lists are then kept in indexed
+                heaps (policies.RegionHeap).  None for the plain FIFO queues, which give the same
+                results as "fifo".  Not available with the kernels or the "cohort" engine.
         """
+        if engine not in ("agents", "arrays", "events", "cohort"):
+            raise ValueError("Unknown engine: %s" % engine)
+        if kernels and engine != "arrays":
+            raise ValueError("The kernels are only available for the arrays engine")
+        if event_log_path and engine == "cohort":
+            raise ValueError("The cohort engine can not write an event log")
+        if steady_state not in (None, "stop", "flag"):
+            raise ValueError("Unknown steady_state mode: %s" % steady_state)
+        if allocation_policy is not None and (kernels or engine == "cohort"):
+            raise ValueError("Allocation policies are not available with the kernels or the cohort engine")
+        if time_series_path and not record_interval:
+            raise ValueError("A time_series_path needs a record_interval to record the time series")
+        self.profile = StepProfile() if profile else None
+        if profile:
+            start = time.perf_counter()
         print("Running model for: ", advantage_prob)
 
         # Initialize model parameters
@@ -46,13 +121,33 @@ class WaitingList(Model):
         self.average_lifespan = average_lifespan
         self.smart_listing = smart_listing
         self.months = years*12
-
-        # Pull information for the selected DSAs
-        self.rates = get_transplant_rates(self.DSAs)
-        self.initial_queue_probabilities = get_initial_queue_probabilities(self.DSAs)
-        self.additional_queue_probabilities = get_additional_queue_probabilities(self.DSAs)
-        self.initial_patients = get_wl_size(self.DSAs)
-        self.additional_patients = get_additional_patients(self.DSAs)
+        self.engine = engine
+        self.kernels = kernels
+        if kernels:
+            # Imported here so Numba is only loaded by the models that use the kernels
+            from kernels import select_patients
+            self.select_patients = select_patients
+        self.active_set = active_set
+        self.batched_draws = batched_draws
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.time_series_path = time_series_path
+        self.event_log_path = event_log_path
+        self.policy = get_policy(allocation_policy) if allocation_policy is not None else None
+
+        # Pull information for the selected DSAs, regions are numbered in the order of the data files
+        parameters = get_dsa_parameters(self.DSAs)
+        self.region_codes = parameters.dsas
+        self.rates = parameters.rates
+        self.initial_queue_probabilities = parameters.initial_queue_probabilities
+        self.additional_queue_probabilities = parameters.additional_queue_probabilities
+        self.initial_patients = parameters.wl_size
+        self.additional_patients = parameters.additional_patients
+        if population_scale != 1:
+            self.rates = [rate * population_scale for rate in self.rates]
+            self.initial_patients = int(round(self.initial_patients * population_scale))
+            self.additional_patients = self.additional_patients * population_scale
+        self.rate_array = np.array(self.rates, dtype=np.float64)
 
         npr.seed(int(seed))
 
@@ -68,27 +163,51 @@ class WaitingList(Model):
         self.alternate_listing_transplant = []  # TX of a patient that was an alternate listing
         self.primary_waiting = []  # Number of Primary Patients added to the Waiting List
         self.alternate_waiting = []  # Number of Alternate Patients added to the Waiting List
-        self.waiting_list_start = [] # Tracks where the method should pick up for the queue
 
         # Set up model objects, to track the number of patients in each state.
         self.schedule = RandomActivation(self)
-        self.dc = DataCollector({"Waiting": lambda m: self.count_type(m, "Waiting"),
-                                 "Selected": lambda m: self.count_type(m, "Selected"),
-                                 "Deceased": lambda m: self.count_type(m, "Deceased"),
-                                 "Transplanted": lambda m: self.count_type(m, "Transplanted")})
+        if engine == "arrays":
+            self.patients = PatientArrays(active_set=active_set, kernels=kernels)
+        elif engine == "events":
+            self.patients = PatientEvents()
+        elif engine == "cohort":
+            self.patients = PatientCohorts(self.regions, int(seed))
+        else:
+            self.patients = None
+        self.archive = PatientArchive()  # Retired agents when using the active set
+        self.outcomes = OutcomeCounters(self.regions)  # Patients in each condition, by region
+        self.queue_lengths = np.zeros(self.regions, dtype=np.int64)  # Patients waiting on each list
+        self.listing_scores = smart_listing_scores(self.rates, self.queue_lengths)  # For smart listing
+        self.queue_live = np.zeros(self.regions, dtype=np.int64)  # Waiting patients in each queue, for the kernels
+        self.time_series = TimeSeriesRecorder(self.months, self.regions, record_interval) if record_interval else None
+        self.event_log = EventLog(event_log_path, self.region_codes) if event_log_path else None
+        self.steady_state = None
+        if steady_state is not None:
+            self.steady_state = SteadyStateMonitor(self.regions, steady_window, steady_tolerance,
+                                                   stop=steady_state == "stop")
 
         # Initialize all the regions
         for i in range(self.regions):
-            self.queues.append([])
+            if self.policy is not None:
+                self.queues.append(RegionHeap())
+            elif engine == "cohort":
+                self.queues.append(CohortQueue(self.patients))
+            elif kernels:
+                self.queues.append(ArrayQueue(self.patients.is_waiting, i, self.queue_live))
+            elif self.patients is not None:
+                self.queues.append(RegionQueue(self.patients.is_waiting))
+            else:
+                self.queues.append(RegionQueue(Patient.is_waiting))
             self.primary_listing_transplant.append(0)
             self.alternate_listing_transplant.append(0)
             self.primary_waiting.append(0)
             self.alternate_waiting.append(0)
-            self.waiting_list_start.append(0)
 
         self.add_candidates(self.initial_patients, initial=True)
 
         self.running = True
+        if profile:
+            self.profile.lap("init", start)
 
     def add_candidates(self, num_to_add, initial=False):
         """
@@ -102,100 +221,100 @@ class WaitingList(Model):
         # Use the initial or additional probabilities listing - depending on the mode
         if initial:
             queue_probabilities = self.initial_queue_probabilities
-
-            # Create probability tables on the waiting list time from the OTPN data on the website.
-            options = [[0, 1], [1, 3], [3, 6], [6, 12], [12, 24], [24, 36], [36, 60], [60, 80]]
-            initial_prob = [0.0411, 0.0665, 0.0825, 0.1368, 0.2004, 0.1409, 0.1830, 0.1488]
-            # Choose the waiting range for the patient
-            patient_waiting_range = list(npr.choice(len(options), num_to_add, replace=True, p=initial_prob))
-
         else:
             queue_probabilities = self.additional_queue_probabilities
 
-        # Generate the list of regions to add patients to
-        all_patient_regions = npr.choice(self.regions, num_to_add, replace=True, p=queue_probabilities)
-
-        # Place a person in each region
-        for i in range(num_to_add):
-
-            # Set the regions for this patient
-            primary_region = all_patient_regions[i]
-            patient_region = [primary_region]
-
-            # Select the region from the generated list
-            self.primary_waiting[primary_region] += 1
-
-
-            # Determine if the patient is advantaged
-            if npr.rand() <= self.advantage_probability:
-                # Remove the primary region from the list of possibilities
-                possible_regions = list(range(self.regions))
-                possible_regions.remove(primary_region)
-
-                # if using self.smart-listing, remove the chosen primary region from the rankings
-                if self.smart_listing:
-                    queue_sizes = []
-
-                    # Calculations of transplant rates/waiting list size calculations - for smart listing
-                    for region in range(self.regions):
-                        queue_sizes.append(len(self.queues[region]))
-
-                    # Compute the best regions to add to by computing the number
-                    # of TX per queue size
-                    best_choice_score =  list(np.array(self.rates).astype('float')/(np.array(queue_sizes)+1))
-                    best_choice_score.pop(primary_region)
-                    probs = np.array(best_choice_score)/sum(best_choice_score)
+        # With smart listing, alternate waiting lists are picked based on the number
+        # of transplants per patient waiting on each list
+        if self.batched_draws:
+            scores = self.listing_scores if self.smart_listing else None
+            batch = draw_candidates(npr, num_to_add, queue_probabilities, self.advantage_probability,
+                                    self.average_lifespan, initial, scores)
+        else:
+            queue_sizes = self.queue_lengths if self.smart_listing else None
+            batch = draw_candidates_sequential(npr, num_to_add, queue_probabilities, self.advantage_probability,
+                                               self.average_lifespan, initial, self.rates, queue_sizes)
+        self.admit_candidates(batch)
 
-                    # Select 1 to 4 more regions to join the waiting list
-                    secondary_listings = list(npr.choice(possible_regions, npr.randint(1, 4),
-                                                         replace=False, p=probs))
+    def admit_candidates(self, batch):
+        """
+        Place a batch of candidates (a CandidateBatch) on their waiting lists.
+        """
+        listings = batch.listings
+        num_to_add = len(listings)
+        primary = listings[:, 0]
+        advantaged = listings[:, 1] >= 0
+
+        # Add patient counts to the primary_waiting and alternate_waiting structures
+        primary_counts = np.bincount(primary, minlength=self.regions)
+        alternate_counts = np.bincount(listings[:, 1:][listings[:, 1:] >= 0], minlength=self.regions)
+        for region in range(self.regions):
+            self.primary_waiting[region] += int(primary_counts[region])
+            self.alternate_waiting[region] += int(alternate_counts[region])
+        self.outcomes.add_many(WAITING, primary, advantaged)
+        self.queue_lengths += primary_counts + alternate_counts
+        self.listing_scores = smart_listing_scores(self.rates, self.queue_lengths)
+
+        # Log a listing for every region each patient joins, patients are numbered in arrival order
+        if self.event_log is not None:
+            rows, columns = np.nonzero(listings >= 0)
+            self.event_log.extend(rows + self.candidates, self.ticks, listings[rows, columns], WAITING,
+                                  advantaged[rows])
+
+        # Priority of each patient under the allocation policy, fixed when they join the lists
+        if self.policy is not None:
+            priorities = self.policy.priority(self.ticks, batch.waiting, batch.lifespan)
+
+        if self.patients is not None:
+            lifespan = batch.lifespan
+            waiting = batch.waiting
+            if self.engine == "cohort":
+                # Only count the single-listed patients, in the bins of their region
+                single = ~advantaged
+                self.patients.add_singles(self.queues, primary[single], lifespan[single], waiting[single])
+                listings, lifespan, waiting = listings[advantaged], lifespan[advantaged], waiting[advantaged]
+
+            # Store the patients in the arrays, the queues hold the patients' indices
+            first = self.patients.add_many(listings, lifespan, waiting)
+            self.candidates += num_to_add
+
+            # Add each patient to the queue of every region they are listed in, in order
+            rows, columns = np.nonzero(listings >= 0)
+            listed_regions = listings[rows, columns]
+            order = np.argsort(listed_regions, kind='stable')
+            ends = np.cumsum(np.bincount(listed_regions, minlength=self.regions))
+            patient_ids = (rows[order] + first).tolist()
+            if self.policy is not None:
+                patient_priorities = priorities[rows[order]].tolist()
+            start = 0
+            for region in range(self.regions):
+                if self.policy is not None:
+                    self.queues[region].extend(patient_ids[start:ends[region]],
+                                               patient_priorities[start:ends[region]])
                 else:
-                    secondary_listings = list(npr.choice(possible_regions, npr.randint(1, 4),
-                                                         replace=False))
-
-                patient_region.extend(secondary_listings)
-
-                # Add patient counts to alternate_waiting structure
-                for listing in secondary_listings:
-                    self.alternate_waiting[listing] += 1
+                    self.queues[region].extend(patient_ids[start:ends[region]])
+                start = ends[region]
+            return
 
+        for i in range(num_to_add):
+            patient_region = listings[i][listings[i] >= 0].tolist()
             patient_id = self.candidates
             self.candidates += 1
 
-            # If this is the initial patient addition, provide the patient with waiting time.
-            if initial:
-                # Use the time range to select the waiting time - uniformly distributed within the range.
-                patient_waiting = npr.randint(options[patient_waiting_range[i]][0],
-                                              options[patient_waiting_range[i]][1])
-                patient_lifespan = 5*npr.randn(1)[0] + self.average_lifespan
-
-                # Ensure Patients don't have a shorter lifespan than
-                # the time they've already spend waiting.
-                # RE-compute the lifespan until it's longer than their
-                # time waiting.  We assume that any patient with
-                # a shorted lifespan than their time waiting has
-                # passed away before the start of the simulation.
-                while patient_waiting > patient_lifespan:
-                    patient_lifespan = 5*npr.randn(1)[0] + self.average_lifespan
-                    print(patient_waiting, patient_lifespan)
-
-            else:
-                patient_waiting = 0
-                # Set the patient's lifespan using a normal random
-                # number distribution N(average_lifespan, 25)
-                patient_lifespan = 5*npr.randn(1)[0] + self.average_lifespan
-
             # Create the patient
             new_patient = Patient(patient_id, self, patient_region,
-                                  patient_lifespan, patient_waiting)
-
-            # Add to the queue
-            for q in patient_region:
-                self.queues[q].append(new_patient)
+                                  batch.lifespan[i], int(batch.waiting[i]))
 
             # Add the the schedule
             self.schedule.add(new_patient)
 
+            # Add to the queue
+            for q in patient_region:
+                if self.policy is not None:
+                    self.queues[q].push(new_patient, float(priorities[i]), patient_id)
+                else:
+                    self.queues[q].append(new_patient)
+
     def step(self):
         """
         Advance the model by one step.
@@ -207,9 +326,25 @@ class WaitingList(Model):
         4. Add new candidates to the list.
         5. Increase the time stamp by one.
         """
-
-        self.schedule.step()
-        self.dc.collect(self)
+        profile = self.profile
+        if profile is not None:
+            start = time.perf_counter()
+
+        if self.patients is not None:
+            self.age_patients()
+            if self.engine == "cohort":
+                transplanted, deceased = self.patients.age_cohorts()
+                self.outcomes.transition_counts(SELECTED, TRANSPLANTED, transplanted)
+                self.outcomes.transition_counts(WAITING, DECEASED, deceased)
+                self.leave_queues_counts(deceased)
+        else:
+            self.schedule.step()
+        if profile is not None:
+            start = profile.lap("aging", start)
+        if self.time_series is not None:
+            self.time_series.record(self)
+            if profile is not None:
+                start = profile.lap("collect", start)
 
         # Print out the year
         if (self.ticks % 12) == 0:
@@ -223,48 +358,202 @@ class WaitingList(Model):
         for i in region_list:
             # transplants to be performed
             num_to_select = npr.poisson(self.rates[i])
-            starting_point = self.waiting_list_start[i]
-            queue = deque(self.queues[i][starting_point:])
-
-            # Mark the first num_to_select patients as selected
+            queue = self.queues[i]
+
+            if self.kernels:
+                outcomes = self.outcomes
+                selected = np.empty(num_to_select, dtype=np.int64)
+                queue.head, primary_selected, alternate_selected, advantaged_wait = self.select_patients(
+                    queue.items, queue.head, queue.end, num_to_select, i, self.patients.condition,
+                    self.patients.waiting, self.patients.listings, outcomes.counts, outcomes.advantaged,
+                    outcomes.transplant_wait, self.queue_live, self.queue_lengths, self.rate_array,
+                    self.listing_scores, selected)
+                if self.event_log is not None:
+                    selected = selected[:primary_selected + alternate_selected]
+                    self.event_log.extend(selected, self.ticks, i, SELECTED, self.patients.advantaged(selected))
+                self.primary_listing_transplant[i] += primary_selected
+                self.alternate_listing_transplant[i] += alternate_selected
+                outcomes.advantaged_transplant_wait += advantaged_wait
+                queue.compact()
+                continue
+
+            # Mark the first num_to_select waiting patients as selected
             j = 0
-            while j < num_to_select and len(queue) > 0:
-
-                # Increment the starting point by one for the next iteration
-                starting_point += 1
-
-                # Select the top patient on the list
-                top_of_list = queue.popleft()
-                # Get the status of the patient
-                top_status = top_of_list.get_condition()
-                # Get whether the patient was on this list as their primary
-                top_primary = top_of_list.get_primary()
-
-                # If this is the primary listing location, add to the
-                # number of primary transplants given
-                if top_status == "Waiting":
+            while j < num_to_select:
+
+                # Select the top waiting patient on the list, patients that are no
+                # longer waiting are skipped by the queue
+                top_of_list = queue.pop_waiting()
+                if top_of_list is None:
+                    break
+
+                if self.engine == "cohort" and isinstance(top_of_list, tuple):
+                    # A single-listed patient, from the bins of this region
+                    top_primary = i
+                    waiting = self.patients.select_single(i, *top_of_list)
+                    self.outcomes.transition(WAITING, SELECTED, i, False, waiting)
+                    self.leave_queues((i,))
+                elif self.patients is not None:
+                    top_primary = self.patients.primary[top_of_list]
+                    waiting = self.patients.select(top_of_list)
+                    self.outcomes.transition(WAITING, SELECTED, top_primary,
+                                             self.patients.advantaged(top_of_list), waiting)
+                    self.leave_queues(self.patients.listings[top_of_list], top_of_list)
+                    if self.event_log is not None:
+                        self.event_log.append(top_of_list, self.ticks, i, SELECTED,
+                                              self.patients.advantaged(top_of_list))
+                else:
+                    # Get whether the patient was on this list as their primary
+                    top_primary = top_of_list.get_primary()
                     top_of_list.selected()
-                    if top_primary == i:
-                        self.primary_listing_transplant[i] += 1
-                    else:
-                        self.alternate_listing_transplant[i] += 1
-                    j += 1
+                    if self.event_log is not None:
+                        self.event_log.append(top_of_list.unique_id, self.ticks, i, SELECTED,
+                                              top_of_list.advantaged)
+
+                self.count_transplant(i, top_primary)
+                j += 1
 
-            self.waiting_list_start[i] = starting_point
+            queue.compact()
+        if profile is not None:
+            start = profile.lap("allocation", start)
 
         # Add new patients
         self.add_candidates(npr.poisson(self.additional_patients))
+        if profile is not None:
+            start = profile.lap("candidates", start)
+            self.record_profile_tick()
+
+        # Check whether the outputs have settled
+        steady = self.steady_state is not None and self.steady_state.update(self) and self.steady_state.stop
 
         # Add a time stamp
         self.ticks += 1
 
-        # Halt if no more waiting or TS >= Max Time
-        if self.count_type(self, "Waiting") == 0 or self.ticks > self.months:
+        # Halt if no more waiting, TS >= Max Time or the run reached its steady state
+        if steady or self.count_type(self, "Waiting") == 0 or self.ticks > self.months:
             if self.output:
                 self.finalize()
+            if self.time_series_path and self.time_series is not None:
+                self.time_series.save(self.time_series_path, self.region_codes)
+            if self.event_log is not None:
+                self.event_log.close()
             self.running = False
 
+        # Save the state of the model every checkpoint_every months
+        if self.running and self.checkpoint_every and self.ticks % self.checkpoint_every == 0:
+            self.save_checkpoint()
+            if profile is not None:
+                profile.lap("checkpoint", start)
+
+    def age_patients(self):
+        """
+        Age the patients stored in arrays by one month, count the transplants and deaths, and take
+        the patients that died off their lists.  Returns the indices of the patients transplanted
+        and deceased.
+        """
+        patients = self.patients
+        transplanted, deceased = patients.age()
+        self.outcomes.transition_many(SELECTED, TRANSPLANTED, patients.primary[transplanted],
+                                      patients.advantaged(transplanted))
+        self.outcomes.transition_many(WAITING, DECEASED, patients.primary[deceased], patients.advantaged(deceased))
+        self.leave_queues_many(patients.listings[deceased], deceased)
+        if self.event_log is not None:
+            for selected, event in ((transplanted, TRANSPLANTED), (deceased, DECEASED)):
+                self.event_log.extend(selected, self.ticks, patients.primary[selected], event,
+                                      patients.advantaged(selected))
+        return transplanted, deceased
+
+    def count_transplant(self, region, primary):
+        """
+        Count a transplant performed in a region, as a primary listing transplant if the region is
+        the primary region of the patient, as an alternate listing transplant otherwise.
+        """
+        if primary == region:
+            self.primary_listing_transplant[region] += 1
+        else:
+            self.alternate_listing_transplant[region] += 1
+
+    def record_profile_tick(self):
+        """
+        Record the number of patients and queue entries held by the model in the profile.
+        """
+        if self.patients is not None:
+            stored = self.patients.stored()
+        else:
+            stored = self.schedule.get_agent_count()
+        alive = self.outcomes.total(WAITING) + self.outcomes.total(SELECTED)
+        queue_entries = sum(queue.entries() for queue in self.queues)
+        self.profile.record_tick(stored, alive, queue_entries)
 
+    def retire(self, patient):
+        """
+        Move a transplanted or deceased patient out of the schedule and into the archive.
+        """
+        self.schedule.remove(patient)
+        self.archive.add(patient.condition, patient.primary, patient.waiting, patient.advantaged)
+
+    def save_checkpoint(self, path=None):
+        """
+        Write the full state of the model (patients, queues and their cursors, counters, tick)
+        and of the NumPy random number generator to a binary (pickle) file.  The file is
+        replaced atomically, so it always holds a complete checkpoint.
+
+        args:
+        path: file to write to, checkpoint_path by default
+        """
+        path = path or self.checkpoint_path
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, "wb") as f:
+            pickle.dump({"model": self, "numpy_random_state": npr.get_state()}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def resume(path):
+        """
+        Load a model from a checkpoint written by save_checkpoint, and restore the NumPy random
+        number generator.  Stepping the resumed model gives results identical to a run that was
+        never interrupted.
+        """
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+        npr.set_state(checkpoint["numpy_random_state"])
+        return checkpoint["model"]
+
+    def leave_queues(self, regions, patient=None):
+        """
+        Record that a patient listed in the given regions is no longer waiting.  Regions
+        given as -1 (padding in the array engine) are ignored.  With an allocation policy the
+        patient is removed from the heap of each region.
+        """
+        for region in regions:
+            if region >= 0:
+                if self.policy is not None:
+                    self.queues[region].remove(patient)
+                self.queues[region].discard()
+                self.queue_lengths[region] -= 1
+                self.listing_scores[region] = self.rates[region] / (self.queue_lengths[region] + 1.0)
+
+    def leave_queues_many(self, listings, patients=None):
+        """
+        Record that the patients with the given rows of listing regions are no longer waiting.
+        """
+        if self.policy is not None:
+            for patient, regions in zip(patients.tolist(), listings.tolist()):
+                for region in regions:
+                    if region >= 0:
+                        self.queues[region].remove(patient)
+        self.leave_queues_counts(np.bincount(listings[listings >= 0], minlength=self.regions))
+
+    def leave_queues_counts(self, counts):
+        """
+        Record that counts[region] patients listed in each region are no longer waiting.
+        """
+        changed = np.flatnonzero(counts)
+        for region in changed:
+            self.queues[region].discard(int(counts[region]))
+        self.queue_lengths -= counts
+        self.listing_scores[changed] = np.array(self.rates)[changed] / (self.queue_lengths[changed] + 1.0)
 
     def print_queue(self):
         # Print out the initial Queues
@@ -274,16 +563,38 @@ class WaitingList(Model):
                 q.append(str(candidate))
             print(q)
 
+    def get_patient_table(model):
+        """
+        Return the condition code, primary region, waiting time and advantaged flag of every
+        patient in the model as NumPy arrays, independent of the engine storing the patients.
+        The cohort engine does not keep records of the single-listed patients, so it has no table.
+        """
+        if model.engine == "cohort":
+            raise ValueError("The cohort engine does not keep a record of every patient")
+        if model.patients is not None:
+            patients = model.patients
+            return (patients.condition[:patients.size], patients.primary[:patients.size],
+                    patients.current_waiting(), patients.advantaged())
+
+        agents = model.schedule.agents
+        condition = np.array([patient.condition for patient in agents], dtype=np.int8)
+        primary = np.array([patient.get_primary() for patient in agents], dtype=np.int64)
+        waiting = np.array([patient.get_waiting() for patient in agents], dtype=np.int64)
+        advantaged = np.array([patient.get_advantaged() for patient in agents], dtype=bool)
+        if len(model.archive) == 0:
+            return condition, primary, waiting, advantaged
+
+        # Include the patients that were retired from the schedule
+        archived = model.archive.as_arrays()
+        return (np.concatenate([archived[0], condition]), np.concatenate([archived[1], primary]),
+                np.concatenate([archived[2], waiting]), np.concatenate([archived[3], advantaged]))
+
     @staticmethod
     def count_type(model, patient_condition):
         """
         Helper method to count patients in a given condition in a given model.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            if patient.condition == patient_condition:
-                count += 1
-        return count
+        return model.outcomes.total(CONDITIONS.index(patient_condition))
 
     def get_primary_center_transplants(model):
         return sum(model.primary_listing_transplant)
@@ -301,137 +612,75 @@ class WaitingList(Model):
         """
         Return the total number of patients waiting for a transplant.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            if patient.get_condition() == "Waiting":
-                count += 1
-        return count
+        return model.outcomes.total(WAITING)
 
     def get_transplants(model):
         """
         Get the total number of transplants.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                count += 1
-        return count
+        return model.outcomes.total(TRANSPLANTED) + model.outcomes.total(SELECTED)
 
     def get_advantaged_transplants(model):
         """
         Return the total number of advantaged patients that received a transplant.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                if patient.get_advantaged():
-                    count += 1
-        return count
+        return int(model.outcomes.advantaged[TRANSPLANTED] + model.outcomes.advantaged[SELECTED])
 
     def get_advantaged_deceased(model):
         """
         Return the total number of advantaged patients that received a transplant.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            if patient.get_condition() == "Deceased":
-                if patient.get_advantaged():
-                    count += 1
-        return count
+        return int(model.outcomes.advantaged[DECEASED])
 
     def get_deceased(model):
         """
         Return the total number of patients that died.
         """
-        count = 0
-        for patient in model.schedule.agents:
-            if patient.get_condition() == "Deceased":
-                count += 1
-        return count
+        return model.outcomes.total(DECEASED)
 
     def get_average_waiting(model):
         """
         Return average time spent waiting for patients that received a
         transplant.
         """
-        count = 0
-        waiting_time = 0
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                count += 1
-                waiting_time += patient.get_waiting()
-        return waiting_time / float(count)
+        return int(model.outcomes.transplant_wait.sum()) / float(model.get_transplants())
 
     def get_average_waiting_advantaged(model):
         """
         Return average time spent waiting for ADVANTAGED patients
         that received a transplant.
         """
-        count = 0
-        waiting_time = 0
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                if patient.get_advantaged():
-                    count += 1
-                    waiting_time += patient.get_waiting()
+        count = model.get_advantaged_transplants()
         if count == 0:
             return 0
         else:
-            return waiting_time / float(count)
+            return model.outcomes.advantaged_transplant_wait / float(count)
 
     def get_primary_waiting_rates(model):
         """
         Return average time spent waiting for patients that received
         a transplant on each list.
         """
-        count = [0] * model.regions
-        wrates = [0] * model.regions
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                p = patient.get_primary()
-                count[p] += 1
-                wrates[p] += patient.get_waiting()
-        return np.array(wrates).astype('float') / np.array(count).astype('float')
+        count = model.outcomes.counts[TRANSPLANTED] + model.outcomes.counts[SELECTED]
+        return model.outcomes.transplant_wait.astype('float') / count.astype('float')
 
     def get_primary_deaths_regional(model):
         """
         Return deaths before transplant for each list.
         """
-        deaths = [0] * model.regions
-        for patient in model.schedule.agents:
-            p = patient.get_primary()
-            if patient.get_condition() == "Deceased":
-                deaths[p] += 1
-        return deaths
+        return model.outcomes.counts[DECEASED].tolist()
 
     def get_primary_wl_regional(model):
         """
         Return primary WL size per region.
         """
-        count = [0] * model.regions
-        for patient in model.schedule.agents:
-            condition = patient.get_condition()
-            if condition == "Waiting":
-                p = patient.get_primary()
-                count[p] += 1
-        return count
+        return model.outcomes.counts[WAITING].tolist()
 
     def get_primary_tx_regional(model):
         """
         Return txs for each list.
         """
-        tx = [0] * model.regions
-        for patient in model.schedule.agents:
-            p = patient.get_primary()
-            condition = patient.get_condition()
-            if condition == "Transplanted" or condition == "Selected":
-                tx[p] += 1
-        return tx
+        return (model.outcomes.counts[TRANSPLANTED] + model.outcomes.counts[SELECTED]).tolist()
 
     def finalize(model):
         print("Number of primary Center Transplants: \t", str(model.primary_listing_transplant))